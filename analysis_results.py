@@ -0,0 +1,210 @@
+"""
+分析結果の型（タイムブロック・Dashboard Summary・VibeGraph）
+
+LLMの応答（JSON）を1回だけ解釈して、保存・集計に使う値を持つ軽量なオブジェクトにする。
+
+- キーの別名（emotionScores / vibeScores、averageScore / averageVibe、cumulative_evaluation / insights）は
+  解釈時に1回だけ解決する
+- 48スロットのスコア配列は array('d') に格納し、未分析・NaN は nan で表す（リストより小さく、平均の計算も速い）
+- 元のJSON（analysis_result としてJSONBに保存・レスポンスに返すもの）はコピーせずに raw として保持する
+"""
+
+import math
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# 1日のスロット数（30分単位）
+SLOTS_PER_DAY = 48
+
+# LLMの出力でスコア配列・平均スコア・総合評価に使われるキー（先頭ほど優先）
+VIBE_SCORES_KEYS = ("emotionScores", "vibeScores")
+AVERAGE_VIBE_KEYS = ("averageScore", "averageVibe")
+INSIGHTS_KEYS = ("cumulative_evaluation", "insights")
+
+NAN = float("nan")
+
+
+def to_score(value: Any) -> float:
+    """スコアを float に変換（None・"NaN"・数値以外は nan）"""
+    if isinstance(value, bool):
+        return NAN
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return NAN
+    return NAN
+
+
+def score_value(value: float) -> Optional[float]:
+    """nan・無限大を None に、整数値を int に変換（JSON・DBに保存する形）"""
+    if math.isnan(value) or math.isinf(value):
+        return None
+    return int(value) if value.is_integer() else value
+
+
+def first_key(data: Dict[str, Any], keys: Tuple[str, ...]) -> Optional[str]:
+    """data に含まれる最初のキー（別名の解決）"""
+    return next((key for key in keys if key in data), None)
+
+
+class ScoreArray:
+    """スロットごとのスコア（array('d')、未分析・NaN は nan）"""
+
+    __slots__ = ("values",)
+
+    def __init__(self, values: Iterable[Any] = ()):
+        self.values = array("d", (to_score(value) for value in values))
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def padded(self, length: int = SLOTS_PER_DAY) -> "ScoreArray":
+        """length 件に満たない場合は nan で補完したもの"""
+        missing = length - len(self.values)
+        if missing <= 0:
+            return self
+        result = ScoreArray()
+        result.values = self.values + array("d", [NAN]) * missing
+        return result
+
+    def valid(self) -> List[float]:
+        return [value for value in self.values if not math.isnan(value)]
+
+    def nan_count(self) -> int:
+        return sum(1 for value in self.values if math.isnan(value))
+
+    def average(self) -> float:
+        """分析済みスロットの平均（なければ nan）"""
+        valid = self.valid()
+        return sum(valid) / len(valid) if valid else NAN
+
+    def to_list(self) -> List[Optional[float]]:
+        """JSON・DBに保存する形（nan は None）"""
+        return [score_value(value) for value in self.values]
+
+
+class TimeBlockResult:
+    """タイムブロック1件の分析結果（audio_scorer の1行）"""
+
+    __slots__ = ("summary", "behavior", "vibe_score", "raw")
+
+    def __init__(self, summary: Optional[str], behavior: Optional[str], vibe_score: float, raw: Dict[str, Any]):
+        self.summary = summary
+        self.behavior = behavior
+        self.vibe_score = vibe_score
+        self.raw = raw
+
+    @classmethod
+    def decode(cls, data: Dict[str, Any]) -> "TimeBlockResult":
+        return cls(data.get("summary"), data.get("behavior"), to_score(data.get("vibe_score")), data)
+
+    @property
+    def processing_error(self) -> Optional[str]:
+        return self.raw.get("processing_error")
+
+    def columns(self) -> Dict[str, Any]:
+        """audio_scorer の個別カラムに保存する値"""
+        return {
+            "vibe_summary": self.summary,
+            "vibe_behavior": self.behavior,
+            "vibe_score": score_value(self.vibe_score),
+        }
+
+
+class DashboardSummaryResult:
+    """Dashboard Summary（1日分）の分析結果"""
+
+    __slots__ = ("vibe_scores", "average_vibe", "insights", "burst_events", "scores_key", "average_key", "raw")
+
+    def __init__(self, raw: Dict[str, Any]):
+        self.raw = raw
+        self.scores_key = first_key(raw, VIBE_SCORES_KEYS)
+        self.average_key = first_key(raw, AVERAGE_VIBE_KEYS)
+        scores = raw.get(self.scores_key) if self.scores_key else None
+        self.vibe_scores = ScoreArray(scores) if isinstance(scores, list) else None
+        self.average_vibe = to_score(raw[self.average_key]) if self.average_key else None
+        insights_key = first_key(raw, INSIGHTS_KEYS)
+        self.insights = raw[insights_key] if insights_key else None
+        self.burst_events = raw.get("burst_events")
+
+    @classmethod
+    def decode(cls, data: Dict[str, Any]) -> "DashboardSummaryResult":
+        return cls(data)
+
+    def columns(self) -> Dict[str, Any]:
+        """dashboard_summary の個別カラムに保存する値（該当する項目がない場合は None）"""
+        return {
+            "vibe_scores": self.vibe_scores.to_list() if self.vibe_scores is not None else None,
+            "average_vibe": score_value(self.average_vibe) if self.average_vibe is not None else None,
+            "insights": self.insights,
+            "burst_events": self.burst_events,
+        }
+
+    def with_numeric_fields(
+        self,
+        scores: List[Optional[float]],
+        average: Optional[float],
+        events: List[Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        """数値項目（スコア配列・平均・バーストイベント）を置き換えた analysis_result（総合評価はそのまま）"""
+        updated = dict(self.raw)
+        if self.scores_key:
+            updated[self.scores_key] = scores
+        if self.average_key:
+            updated[self.average_key] = average
+        updated["burst_events"] = events
+        return updated
+
+
+class VibeGraphResult:
+    """VibeGraph（vibe_whisper_summary、非推奨エンドポイント）の分析結果"""
+
+    __slots__ = (
+        "emotion_scores", "average_score", "positive_hours", "negative_hours", "neutral_hours",
+        "insights", "emotion_changes", "validation_info"
+    )
+
+    def __init__(self, data: Dict[str, Any]):
+        self.validation_info: Dict[str, Any] = {
+            "original_score_count": 0,
+            "expected_score_count": SLOTS_PER_DAY,
+            "score_length_warning": False,
+            "missing_scores_filled": 0,
+            "nan_scores_detected": 0
+        }
+        raw_scores = data.get("emotionScores")
+        if isinstance(raw_scores, list):
+            scores = ScoreArray(raw_scores)
+            self.validation_info["original_score_count"] = len(scores)
+            self.validation_info["nan_scores_detected"] = scores.nan_count()
+            if len(scores) < SLOTS_PER_DAY:
+                # 48個に満たない場合は nan で補完
+                self.validation_info["missing_scores_filled"] = SLOTS_PER_DAY - len(scores)
+                self.validation_info["score_length_warning"] = True
+                scores = scores.padded()
+            # averageScoreを再計算（nan を除外）
+            self.validation_info["average_calculated_from"] = len(scores.valid())
+            self.average_score = scores.average()
+        elif "emotionScores" not in data:
+            # emotionScoresが存在しない場合は nan で初期化
+            scores = ScoreArray().padded()
+            self.validation_info["missing_scores_filled"] = SLOTS_PER_DAY
+            self.validation_info["score_length_warning"] = True
+            self.average_score = NAN
+        else:
+            # リスト以外の場合は検証せずそのまま扱う
+            scores = ScoreArray()
+            self.average_score = to_score(data.get("averageScore", 0.0))
+        self.emotion_scores = scores
+        self.positive_hours = data.get("positiveHours", 0.0)
+        self.negative_hours = data.get("negativeHours", 0.0)
+        self.neutral_hours = data.get("neutralHours", 0.0)
+        self.insights = data.get("insights", [])
+        self.emotion_changes = data.get("emotionChanges", [])
+
+    @classmethod
+    def decode(cls, data: Dict[str, Any]) -> "VibeGraphResult":
+        return cls(data)
@@ -0,0 +1,612 @@
+"""
+分析リクエストのスケジューリング層
+
+LLM呼び出しの前段で行う制御（重複リクエストの集約、優先度レーン、デバイス間の公平性、受付制御など）をまとめたモジュール。
+main.py の各エンドポイントから利用する。
+"""
+
+import asyncio
+import hashlib
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+from request_deadline import Deadline, current_deadline, shared_deadline, with_deadline
+
+# 優先度レーン（先頭ほど優先度が高い）
+LANES = ("interactive", "scheduled", "backfill")
+
+# 各レーンが使える同時実行数の割合（全体の同時実行数に対する比率）
+# 下位レーンに上限を設けることで、バックフィル中も対話的なリクエスト用の枠が常に残る
+DEFAULT_LANE_SHARES = {"interactive": 1.0, "scheduled": 0.75, "backfill": 0.5}
+
+# 待ち時間の統計に使う直近のサンプル数
+WAIT_SAMPLE_SIZE = 500
+
+# デバイスごとの統計: 待ち時間のサンプル数、保持するデバイス数、メトリクスに含めるデバイス数
+DEVICE_WAIT_SAMPLE_SIZE = 100
+DEVICE_STATS_LIMIT = 5000
+DEVICE_METRICS_LIMIT = 20
+
+# 受付制御: 所要時間のサンプルがない間に使う処理時間の推定値（秒）
+DEFAULT_PROCESSING_SECONDS = 30.0
+
+
+def prompt_hash(prompt: str) -> str:
+    """プロンプト本文のハッシュ（集約キー・ログ用の短縮形）を返す"""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+class _Flight:
+    """実行中の1件の処理（共有されるタスク・待機者数・待機者がいなくなっても完了させるか・処理本体の期限）"""
+
+    __slots__ = ("task", "waiters", "persist", "deadline")
+
+    def __init__(self, task: asyncio.Task, deadline: Optional[Deadline] = None):
+        self.task = task
+        self.waiters = 0
+        self.persist = False
+        self.deadline = deadline
+
+
+class SingleFlight:
+    """
+    同一キーの同時実行を1回に集約する（single-flight）
+
+    実行中の処理と同じキーで呼び出された場合は新たに処理を開始せず、
+    実行中のタスクの完了を待って同じ結果を返す。
+    処理本体は独立したタスクとして実行されるため、待機者の1人が
+    キャンセルされても他の待機者への結果共有は継続される。
+    persist=False の待機者だけが全員キャンセルされた場合は、処理本体もキャンセルする。
+    処理本体の期限は待機者のうち最も遅い期限（期限のない待機者がいれば期限なし）とし、
+    各待機者の期限はそれぞれの待機にのみ適用する。
+    """
+
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight] = {}
+        self.stats = {"executed": 0, "coalesced": 0, "abandoned": 0}
+
+    def inflight_count(self) -> int:
+        """実行中のキー数を返す"""
+        return len(self._flights)
+
+    async def run(
+        self,
+        key: Hashable,
+        func: Callable[[], Awaitable[Any]],
+        persist: bool = True
+    ) -> Tuple[Any, bool]:
+        """
+        キーが実行中でなければ func を実行し、実行中ならその結果を待つ
+
+        Args:
+            key: 集約キー（分析対象 + プロンプトハッシュ）
+            func: 実際の処理を行うコルーチン関数
+            persist: この待機者がキャンセルされても処理を完了させるか
+                （False の待機者だけが全員キャンセルされた場合は処理本体をキャンセルする）
+
+        Returns:
+            Tuple[Any, bool]: (処理結果, 実行中の処理に相乗りしたかどうか)
+        """
+        flight = self._flights.get(key)
+        coalesced = flight is not None
+
+        if flight is None:
+            # 最初の呼び出し元の期限で共有の処理が打ち切られないよう、処理本体は専用の期限で実行する
+            deadline = shared_deadline()
+            flight = _Flight(asyncio.ensure_future(with_deadline(func(), deadline)), deadline)
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda task, key=key: self._finish(key, task))
+            self.stats["executed"] += 1
+        else:
+            self.stats["coalesced"] += 1
+            if flight.deadline is not None:
+                flight.deadline.extend(current_deadline())
+
+        flight.waiters += 1
+        flight.persist = flight.persist or persist
+        try:
+            return await asyncio.shield(flight.task), coalesced
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.persist and not flight.task.done():
+                # 結果を待つ呼び出し元がいなくなった
+                self.stats["abandoned"] += 1
+                flight.task.cancel()
+
+    def _finish(self, key: Hashable, task: asyncio.Task) -> None:
+        """完了したタスクを登録から外す"""
+        flight = self._flights.get(key)
+        if flight is not None and flight.task is task:
+            del self._flights[key]
+        # 待機者が全員いなくなった場合でも例外を回収しておく
+        if not task.cancelled():
+            task.exception()
+
+
+class InflightTracker:
+    """
+    実行中の処理数を数える
+
+    シャットダウン時に実行中のLLM呼び出しが終わるのを待つ（graceful drain）ために使う。
+    """
+
+    def __init__(self):
+        self._count = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def count(self) -> int:
+        """実行中の処理数"""
+        return self._count
+
+    @asynccontextmanager
+    async def track(self):
+        """with ブロックの間、実行中として数える"""
+        self._count += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self._count -= 1
+            if self._count == 0:
+                self._idle.set()
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """
+        実行中の処理がなくなるまで待つ
+
+        Args:
+            timeout: 最大待機秒数
+
+        Returns:
+            bool: タイムアウト前に全て完了した場合True
+        """
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+def percentile(values: List[float], ratio: float) -> Optional[float]:
+    """値の分位点を返す（値がない場合はNone）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(ratio * len(ordered)) - 1))
+    return ordered[index]
+
+
+def parse_lane_shares(value: Optional[str]) -> Dict[str, float]:
+    """
+    "interactive=1.0,scheduled=0.75,backfill=0.5" 形式の設定を読み込む
+
+    未指定のレーンはデフォルト値を使う。
+    """
+    shares = dict(DEFAULT_LANE_SHARES)
+    if not value:
+        return shares
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        lane, share = item.split("=", 1)
+        lane = lane.strip()
+        if lane in shares:
+            shares[lane] = float(share)
+    return shares
+
+
+def parse_device_weights(value: Optional[str]) -> Dict[str, float]:
+    """
+    "device_id=2,device_id2=0.5" 形式のデバイスごとの重みを読み込む
+
+    未指定のデバイスの重みは1。
+    """
+    weights: Dict[str, float] = {}
+    if not value:
+        return weights
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        device_id, weight = item.split("=", 1)
+        if float(weight) > 0:
+            weights[device_id.strip()] = float(weight)
+    return weights
+
+
+class _Lane:
+    """1つの優先度レーンのデバイスごとの待ち行列と統計"""
+
+    __slots__ = ("name", "limit", "queues", "inflight", "started", "wait_samples")
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        # デバイスID → 待機中の処理（待機が始まった順）
+        self.queues: Dict[str, Deque[asyncio.Future]] = {}
+        self.inflight = 0
+        self.started = 0
+        self.wait_samples: Deque[float] = deque(maxlen=WAIT_SAMPLE_SIZE)
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+
+class _Device:
+    """1台のデバイスの実行数・仮想時間（重み付き公平キューイング用）と統計"""
+
+    __slots__ = ("weight", "inflight", "queued", "started", "virtual_time", "wait_samples", "last_active")
+
+    def __init__(self, weight: float):
+        self.weight = weight
+        self.inflight = 0
+        self.queued = 0
+        self.started = 0
+        self.virtual_time = 0.0
+        self.wait_samples: Deque[float] = deque(maxlen=DEVICE_WAIT_SAMPLE_SIZE)
+        self.last_active = time.monotonic()
+
+    @property
+    def idle(self) -> bool:
+        return self.inflight == 0 and self.queued == 0
+
+
+class PriorityScheduler:
+    """
+    優先度レーン付きの同時実行数制御（レーン内はデバイスごとの重み付き公平キューイング）
+
+    - 全体の同時実行数（capacity）を超えてLLMを呼び出さない
+    - 各レーンは capacity × 割合 までしか同時に実行できない
+    - 枠が空いた時は優先度の高いレーンの待ち行列から順に割り当てる
+      （対話的なリクエストは、待機中のバッチ処理より先に実行される）
+    - レーン内では、実行した回数 ÷ 重み（仮想時間）が最も小さいデバイスから割り当てる
+      （1台のデバイスが大量のリクエストを送っても、他のデバイスの待ち時間が伸びない）
+    - 1台のデバイスの同時実行数は device_limit まで。他のデバイスが待機していない場合に限り
+      device_burst 件まで超えて実行できる
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        lane_shares: Optional[Dict[str, float]] = None,
+        device_limit: Optional[int] = None,
+        device_burst: Optional[int] = None,
+        device_weights: Optional[Dict[str, float]] = None
+    ):
+        self.capacity = max(1, capacity)
+        shares = lane_shares or DEFAULT_LANE_SHARES
+        self._lanes: Dict[str, _Lane] = {
+            name: _Lane(name, max(1, min(self.capacity, int(self.capacity * shares.get(name, 1.0)))))
+            for name in LANES
+        }
+        self._inflight = 0
+        # 実行枠を保持していた時間（LLM呼び出しの所要時間）の直近のサンプル
+        self.service_samples: Deque[float] = deque(maxlen=WAIT_SAMPLE_SIZE)
+
+        # デバイスごとの上限（デフォルト: 全体の半分、他のデバイスが待機していなければ全体まで）
+        self.device_limit = max(1, device_limit if device_limit else self.capacity // 2)
+        self.device_burst = max(0, device_burst if device_burst is not None else self.capacity - self.device_limit)
+        self.device_weights = device_weights or {}
+        self._devices: Dict[str, _Device] = {}
+        self._virtual_time = 0.0
+
+    @property
+    def inflight(self) -> int:
+        """実行中の処理数（全レーン合計）"""
+        return self._inflight
+
+    @property
+    def queued(self) -> int:
+        """待機中の処理数（全レーン合計）"""
+        return sum(lane.queued for lane in self._lanes.values())
+
+    def validate_lane(self, lane: str) -> None:
+        """未知のレーン名の場合は ValueError"""
+        if lane not in self._lanes:
+            raise ValueError(f"未知の優先度: {lane}（{', '.join(LANES)} のいずれかを指定してください）")
+
+    def _device(self, device_id: str) -> _Device:
+        device = self._devices.get(device_id)
+        if device is None:
+            if len(self._devices) >= DEVICE_STATS_LIMIT:
+                self._prune_devices()
+            device = _Device(self.device_weights.get(device_id, 1.0))
+            self._devices[device_id] = device
+        if device.idle:
+            # 待機を再開したデバイスが、休んでいた間の分をまとめて使わないようにする
+            device.virtual_time = max(device.virtual_time, self._virtual_time)
+        device.last_active = time.monotonic()
+        return device
+
+    def _prune_devices(self) -> None:
+        """統計を保持するデバイス数が上限に達した場合、最も長く使われていないデバイスから削除する"""
+        idle = sorted(
+            (device.last_active, device_id) for device_id, device in self._devices.items() if device.idle
+        )
+        for _, device_id in idle[:max(1, len(idle) // 2)]:
+            del self._devices[device_id]
+
+    @asynccontextmanager
+    async def slot(self, lane: str, device_id: Optional[str] = None):
+        """
+        指定レーンの実行枠を確保し、with ブロックの間保持する
+
+        device_id を省略した場合は共通のデバイス（"-"）として扱う。
+
+        Yields:
+            float: 枠の確保までに待った秒数
+        """
+        self.validate_lane(lane)
+        state = self._lanes[lane]
+        key = device_id or "-"
+        device = self._device(key)
+        waiter = asyncio.get_running_loop().create_future()
+        state.queues.setdefault(key, deque()).append(waiter)
+        device.queued += 1
+        enqueued_at = time.monotonic()
+        self._dispatch()
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 枠を割り当てられた直後にキャンセルされた場合は返却する
+                self._release(state, device)
+            elif waiter in state.queues.get(key, ()):
+                state.queues[key].remove(waiter)
+                if not state.queues[key]:
+                    del state.queues[key]
+                device.queued -= 1
+            raise
+
+        started_at = time.monotonic()
+        waited = started_at - enqueued_at
+        state.wait_samples.append(waited)
+        device.wait_samples.append(waited)
+        try:
+            yield waited
+        finally:
+            self.service_samples.append(time.monotonic() - started_at)
+            self._release(state, device)
+
+    def lane_limit(self, lane: str) -> int:
+        """レーンの同時実行数の上限"""
+        return self._lanes[lane].limit
+
+    def ahead_of(self, lane: str) -> int:
+        """
+        指定レーンに新しく入る処理より先に実行枠を使う処理数
+
+        同じ・上位レーンの実行中と待機中に加え、下位レーンの実行中（枠を返すまで）を数える。
+        """
+        index = LANES.index(lane)
+        ahead = 0
+        for position, name in enumerate(LANES):
+            state = self._lanes[name]
+            ahead += state.inflight + (state.queued if position <= index else 0)
+        return ahead
+
+    def _next_device(self, state: _Lane) -> Optional[str]:
+        """
+        レーン内で次に実行するデバイス（上限内のデバイスのうち仮想時間が最小のもの）
+
+        上限に達したデバイスは、上限内で待機している他のデバイスがない場合に限りバースト枠まで実行できる。
+        """
+        waiting = {
+            device_id
+            for lane in self._lanes.values()
+            for device_id in lane.queues
+            if self._devices[device_id].inflight < self.device_limit
+        }
+        candidates = []
+        for device_id in state.queues:
+            inflight = self._devices[device_id].inflight
+            if inflight < self.device_limit or (
+                inflight < self.device_limit + self.device_burst and not waiting - {device_id}
+            ):
+                candidates.append(device_id)
+        if not candidates:
+            return None
+        return min(candidates, key=lambda device_id: self._devices[device_id].virtual_time)
+
+    def _dispatch(self) -> None:
+        """空いている枠を優先度の高いレーンから順に、レーン内ではデバイス間で公平に割り当てる"""
+        for name in LANES:
+            state = self._lanes[name]
+            while self._inflight < self.capacity and state.inflight < state.limit:
+                device_id = self._next_device(state)
+                if device_id is None:
+                    break
+                queue = state.queues[device_id]
+                waiter = queue.popleft()
+                if not queue:
+                    del state.queues[device_id]
+                device = self._devices[device_id]
+                device.queued -= 1
+                if waiter.done():
+                    continue
+                state.inflight += 1
+                state.started += 1
+                device.inflight += 1
+                device.started += 1
+                device.virtual_time += 1.0 / device.weight
+                self._virtual_time = device.virtual_time
+                self._inflight += 1
+                waiter.set_result(None)
+
+    def _release(self, state: _Lane, device: _Device) -> None:
+        state.inflight -= 1
+        device.inflight -= 1
+        device.last_active = time.monotonic()
+        self._inflight -= 1
+        self._dispatch()
+
+    def device_metrics(self, limit: int = DEVICE_METRICS_LIMIT) -> List[Dict[str, Any]]:
+        """デバイスごとの待機数・実行数・待ち時間（待機数・実行数が多い順に limit 件）"""
+        ordered = sorted(
+            self._devices.items(),
+            key=lambda item: (item[1].queued + item[1].inflight, item[1].last_active),
+            reverse=True
+        )
+        devices = []
+        for device_id, device in ordered[:limit]:
+            samples = list(device.wait_samples)
+            devices.append({
+                "device_id": device_id,
+                "weight": device.weight,
+                "inflight": device.inflight,
+                "queue_depth": device.queued,
+                "started": device.started,
+                "wait_ms_p50": _to_ms(percentile(samples, 0.5)),
+                "wait_ms_p95": _to_ms(percentile(samples, 0.95)),
+            })
+        return devices
+
+    def metrics(self) -> Dict[str, Any]:
+        """レーンごと・デバイスごとの待ち行列の長さ・実行数・待ち時間"""
+        lanes = {}
+        for name, state in self._lanes.items():
+            samples = list(state.wait_samples)
+            lanes[name] = {
+                "limit": state.limit,
+                "inflight": state.inflight,
+                "queue_depth": state.queued,
+                "queued_devices": len(state.queues),
+                "started": state.started,
+                "wait_ms_p50": _to_ms(percentile(samples, 0.5)),
+                "wait_ms_p95": _to_ms(percentile(samples, 0.95)),
+                "wait_ms_max": _to_ms(max(samples) if samples else None),
+            }
+        service = list(self.service_samples)
+        return {
+            "capacity": self.capacity,
+            "inflight": self._inflight,
+            "queue_depth": self.queued,
+            "service_ms_p50": _to_ms(percentile(service, 0.5)),
+            "service_ms_p95": _to_ms(percentile(service, 0.95)),
+            "device_limit": self.device_limit,
+            "device_burst": self.device_burst,
+            "lanes": lanes,
+            "devices": self.device_metrics(),
+        }
+
+
+class AdmissionRejected(Exception):
+    """期限内に完了できないと推定されたため受け付けなかった"""
+
+    def __init__(self, estimated_seconds: float, retry_after: int):
+        super().__init__(f"推定完了時間 {estimated_seconds:.1f}秒")
+        self.estimated_seconds = estimated_seconds
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """受け付けたリクエスト1件（完了時に AdmissionController.release に渡す）"""
+
+    __slots__ = ("endpoint", "lane", "estimated_seconds", "admitted_at")
+
+    def __init__(self, endpoint: str, lane: str, estimated_seconds: float):
+        self.endpoint = endpoint
+        self.lane = lane
+        self.estimated_seconds = estimated_seconds
+        self.admitted_at = time.monotonic()
+
+
+class AdmissionController:
+    """
+    受付制御（ロードシェディング）
+
+    リクエストの処理を始める前に完了までの時間を推定し、期限（プロキシのタイムアウト）内に
+    終わらない場合はプロンプト取得・LLM呼び出しを行わずに拒否する。
+
+    推定完了時間 = LLM実行枠の推定待ち時間 + 推定処理時間
+    - 推定待ち時間: 先に実行枠を使う処理数（受付済み・未完了のリクエストと、スケジューラの実行中・待機中の
+      多い方）をレーンの同時実行数で割り、直近のLLM呼び出し時間の中央値を掛けたもの
+    - 推定処理時間: エンドポイントごとの直近の所要時間（実行枠の待ち時間を除く）のp90
+
+    待ちが発生しない場合は、処理時間の推定値に関わらず受け付ける。
+    """
+
+    def __init__(self, scheduler: PriorityScheduler, deadline_seconds: float, enabled: bool = True):
+        self.scheduler = scheduler
+        self.deadline_seconds = deadline_seconds
+        self.enabled = enabled
+        self._admitted: Dict[str, int] = {name: 0 for name in LANES}
+        self._processing_samples: Dict[str, Deque[float]] = {}
+        self.stats = {"admitted": 0, "rejected": 0}
+
+    def _processing_seconds(self, endpoint: str) -> float:
+        samples = list(self._processing_samples.get(endpoint, ()))
+        if samples:
+            return percentile(samples, 0.9)
+        service = percentile(list(self.scheduler.service_samples), 0.9)
+        return service if service is not None else DEFAULT_PROCESSING_SECONDS
+
+    def estimate(self, endpoint: str, lane: str) -> Tuple[float, float]:
+        """(推定待ち時間, 推定処理時間) を秒で返す"""
+        index = LANES.index(lane)
+        admitted_ahead = sum(self._admitted[name] for name in LANES[:index + 1])
+        ahead = max(admitted_ahead, self.scheduler.ahead_of(lane))
+        parallelism = self.scheduler.lane_limit(lane)
+
+        service = percentile(list(self.scheduler.service_samples), 0.5)
+        if service is None:
+            service = DEFAULT_PROCESSING_SECONDS
+        waves = max(0, ahead + 1 - parallelism) / parallelism
+        return waves * service, self._processing_seconds(endpoint)
+
+    def admit(self, endpoint: str, lane: str, deadline_seconds: Optional[float] = None) -> AdmissionTicket:
+        """
+        リクエストを受け付ける
+
+        deadline_seconds（呼び出し元の期限までの残り秒数）が deadline_seconds より短い場合はそちらで判定する。
+
+        Raises:
+            AdmissionRejected: 期限内に完了できないと推定された場合
+        """
+        deadline = min(self.deadline_seconds, deadline_seconds) if deadline_seconds is not None else self.deadline_seconds
+        wait, processing = self.estimate(endpoint, lane)
+        estimated = wait + processing
+        if self.enabled and wait > 0 and estimated > deadline:
+            self.stats["rejected"] += 1
+            retry_after = max(1, math.ceil(estimated - deadline))
+            raise AdmissionRejected(estimated, retry_after)
+
+        self.stats["admitted"] += 1
+        self._admitted[lane] += 1
+        return AdmissionTicket(endpoint, lane, estimated)
+
+    def release(self, ticket: AdmissionTicket, queue_wait_seconds: Optional[float] = None) -> None:
+        """
+        受け付けたリクエストの完了
+
+        queue_wait_seconds（実行枠の待ち時間）を渡した場合、所要時間からそれを除いた時間を
+        エンドポイントの処理時間のサンプルとして記録する（エラー時は省略する）。
+        """
+        self._admitted[ticket.lane] -= 1
+        if queue_wait_seconds is not None:
+            elapsed = time.monotonic() - ticket.admitted_at
+            samples = self._processing_samples.setdefault(ticket.endpoint, deque(maxlen=WAIT_SAMPLE_SIZE))
+            samples.append(max(0.0, elapsed - queue_wait_seconds))
+
+    def metrics(self) -> Dict[str, Any]:
+        """受付・拒否数、受付済みのリクエスト数、エンドポイントごとの処理時間"""
+        return {
+            "enabled": self.enabled,
+            "deadline_seconds": self.deadline_seconds,
+            **self.stats,
+            "admitted_inflight": dict(self._admitted),
+            "processing_ms_p90": {
+                endpoint: _to_ms(percentile(list(samples), 0.9))
+                for endpoint, samples in self._processing_samples.items()
+            },
+        }
+
+
+def _to_ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 1) if seconds is not None else None
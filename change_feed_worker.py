@@ -0,0 +1,425 @@
+"""
+audio_aggregator の変更を取り込んでタイムブロック分析を行うワーカー
+
+外部のオーケストレーターが audio_aggregator をポーリングして /analyze-timeblock を呼ぶ代わりに、
+追加・更新された行をこのサービス自身が取り込み、同じ分析パイプラインで処理する。
+
+- CursorPollingSource: updated_at のカーソルで audio_aggregator を定期的に取得（カーソルはファイルに保存）
+- LocalChangeSource: プロセス内のキュー（テストや LISTEN/NOTIFY の代わり）
+- ChangeFeedWorker: (device_id, date, time_block) 単位で重複を除き、同時実行数を制限して分析する
+
+起動方法:
+- APIと同じプロセスで動かす: CHANGE_FEED_WORKER=true（コンテナ内で1ワーカーのみが取り込む）
+- 単独で動かす: python change_feed_worker.py
+- 過去分の取り込み（バックフィル）: CHANGE_FEED_START_FROM=2025-11-01T00:00:00+00:00 python change_feed_worker.py
+
+複数インスタンスで動かす場合は SHARDING=true にすると、device_id のシャード単位で分担する（sharding.py）。
+"""
+
+import asyncio
+import fcntl
+import json
+import os
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# 取り込み対象のテーブルとカーソルに使うカラム
+CHANGE_FEED_TABLE = "audio_aggregator"
+CHANGE_FEED_CURSOR_COLUMN = os.getenv("CHANGE_FEED_CURSOR_COLUMN", "updated_at")
+
+# ポーリング間隔（秒）と1回に取得する最大行数
+CHANGE_FEED_POLL_INTERVAL_SECONDS = float(os.getenv("CHANGE_FEED_POLL_INTERVAL_SECONDS", "5"))
+CHANGE_FEED_BATCH_SIZE = int(os.getenv("CHANGE_FEED_BATCH_SIZE", "100"))
+
+# 同時に分析するタイムブロック数（LLM呼び出し自体は優先度レーンの実行枠でも制限される）
+CHANGE_FEED_CONCURRENCY = int(os.getenv("CHANGE_FEED_CONCURRENCY", "4"))
+
+# カーソルの保存先と、同一コンテナ内で取り込みを1プロセスに限定するロックファイル
+CHANGE_FEED_STATE_DIR = os.getenv("CHANGE_FEED_STATE_DIR", os.path.join(tempfile.gettempdir(), "vibe-scorer-change-feed"))
+
+# カーソルが保存されていない場合に取り込みを始める時刻（未設定の場合は起動時点から。バックフィル用）
+CHANGE_FEED_START_FROM = os.getenv("CHANGE_FEED_START_FROM")
+
+# 処理済みプロンプトのハッシュを覚えておくキー数（同じ内容の再通知を読み飛ばす）
+PROCESSED_KEYS_SIZE = 10000
+
+ChangeKey = Tuple[str, str, str]
+
+
+def change_key(row: Dict[str, Any]) -> Optional[ChangeKey]:
+    """行から (device_id, date, time_block) を取り出す（欠けている場合はNone）"""
+    key = (row.get("device_id"), row.get("date"), row.get("time_block"))
+    return key if all(key) else None
+
+
+class ChangeSource(ABC):
+    """audio_aggregator の変更行の取得元"""
+
+    @abstractmethod
+    async def poll(self) -> List[Dict[str, Any]]:
+        """新しく追加・更新された行を返す（なければ次の変更を待つか空リストを返す）"""
+
+    async def commit(self, checkpoint: Optional[str] = None) -> None:
+        """
+        poll() で返した行の取り込みが済んだことを記録する
+
+        checkpoint: 処理待ち・処理中の行のうち最も古い更新時刻（ある場合はその位置までしか保存しない）
+        """
+
+    def rewind(self, cursor: str) -> None:
+        """指定した位置から取り込み直す（シャードを引き継いだ場合。対応しない取得元では何もしない）"""
+
+
+class LocalChangeSource(ChangeSource):
+    """プロセス内のキューを取得元にする（テスト用、または LISTEN/NOTIFY の受け口）"""
+
+    def __init__(self, wait_seconds: float = 1.0):
+        self.wait_seconds = wait_seconds
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    def publish(self, row: Dict[str, Any]) -> None:
+        """変更行を通知する"""
+        self._queue.put_nowait(row)
+
+    async def poll(self) -> List[Dict[str, Any]]:
+        try:
+            rows = [await asyncio.wait_for(self._queue.get(), self.wait_seconds)]
+        except asyncio.TimeoutError:
+            return []
+        while not self._queue.empty():
+            rows.append(self._queue.get_nowait())
+        return rows
+
+
+class CursorPollingSource(ChangeSource):
+    """
+    updated_at のカーソルで audio_aggregator を定期的に取得する
+
+    (updated_at, device_id, date, time_block) の順に並べ、前回取得した最後の行より後の行を取得する（キーセット）。
+    同じ時刻の行が batch_size 件以上あっても、同じ時刻の中で続きから取得できる。
+    カーソルはファイルに保存し、再起動後も続きから取り込む（処理が終わっていない行がある場合はその時刻から）。
+    """
+
+    def __init__(
+        self,
+        get_supabase_client: Callable[[], Any],
+        poll_interval: float = CHANGE_FEED_POLL_INTERVAL_SECONDS,
+        batch_size: int = CHANGE_FEED_BATCH_SIZE,
+        state_dir: str = CHANGE_FEED_STATE_DIR,
+        start_from: Optional[str] = CHANGE_FEED_START_FROM
+    ):
+        self._get_supabase_client = get_supabase_client
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self._cursor_path = os.path.join(state_dir, "cursor.json")
+        state = self._load_state()
+        # カーソルがなければ起動時点から取り込む（過去分はオーケストレーターやバッチで処理する）
+        self.cursor: str = state.get("cursor") or start_from or datetime.now(timezone.utc).isoformat()
+        # カーソル時刻で最後に取得した行のキー（None の場合はカーソル時刻の行を最初から取得する）
+        self._last_key: Optional[ChangeKey] = tuple(state["last_key"]) if state.get("last_key") else None
+        self._first_poll = True
+        self._rewound = False
+
+    def _load_state(self) -> Dict[str, Any]:
+        try:
+            with open(self._cursor_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _after_cursor(self) -> str:
+        """(cursor, last_key) より後の行を表す PostgREST の or 条件"""
+        column, cursor = CHANGE_FEED_CURSOR_COLUMN, _quote(self.cursor)
+        if self._last_key is None:
+            return f"{column}.gte.{cursor}"
+        device_id, date, time_block = (_quote(value) for value in self._last_key)
+        return ",".join([
+            f"{column}.gt.{cursor}",
+            f"and({column}.eq.{cursor},device_id.gt.{device_id})",
+            f"and({column}.eq.{cursor},device_id.eq.{device_id},date.gt.{date})",
+            f"and({column}.eq.{cursor},device_id.eq.{device_id},date.eq.{date},time_block.gt.{time_block})",
+        ])
+
+    async def poll(self) -> List[Dict[str, Any]]:
+        if not self._first_poll:
+            await asyncio.sleep(self.poll_interval)
+        self._first_poll = False
+        self._rewound = False
+
+        supabase = self._get_supabase_client()
+        after_cursor = self._after_cursor()
+        result = await asyncio.to_thread(
+            lambda: supabase.client.table(CHANGE_FEED_TABLE)
+            .select(f"device_id, date, time_block, vibe_aggregator_result, {CHANGE_FEED_CURSOR_COLUMN}")
+            .or_(after_cursor)
+            .order(CHANGE_FEED_CURSOR_COLUMN)
+            .order("device_id")
+            .order("date")
+            .order("time_block")
+            .limit(self.batch_size)
+            .execute()
+        )
+
+        rows = []
+        cursor, last_key = self.cursor, self._last_key
+        for row in result.data or []:
+            key = change_key(row)
+            changed_at = row.get(CHANGE_FEED_CURSOR_COLUMN)
+            if key is None or not changed_at:
+                continue
+            rows.append(row)
+            cursor, last_key = changed_at, key
+
+        # 次回はここから取得する（取得中に rewind() された場合は進めない）
+        if not self._rewound:
+            self.cursor, self._last_key = cursor, last_key
+        return rows
+
+    async def commit(self, checkpoint: Optional[str] = None) -> None:
+        """
+        取り込み済みの位置を保存する
+
+        処理待ち・処理中の行がある場合（checkpoint）は、再起動後にその行から取り込み直せるよう
+        その時刻の最初の行の位置を保存する。
+        """
+        if checkpoint is not None and checkpoint <= self.cursor:
+            state = {"cursor": checkpoint, "last_key": None}
+        else:
+            state = {"cursor": self.cursor, "last_key": list(self._last_key) if self._last_key else None}
+        os.makedirs(os.path.dirname(self._cursor_path), exist_ok=True)
+        tmp_path = self._cursor_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self._cursor_path)
+
+    def rewind(self, cursor: str) -> None:
+        if cursor and cursor < self.cursor:
+            print(f"⏪ 変更フィードのカーソルを戻します: {self.cursor} → {cursor}")
+            self.cursor = cursor
+            self._last_key = None
+            self._rewound = True
+
+
+class ChangeFeedWorker:
+    """
+    変更行を (device_id, date, time_block) 単位で重複を除いて分析する
+
+    - 同じキーが処理待ち・処理中の間に再度通知された場合は、最新の行で1回だけ処理し直す
+    - 前回処理したプロンプトと同じ内容の通知は読み飛ばす
+    - 同時に処理するキーの数は concurrency で制限する
+    - owns が False を返す行（他のインスタンスが担当するシャード）は処理しない
+    """
+
+    def __init__(
+        self,
+        source: ChangeSource,
+        handler: Callable[[Dict[str, Any]], Awaitable[Any]],
+        concurrency: int = CHANGE_FEED_CONCURRENCY,
+        fingerprint: Callable[[Dict[str, Any]], Optional[str]] = lambda row: None,
+        owns: Callable[[Dict[str, Any]], bool] = lambda row: True
+    ):
+        self.source = source
+        self.handler = handler
+        self.fingerprint = fingerprint
+        self.owns = owns
+        self.concurrency = max(1, concurrency)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._latest: Dict[ChangeKey, Dict[str, Any]] = {}
+        self._running: Dict[ChangeKey, asyncio.Task] = {}
+        self._processed: "OrderedDict[ChangeKey, str]" = OrderedDict()
+        # 処理中の行の更新時刻（チェックポイントの計算用）
+        self._processing: Dict[ChangeKey, Optional[str]] = {}
+        self._stopping = asyncio.Event()
+        self.stats = {
+            "received": 0,
+            "deduplicated": 0,
+            "skipped_unchanged": 0,
+            "skipped_other_shard": 0,
+            "processed": 0,
+            "failed": 0,
+            "last_lag_seconds": None,
+        }
+
+    def submit(self, row: Dict[str, Any]) -> None:
+        """変更行を1件受け付ける"""
+        key = change_key(row)
+        if key is None:
+            return
+        self.stats["received"] += 1
+        if not self.owns(row):
+            self.stats["skipped_other_shard"] += 1
+            return
+
+        digest = self.fingerprint(row)
+        if digest is not None and self._processed.get(key) == digest and key not in self._latest:
+            self.stats["skipped_unchanged"] += 1
+            return
+
+        if key in self._latest:
+            self.stats["deduplicated"] += 1
+        self._latest[key] = row
+        if key not in self._running:
+            self._running[key] = asyncio.create_task(self._drain(key))
+
+    async def _drain(self, key: ChangeKey) -> None:
+        """キーごとに最新の行がなくなるまで処理する（同じキーは同時に処理しない）"""
+        try:
+            while key in self._latest:
+                async with self._semaphore:
+                    row = self._latest.pop(key, None)
+                    if row is None:
+                        break
+                    digest = self.fingerprint(row)
+                    if digest is not None and self._processed.get(key) == digest:
+                        self.stats["skipped_unchanged"] += 1
+                        continue
+                    if not self.owns(row):
+                        # 処理待ちの間に担当シャードが他のインスタンスに移った
+                        self.stats["skipped_other_shard"] += 1
+                        continue
+                    self._processing[key] = row.get(CHANGE_FEED_CURSOR_COLUMN)
+                    try:
+                        await self._process(key, row, digest)
+                    finally:
+                        self._processing.pop(key, None)
+        finally:
+            self._running.pop(key, None)
+
+    async def _process(self, key: ChangeKey, row: Dict[str, Any], digest: Optional[str]) -> None:
+        try:
+            await self.handler(row)
+        except Exception as e:
+            self.stats["failed"] += 1
+            print(f"❌ 変更フィードの分析失敗: {key}: {e}")
+            return
+
+        self.stats["processed"] += 1
+        if digest is not None:
+            self._processed[key] = digest
+            self._processed.move_to_end(key)
+            while len(self._processed) > PROCESSED_KEYS_SIZE:
+                self._processed.popitem(last=False)
+
+        changed_at = row.get(CHANGE_FEED_CURSOR_COLUMN)
+        parsed = _parse_timestamp(changed_at)
+        if parsed is not None:
+            self.stats["last_lag_seconds"] = round(time.time() - parsed.timestamp(), 1)
+
+    def checkpoint(self) -> Optional[str]:
+        """
+        ここまでの変更は処理済みといえる位置（処理待ち・処理中の行のうち最も古い更新時刻、なければ取得元のカーソル）
+
+        シャードを他のインスタンスに渡す際にリースに保存する。
+        """
+        pending = [row.get(CHANGE_FEED_CURSOR_COLUMN) for row in self._latest.values()]
+        pending += list(self._processing.values())
+        pending = [changed_at for changed_at in pending if changed_at]
+        if pending:
+            return min(pending)
+        return getattr(self.source, "cursor", None)
+
+    def rewind(self, cursor: Optional[str]) -> None:
+        """引き継いだシャードのチェックポイントから取り込み直す"""
+        if cursor:
+            self.source.rewind(cursor)
+
+    @property
+    def pending(self) -> int:
+        """処理待ち・処理中のキー数"""
+        return len(self._running)
+
+    async def run(self) -> None:
+        """stop() が呼ばれるまで変更行を取り込み続ける"""
+        print(f"🛰️ 変更フィードワーカー開始（同時実行数 {self.concurrency}）")
+        while not self._stopping.is_set():
+            try:
+                rows = await self.source.poll()
+                for row in rows:
+                    self.submit(row)
+                # 処理が終わっていない行があれば、その位置までしか保存しない（再起動後に取り込み直す）
+                await self.source.commit(self.checkpoint() if self._latest or self._processing else None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ 変更フィードの取得失敗: {e}")
+                await asyncio.sleep(CHANGE_FEED_POLL_INTERVAL_SECONDS)
+
+    async def stop(self, timeout: Optional[float] = None) -> bool:
+        """取り込みを止め、処理中の分析の完了を待つ（timeout内に完了した場合True）"""
+        self._stopping.set()
+        tasks = list(self._running.values())
+        if not tasks:
+            return True
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        return not pending
+
+    def metrics(self) -> Dict[str, Any]:
+        return {**self.stats, "pending_keys": self.pending}
+
+
+def _quote(value: Any) -> str:
+    """PostgREST の or 条件に埋め込む値（: や , を含む時刻をそのまま渡せるよう二重引用符で囲む）"""
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _parse_timestamp(value: Any) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def try_acquire_worker_lock(state_dir: str = CHANGE_FEED_STATE_DIR) -> Optional[Any]:
+    """
+    同一コンテナ内で変更フィードを取り込むプロセスを1つに限定するロックを取得する
+
+    取得できた場合はロックファイルを返す（プロセス終了まで開いたままにする）。
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    lock_file = open(os.path.join(state_dir, "worker.lock"), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    return lock_file
+
+
+async def _run_standalone() -> None:
+    """APIサーバーなしでワーカーだけを動かす"""
+    from main import (
+        create_change_feed_worker, create_shard_coordinator, run_change_feed,
+        llm_calls, close_current_llm, LLM_DRAIN_TIMEOUT_SECONDS
+    )
+
+    lock = try_acquire_worker_lock()
+    if lock is None:
+        print("⚠️ 別のプロセスが変更フィードを取り込んでいるため終了します")
+        return
+
+    coordinator = create_shard_coordinator()
+    worker = create_change_feed_worker(coordinator=coordinator)
+    try:
+        await run_change_feed(worker, coordinator)
+    finally:
+        await worker.stop(timeout=LLM_DRAIN_TIMEOUT_SECONDS)
+        if coordinator is not None:
+            await coordinator.stop()
+        await llm_calls.wait_idle(LLM_DRAIN_TIMEOUT_SECONDS)
+        close_current_llm()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(_run_standalone())
+    except KeyboardInterrupt:
+        print("🛑 変更フィードワーカーを停止しました")
@@ -0,0 +1,162 @@
+"""
+Dashboard Summaryの差分更新
+
+audio_scorer のスコアから再計算した48スロットのスコアを、dashboard_summary に保存済みの vibe_scores と比べて
+変化したタイムブロックを検出し、数値項目（vibe_scores・average_vibe・burst_events）はローカルで再計算する。
+LLMによる総合評価（cumulative_evaluation）は、前回生成時からの変化が閾値を超えた場合のみ再生成する。
+
+前回の総合評価を生成した時点のスコアは dashboard_summary.incremental_state カラムに保存する
+（アプリが参照する analysis_result には含めない）。
+"""
+
+import math
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from analysis_results import SLOTS_PER_DAY
+
+# 連続するスコアの変化がこの値以上の場合をバーストイベントとする
+BURST_SCORE_CHANGE_THRESHOLD = float(os.getenv("BURST_SCORE_CHANGE_THRESHOLD", "30"))
+
+# 総合評価を再生成する条件（前回生成時からの変化）
+# - 追加・変更されたタイムブロック数がこの値以上
+# - 平均スコアの変化がこの値以上
+# - 新しいバーストイベントが検出された
+DASHBOARD_NARRATIVE_MIN_CHANGED_BLOCKS = int(os.getenv("DASHBOARD_NARRATIVE_MIN_CHANGED_BLOCKS", "4"))
+DASHBOARD_NARRATIVE_MIN_AVERAGE_SHIFT = float(os.getenv("DASHBOARD_NARRATIVE_MIN_AVERAGE_SHIFT", "10"))
+
+
+def time_block_index(time_block: str) -> Optional[int]:
+    """"HH-MM" 形式のタイムブロックをスロット番号（0〜47）に変換（不正な形式はNone）"""
+    try:
+        hour, minute = (int(part) for part in time_block.split("-", 1))
+    except (AttributeError, ValueError):
+        return None
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        return None
+    return hour * 2 + (1 if minute >= 30 else 0)
+
+
+def slot_time(index: int) -> str:
+    """スロット番号を "HH:MM" に変換"""
+    return f"{index // 2:02d}:{30 if index % 2 else 0:02d}"
+
+
+def _valid_score(value: Any) -> Optional[float]:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if math.isnan(value) or math.isinf(value):
+        return None
+    return float(value)
+
+
+def build_vibe_scores(rows: List[Dict[str, Any]]) -> List[Optional[float]]:
+    """audio_scorerの行から48スロットのスコア配列を作成（未分析のスロットはNone）"""
+    scores: List[Optional[float]] = [None] * SLOTS_PER_DAY
+    for row in rows:
+        index = time_block_index(row.get("time_block"))
+        if index is not None:
+            scores[index] = _valid_score(row.get("vibe_score"))
+    return scores
+
+
+def average_score(scores: List[Optional[float]]) -> Optional[float]:
+    """分析済みスロットの平均スコア（小数第1位まで）"""
+    values = [score for score in scores if score is not None]
+    return round(sum(values) / len(values), 1) if values else None
+
+
+def detect_burst_events(
+    scores: List[Optional[float]],
+    previous_events: Optional[List[Dict[str, Any]]] = None,
+    threshold: float = BURST_SCORE_CHANGE_THRESHOLD
+) -> List[Dict[str, Any]]:
+    """
+    分析済みスロット間のスコアの急変をバーストイベントとして検出する
+
+    同じ時刻のイベントが前回の結果にあれば、その説明文（event）を引き継ぐ。
+    """
+    previous_text = {
+        event.get("time"): event.get("event")
+        for event in previous_events or []
+        if isinstance(event, dict)
+    }
+    events = []
+    last_index = None
+    for index, score in enumerate(scores):
+        if score is None:
+            continue
+        if last_index is not None:
+            change = score - scores[last_index]
+            if abs(change) >= threshold:
+                time = slot_time(index)
+                events.append({
+                    "time": time,
+                    "event": previous_text.get(time) or ("気分の急上昇" if change > 0 else "気分の急下降"),
+                    "score_change": round(change, 1),
+                    "from_score": scores[last_index],
+                    "to_score": score
+                })
+        last_index = index
+    return events
+
+
+def stored_vibe_scores(value: Any) -> Optional[List[Optional[float]]]:
+    """保存済みの vibe_scores を48スロットのスコア配列に揃える（配列でない場合はNone）"""
+    if not isinstance(value, list):
+        return None
+    scores = [_valid_score(score) for score in value[:SLOTS_PER_DAY]]
+    return scores + [None] * (SLOTS_PER_DAY - len(scores))
+
+
+def changed_time_blocks(scores: List[Optional[float]], stored_scores: List[Optional[float]]) -> List[str]:
+    """再計算したスコアが保存済みのスコアと異なるタイムブロック（"HH-MM" 形式）"""
+    return [
+        slot_time(index).replace(":", "-")
+        for index, (before, after) in enumerate(zip(stored_scores, scores))
+        if before != after
+    ]
+
+
+def narrative_change(
+    basis_scores: List[Optional[float]],
+    scores: List[Optional[float]],
+    basis_events: List[Dict[str, Any]],
+    events: List[Dict[str, Any]]
+) -> Dict[str, Any]:
+    """総合評価を生成した時点のスコアからの変化量と、再生成が必要かどうか"""
+    changed_slots = sum(1 for before, after in zip(basis_scores, scores) if before != after)
+    basis_average = average_score(basis_scores)
+    current_average = average_score(scores)
+    average_shift = (
+        abs(current_average - basis_average)
+        if basis_average is not None and current_average is not None
+        else (0.0 if basis_average == current_average else math.inf)
+    )
+    new_bursts = sorted({event["time"] for event in events} - {event.get("time") for event in basis_events})
+
+    reasons = []
+    if changed_slots >= DASHBOARD_NARRATIVE_MIN_CHANGED_BLOCKS:
+        reasons.append(f"changed_blocks>={DASHBOARD_NARRATIVE_MIN_CHANGED_BLOCKS}")
+    if average_shift >= DASHBOARD_NARRATIVE_MIN_AVERAGE_SHIFT:
+        reasons.append(f"average_shift>={DASHBOARD_NARRATIVE_MIN_AVERAGE_SHIFT}")
+    if new_bursts:
+        reasons.append("new_burst_events")
+
+    return {
+        "changed_slots": changed_slots,
+        "average_shift": None if math.isinf(average_shift) else round(average_shift, 1),
+        "new_burst_events": new_bursts,
+        "significant": bool(reasons),
+        "reasons": reasons
+    }
+
+
+def build_incremental_state(scores: List[Optional[float]], events: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """総合評価を生成した時点のスコア（次回の差分判定の基準）"""
+    return {
+        "basis_scores": scores,
+        "basis_burst_events": events,
+        "narrative_generated_at": datetime.now().isoformat()
+    }
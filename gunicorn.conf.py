@@ -0,0 +1,42 @@
+"""
+本番環境用 gunicorn 設定（uvicornワーカーによるマルチワーカー構成）
+
+起動: gunicorn -c gunicorn.conf.py main:app
+"""
+
+import importlib
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8002')}"
+
+# ワーカー数: 指定がなければCPUコア数に合わせる
+# LLM呼び出しはI/O待ちが中心のため、各ワーカーのイベントループで並行処理する
+workers = int(os.getenv("WEB_CONCURRENCY") or multiprocessing.cpu_count())
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# アプリをマスタープロセスで読み込み、fork後のワーカーでメモリを共有する
+# （Supabase・LLMクライアントはfork後に各ワーカーのlifespanで作成される）
+preload_app = True
+
+# SIGTERM受信後、実行中のリクエストの完了を待つ最大秒数
+# nginxのタイムアウト（180秒）に合わせる
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "180"))
+timeout = int(os.getenv("WORKER_TIMEOUT", "120"))
+keepalive = 5
+
+loglevel = os.getenv("LOG_LEVEL", "info")
+accesslog = "-"
+errorlog = "-"
+
+# マスターで事前に読み込んでおく重いモジュール（LLMプロバイダーは遅延インポートのため）
+PRELOAD_MODULES = ["groq", "openai"]
+
+
+def on_starting(server):
+    """マスタープロセス起動時に重いSDKを読み込む"""
+    for module_name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module_name)
+        except ImportError:
+            server.log.warning(f"preload skipped: {module_name} is not installed")
@@ -0,0 +1,61 @@
+"""
+バックグラウンドジョブの記録
+
+バッチ処理など、レスポンスを返した後も続く処理の状態をJSONファイルに保存する。
+マルチワーカー構成でも、どのワーカーからでも同じジョブの状態を参照できる。
+"""
+
+import json
+import os
+import tempfile
+import threading
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+# ジョブ記録の保存先（同一コンテナ内の全ワーカーで共有）
+JOB_STORE_DIR = os.getenv("JOB_STORE_DIR", os.path.join(tempfile.gettempdir(), "vibe-scorer-jobs"))
+
+
+class JobStore:
+    """ジョブ記録をジョブIDごとのJSONファイルとして保存する"""
+
+    def __init__(self, directory: str = JOB_STORE_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def create(self, kind: str, **fields: Any) -> Dict[str, Any]:
+        """新しいジョブ記録を作成する"""
+        job = {
+            "job_id": f"{kind}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}",
+            "kind": kind,
+            "status": "queued",
+            "created_at": datetime.now().isoformat(),
+            "updated_at": datetime.now().isoformat(),
+            **fields
+        }
+        self.save(job)
+        return job
+
+    def save(self, job: Dict[str, Any]) -> None:
+        """ジョブ記録を保存する（一時ファイル経由で置き換え、読み込み側が途中状態を見ないようにする）"""
+        job["updated_at"] = datetime.now().isoformat()
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(job, f, ensure_ascii=False, default=str)
+            os.replace(tmp_path, self._path(job["job_id"]))
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """ジョブ記録を取得する（存在しない場合はNone）"""
+        if os.path.basename(job_id) != job_id:
+            return None
+        try:
+            with open(self._path(job_id), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,231 @@
+"""
+非推奨エンドポイント（現在使用していません）
+
+/analyze/chatgpt と /analyze-vibegraph-supabase をまとめたルーター。
+起動時間を短くするため、main.py はパスのみを登録し、このモジュールは最初のリクエスト時に読み込む。
+"""
+
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+
+from analysis_results import VibeGraphResult, score_value
+from response_shaping import render_response
+
+
+class PromptRequest(BaseModel):
+    prompt: str
+
+class VibeGraphRequest(BaseModel):
+    device_id: str
+    date: Optional[str] = None
+
+
+def validate_emotion_scores(data: Dict[str, Any]) -> Tuple[VibeGraphResult, Dict[str, Any]]:
+    """emotionScoresの構造をバリデーションし、必要に応じて補完する（48個に満たない場合は nan で補完、平均は再計算）"""
+    result = VibeGraphResult.decode(data)
+    return result, result.validation_info
+
+
+def create_legacy_router(
+    get_supabase_client: Callable[[], Any],
+    call_llm_with_retry: Callable[..., Awaitable[Dict[str, Any]]]
+) -> APIRouter:
+    """
+    非推奨エンドポイントのルーターを作成
+
+    Args:
+        get_supabase_client: Supabaseクライアントの取得関数（main.py）
+        call_llm_with_retry: LLM呼び出し関数（main.py）
+
+    Returns:
+        APIRouter: 非推奨エンドポイントを登録したルーター
+    """
+    router = APIRouter()
+
+    @router.post("/analyze/chatgpt")
+    async def relay_to_chatgpt(request: PromptRequest):
+        """
+        ⚠️ このエンドポイントは現在使用していません
+
+        プロンプトをChatGPT APIに中継し、応答をJSON形式（dict）で返します。
+        改善されたJSON抽出処理とNaN対応を含みます。
+        """
+        try:
+            # LLM呼び出し（JSON抽出・NaN値の処理を含む）
+            return await call_llm_with_retry(request.prompt)
+
+        except Exception as e:
+            import traceback
+            error_details = {
+                "error_type": type(e).__name__,
+                "error_message": str(e),
+                "traceback": traceback.format_exc().split('\n')[-5:]
+            }
+            print(f"❌ ERROR in relay_to_chatgpt: {error_details}")
+
+            raise HTTPException(
+                status_code=500, 
+                detail={
+                    "message": "ChatGPT APIでエラーが発生しました",
+                    "error_details": error_details
+                }
+            )
+
+    @router.post("/analyze-vibegraph-supabase")
+    async def analyze_vibegraph_supabase(
+        request: VibeGraphRequest,
+        fields: Optional[str] = None,
+        verbose: bool = True
+    ):
+        """
+        ⚠️ このエンドポイントは現在使用していません
+
+        Supabase統合版の心理グラフ(VibeGraph)処理
+        vibe_whisper_promptテーブルからプロンプトを取得し、処理後にvibe_whisper_summaryテーブルに保存
+
+        verbose=false の場合、summary・processing_log（vibe_scores・insightsの重複分）を省略
+        """
+        try:
+            device_id = request.device_id
+
+            # 日付パラメータは必須
+            if not request.date:
+                raise HTTPException(
+                    status_code=400,
+                    detail="date parameter is required"
+                )
+
+            search_date = request.date  # 検索用の日付
+
+            processing_log = {
+                "start_time": datetime.now().isoformat(),
+                "mode": "supabase",
+                "processing_steps": [],
+                "complete": False,
+                "warnings": [],
+                "search_date": search_date
+            }
+
+            # Supabaseクライアントの取得
+            supabase = get_supabase_client()
+
+            # 1) vibe_whisper_promptテーブルからプロンプト取得
+            prompt_data = await supabase.get_vibe_whisper_prompt(device_id, search_date)
+            if prompt_data is None:
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"プロンプトが見つかりません: device_id={device_id}, date={search_date}"
+                )
+            processing_log["processing_steps"].append("vibe_whisper_promptからプロンプト取得完了")
+
+            if "prompt" not in prompt_data:
+                raise HTTPException(
+                    status_code=400, 
+                    detail="プロンプトデータに'prompt'フィールドが見つかりません"
+                )
+
+            # 実際のデータの日付を取得（prompt_dataの日付を優先）
+            actual_date = prompt_data.get('date', search_date)
+            if actual_date != search_date:
+                processing_log["warnings"].append(f"検索日付({search_date})と実データ日付({actual_date})が異なります")
+                processing_log["actual_date"] = actual_date
+
+            # 2) LLM処理（リトライ付き）
+            # emotionScoresが欠けている・48個に満たない場合は、該当項目のみ修復してから補完する
+            analysis_result = await call_llm_with_retry(prompt_data["prompt"], processing_log, schema="vibegraph")
+            processing_log["processing_steps"].append("LLM処理完了")
+
+            # 3) 構造バリデーション
+            validated, validation_info = validate_emotion_scores(analysis_result)
+            processing_log["validation_info"] = validation_info
+            processing_log["processing_steps"].append("構造バリデーション完了")
+
+            # 警告の追加
+            if validation_info.get("score_length_warning", False):
+                processing_log["warnings"].append(f"emotionScores不足: {validation_info['missing_scores_filled']}個のスコアをNaNで補完")
+
+            if validation_info.get("nan_scores_detected", 0) > 0:
+                processing_log["warnings"].append(f"{validation_info['nan_scores_detected']}個のNaN値を検出")
+
+            # 4) データを整形してvibe_whisper_summaryテーブルに保存
+            # emotionScoresをvibe_scoresに変換（キー名の変更）
+            vibe_scores = validated.emotion_scores.to_list()
+            average_score = score_value(validated.average_score)
+
+            save_success = await supabase.save_to_vibe_whisper_summary(
+                device_id=device_id,
+                target_date=actual_date,
+                vibe_scores=vibe_scores,
+                average_score=average_score,
+                positive_hours=validated.positive_hours,
+                negative_hours=validated.negative_hours,
+                neutral_hours=validated.neutral_hours,
+                insights=validated.insights,
+                vibe_changes=validated.emotion_changes,
+                processing_log=processing_log
+            )
+
+            if save_success:
+                processing_log["processing_steps"].append("vibe_whisper_summaryテーブルに保存完了")
+                final_status = "success"
+            else:
+                processing_log["processing_steps"].append("vibe_whisper_summaryテーブルへの保存失敗")
+                processing_log["warnings"].append("データベースへの保存に失敗しました")
+                final_status = "failed"
+
+            processing_log["complete"] = True
+            processing_log["end_time"] = datetime.now().isoformat()
+
+            return render_response({
+                "status": final_status,
+                "message": "Supabase統合心理グラフ(VibeGraph)処理が完了しました" if final_status == "success" else "処理中にエラーが発生しました",
+                "device_id": device_id,
+                "date": actual_date,
+                "search_date": search_date,
+                "database_save": save_success,
+                "processed_at": datetime.now().isoformat(),
+                "processing_log": processing_log,
+                "validation_summary": {
+                    "total_warnings": len(processing_log["warnings"]),
+                    "structure_valid": not validation_info.get("score_length_warning", False),
+                    "nan_handling": "completed" if validation_info.get("nan_scores_detected", 0) > 0 else "not_required"
+                },
+                "summary": {
+                    "vibe_scores": vibe_scores,
+                    "average_score": average_score,
+                    "positive_hours": validated.positive_hours,
+                    "negative_hours": validated.negative_hours,
+                    "neutral_hours": validated.neutral_hours,
+                    "insights": validated.insights,
+                    "vibe_changes": validated.emotion_changes
+                }
+            }, fields, verbose)
+
+        except HTTPException:
+            raise
+        except Exception as e:
+            import traceback
+            error_details = {
+                "error_type": type(e).__name__,
+                "error_message": str(e),
+                "traceback": traceback.format_exc().split('\n')[-5:],  # 最後の5行のみ
+                "device_id": device_id,
+                "search_date": search_date,
+                "processing_step": processing_log.get("processing_steps", [])[-1] if processing_log.get("processing_steps") else "初期化前"
+            }
+
+            # エラーログを出力
+            print(f"❌ ERROR in analyze_vibegraph_supabase: {error_details}")
+
+            raise HTTPException(
+                status_code=500, 
+                detail={
+                    "message": "Supabase統合心理グラフ(VibeGraph)処理中にエラーが発生しました",
+                    "error_details": error_details
+                }
+            )
+
+    return router
@@ -6,9 +6,20 @@ LLMプロバイダー抽象化レイヤー
 """
 
 from abc import ABC, abstractmethod
-from typing import Optional
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+import asyncio
+import io
+import json
 import os
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+import threading
+import time
+import uuid
+from tenacity import (
+    retry, stop_after_attempt, wait_exponential, retry_if_exception_type, retry_if_not_exception_type
+)
+
+from request_deadline import CallAbandoned, call_abandoned, call_timeout
 
 # ==========================================
 # 🔧 現在使用中のLLMプロバイダー設定
@@ -21,29 +32,535 @@ CURRENT_REASONING_EFFORT = "medium"  # "low", "medium", "high"
 CURRENT_MAX_COMPLETION_TOKENS = 8192
 # ==========================================
 
+# ==========================================
+# ⚡ 段階的スコアリング用の高速モデル（タイムブロック分析の一次判定）
+# ==========================================
+# 高速モデルの結果が妥当な場合はそのまま採用し、そうでない場合のみ上記の推論モデルで分析する
+FAST_PROVIDER = "groq"
+FAST_MODEL = "llama-3.1-8b-instant"
+FAST_MAX_COMPLETION_TOKENS = 1024
+# ==========================================
+
+# ==========================================
+# 🎛️ 生成設定ポリシー（推論の深さ・最大出力トークン数をリクエストごとに選択）
+# ==========================================
+REASONING_EFFORTS = ("low", "medium", "high")
+# エンドポイントごとの推論の深さ: (プロンプトの最大文字数, 推論の深さ) の先頭から最初に該当するもの（Noneは上限なし）
+GENERATION_EFFORT_RULES = {
+    "timeblock": [(3000, "low"), (None, "medium")],
+    "timeblock_packed": [(None, "medium")],
+    "dashboard_summary": [(None, "medium")],
+}
+# 出力スキーマごとの出力トークン数の目安（1件あたり。まとめ分析はブロック数倍）
+OUTPUT_TOKEN_ESTIMATES = {
+    "timeblock": 512,
+    "timeblock_packed": 512,
+    "dashboard_summary": 3072,
+}
+# 推論の深さごとの思考トークンの予算
+REASONING_TOKEN_BUDGETS = {"low": 1024, "medium": 4096, "high": 12288}
+# 入力が大きいほど思考が長くなるため、入力トークン（文字数から概算）の一定割合を加算
+PROMPT_CHARS_PER_TOKEN = 2
+PROMPT_TOKEN_ALLOWANCE_RATIO = 0.25
+# 最大出力トークン数の下限・上限
+MIN_COMPLETION_TOKENS = 2048
+MAX_COMPLETION_TOKENS_CAP = 32768
+# ==========================================
+
+# ==========================================
+# ✂️ 出力の途中切れ（最大出力トークン数に到達）の続き生成
+# ==========================================
+# 途中で切れたJSONは最初から生成し直さず、途中までの出力に続けて残りだけを生成させてつなぐ
+MAX_CONTINUATIONS = 2
+# 続きの生成は思考を短くし、出力の残り分だけのトークン数にする
+CONTINUATION_REASONING_EFFORT = "low"
+CONTINUATION_MAX_COMPLETION_TOKENS = 4096
+CONTINUATION_INSTRUCTION = (
+    "直前のあなたの出力は最大出力トークン数に達して途中で切れています。"
+    "切れた位置の直後から、続きの部分だけを出力してください。"
+    "最初から出力し直したり、説明やコードブロックの記号を付け加えたりしないでください。"
+)
+# 続きの先頭が途中までの出力の末尾と重複している場合に取り除く最大文字数
+CONTINUATION_OVERLAP_CHARS = 200
+# 思考だけで最大出力トークン数に達し出力が空の場合（続きを生成できない）は、
+# 最大出力トークン数を増やし推論の深さを1段階下げて最初から生成し直す
+EMPTY_OUTPUT_RETRIES = 1
+EMPTY_OUTPUT_TOKEN_MULTIPLIER = 2
+# ==========================================
+
+# ==========================================
+# 🗂️ プロンプトキャッシュ（固定の指示部分をsystemメッセージとして分離）
+# ==========================================
+# 共通部分として分離する最小文字数（ベンダーのプロンプトキャッシュは約1024トークン以上が対象）
+PROMPT_PREFIX_MIN_CHARS = 1024
+# 共通部分の学習に使う直近のプロンプト数・保持する共通部分の数
+PROMPT_PREFIX_RECENT_SIZE = 8
+PROMPT_PREFIX_MAX_KNOWN = 16
+
+
+class StructuredPrompt:
+    """
+    固定の指示部分（instructions）と可変のデータ部分（data）に分けたプロンプト
+
+    instructions はsystemメッセージとして送信され、ベンダー側のプロンプトキャッシュの対象になる。
+    instructions + data は元のプロンプト全体と一致する。
+    """
+
+    __slots__ = ("instructions", "data")
+
+    def __init__(self, instructions: str, data: str):
+        self.instructions = instructions
+        self.data = data
+
+    def to_text(self) -> str:
+        """元のプロンプト全体を返す"""
+        return self.instructions + self.data
+
+    def __len__(self) -> int:
+        return len(self.instructions) + len(self.data)
+
+
+PromptInput = Union[str, StructuredPrompt]
+
+
+def prompt_text(prompt: PromptInput) -> str:
+    """プロンプト全体を文字列で返す"""
+    return prompt.to_text() if isinstance(prompt, StructuredPrompt) else prompt
+
+
+def build_messages(prompt: PromptInput, partial: Optional[str] = None) -> List[Dict[str, str]]:
+    """
+    プロンプトをchat.completions用のメッセージに変換（指示部分はsystemメッセージ）
+
+    partial（途中で切れた出力）を指定した場合は、それをassistantの応答として続け、続きの生成を指示する。
+    """
+    if isinstance(prompt, StructuredPrompt) and prompt.instructions:
+        messages = [
+            {"role": "system", "content": prompt.instructions},
+            {"role": "user", "content": prompt.data}
+        ]
+    else:
+        messages = [{"role": "user", "content": prompt_text(prompt)}]
+    if partial is not None:
+        messages += [
+            {"role": "assistant", "content": partial},
+            {"role": "user", "content": CONTINUATION_INSTRUCTION}
+        ]
+    return messages
+
+
+def common_prefix_at_line(texts: List[str], min_chars: int = PROMPT_PREFIX_MIN_CHARS) -> str:
+    """
+    全テキストに共通する先頭部分を行の区切りで切って返す（min_chars 未満の場合は空文字）
+    """
+    if len(texts) < 2:
+        return ""
+    prefix = os.path.commonprefix(texts)
+    cut = prefix.rfind("\n")
+    prefix = prefix[:cut + 1] if cut >= 0 else ""
+    return prefix if len(prefix) >= min_chars else ""
+
+
+def split_shared_prefix(prompts: List[str], min_chars: int = PROMPT_PREFIX_MIN_CHARS) -> List[PromptInput]:
+    """
+    バッチ内のプロンプトに共通する先頭部分を検出し、StructuredPrompt に分割する
+
+    共通部分が min_chars 未満の場合は元の文字列のまま返す。
+    """
+    prefix = common_prefix_at_line(prompts, min_chars)
+    if not prefix:
+        return list(prompts)
+    return [StructuredPrompt(prefix, prompt[len(prefix):]) for prompt in prompts]
+
+
+class PromptPrefixRegistry:
+    """
+    直近のプロンプトから共通の指示部分を学習し、新しいプロンプトを分割する
+
+    同じ指示文に観測データを連結したプロンプト（vibe_aggregator_result など）が繰り返し届くと、
+    2件目以降から指示部分がsystemメッセージとして分離され、ベンダー側でキャッシュされる。
+    """
+
+    def __init__(
+        self,
+        min_chars: int = PROMPT_PREFIX_MIN_CHARS,
+        recent_size: int = PROMPT_PREFIX_RECENT_SIZE,
+        max_known: int = PROMPT_PREFIX_MAX_KNOWN
+    ):
+        self.min_chars = min_chars
+        self.max_known = max_known
+        self._recent = deque(maxlen=recent_size)
+        self._known: List[str] = []
+        self._lock = threading.Lock()
+
+    def structure(self, prompt: PromptInput) -> PromptInput:
+        """既知の共通部分で始まるプロンプトを分割する（該当しない場合は学習のみ行う）"""
+        if isinstance(prompt, StructuredPrompt):
+            return prompt
+        with self._lock:
+            for prefix in self._known:
+                if prompt.startswith(prefix) and len(prompt) > len(prefix):
+                    return StructuredPrompt(prefix, prompt[len(prefix):])
+
+            for recent in self._recent:
+                prefix = common_prefix_at_line([recent, prompt], self.min_chars)
+                if prefix and len(prompt) > len(prefix):
+                    self._known.insert(0, prefix)
+                    del self._known[self.max_known:]
+                    return StructuredPrompt(prefix, prompt[len(prefix):])
+
+            self._recent.append(prompt)
+        return prompt
+
+    def known_prefixes(self) -> List[Dict[str, Any]]:
+        """学習済みの共通部分（長さのみ）"""
+        with self._lock:
+            return [{"chars": len(prefix)} for prefix in self._known]
+
+
+def extract_usage(response: Any) -> Dict[str, Any]:
+    """chat.completions の応答からトークン使用量（キャッシュ分を含む）と終了理由を取り出す"""
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details is not None else None
+    choices = getattr(response, "choices", None) or []
+    return {
+        "prompt_tokens": getattr(usage, "prompt_tokens", None),
+        "completion_tokens": getattr(usage, "completion_tokens", None),
+        "cached_tokens": cached or 0,
+        "finish_reason": getattr(choices[0], "finish_reason", None) if choices else None
+    }
+
+
+def json_incomplete(text: str) -> bool:
+    """
+    最初の { または [ から始まるJSONの括弧が閉じていないか（文字列の途中で終わっている場合を含む）
+
+    JSONを含まない応答はFalse。
+    """
+    starts = [index for index in (text.find("{"), text.find("[")) if index >= 0]
+    if not starts:
+        return False
+    stack = []
+    in_string = escaped = False
+    for char in text[min(starts):]:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append(char)
+        elif char in "}]":
+            if not stack:
+                return False
+            stack.pop()
+            if not stack:
+                return False
+    return True
+
+
+def is_truncated(text: Optional[str], usage: Dict[str, Any]) -> bool:
+    """
+    出力が途中で切れているか（finish_reason=length、またはJSONの括弧が閉じていない）
+
+    思考だけで最大出力トークン数に達した場合は、出力が空でも finish_reason=length なので切れているとみなす。
+    """
+    if usage.get("finish_reason") == "length":
+        return True
+    return bool(text) and json_incomplete(text)
+
+
+def stitch_continuation(partial: str, continuation: str) -> str:
+    """途中までの出力に続きをつなぐ（続きの先頭のコードブロック記号と、末尾との重複は取り除く）"""
+    tail = continuation.lstrip("\n")
+    if tail.startswith("```"):
+        tail = tail.split("\n", 1)[1] if "\n" in tail else ""
+    # 偶然の一致を避けるため、8文字以上の重複のみ取り除く
+    for size in range(min(len(tail), len(partial), CONTINUATION_OVERLAP_CHARS), 7, -1):
+        if partial.endswith(tail[:size]):
+            tail = tail[size:]
+            break
+    return partial + tail
+
+
+class ContinuationStats:
+    """途中で切れた出力の続き生成の件数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.truncated = 0
+        self.continuations = 0
+        self.completed = 0
+        self.incomplete = 0
+        self.empty_output_retries = 0
+
+    def record_empty_output_retry(self) -> None:
+        with self._lock:
+            self.empty_output_retries += 1
+
+    def record(self, continuations: int, completed: bool) -> None:
+        with self._lock:
+            self.truncated += 1
+            self.continuations += continuations
+            if completed:
+                self.completed += 1
+            else:
+                self.incomplete += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "truncated": self.truncated,
+                "continuations": self.continuations,
+                "completed": self.completed,
+                "incomplete": self.incomplete,
+                "empty_output_retries": self.empty_output_retries
+            }
+
+
+class PromptCacheStats:
+    """プロンプトキャッシュの効果（キャッシュされた入力トークン数）の累計"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.structured_calls = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def record(self, structured: bool, usage: Dict[str, Any]) -> None:
+        with self._lock:
+            self.calls += 1
+            self.structured_calls += int(structured)
+            self.prompt_tokens += usage.get("prompt_tokens") or 0
+            self.cached_tokens += usage.get("cached_tokens") or 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "structured_calls": self.structured_calls,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+                "cached_ratio": round(self.cached_tokens / self.prompt_tokens, 3) if self.prompt_tokens else None
+            }
+
+
+# プロセス全体で共有するプロンプトキャッシュの学習結果と統計
+prompt_prefix_registry = PromptPrefixRegistry()
+prompt_cache_stats = PromptCacheStats()
+continuation_stats = ContinuationStats()
+
+
+class GenerationSettings:
+    """1回のLLM呼び出しに適用する生成設定（Noneの項目はプロバイダーのデフォルトを使用）"""
+
+    __slots__ = ("reasoning_effort", "max_completion_tokens", "reason")
+
+    def __init__(
+        self,
+        reasoning_effort: Optional[str] = None,
+        max_completion_tokens: Optional[int] = None,
+        reason: str = ""
+    ):
+        self.reasoning_effort = reasoning_effort
+        self.max_completion_tokens = max_completion_tokens
+        self.reason = reason
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "reasoning_effort": self.reasoning_effort,
+            "max_completion_tokens": self.max_completion_tokens,
+            "reason": self.reason
+        }
+
+
+class GenerationPolicy:
+    """
+    エンドポイント・プロンプトの大きさ・出力スキーマから生成設定を選ぶ
+
+    - 推論の深さ: GENERATION_EFFORT_RULES（エンドポイントとプロンプトの文字数）
+    - 最大出力トークン数: 出力の目安（× 件数）+ 推論の深さごとの思考予算 + 入力の大きさに応じた加算
+    - 環境変数 GENERATION_POLICY（JSON）でエンドポイントごとに固定値を指定できる
+      例: {"timeblock": {"reasoning_effort": "low", "max_completion_tokens": 2048}}
+    - リクエストごとの指定（overrides）が最優先
+    """
+
+    def __init__(self, fixed: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.fixed = fixed or {}
+
+    @classmethod
+    def from_env(cls) -> "GenerationPolicy":
+        raw = os.getenv("GENERATION_POLICY")
+        if not raw:
+            return cls()
+        try:
+            fixed = json.loads(raw)
+            for endpoint, settings in fixed.items():
+                validate_generation_overrides(settings)
+        except (ValueError, AttributeError) as e:
+            print(f"⚠️ GENERATION_POLICY を無視します（形式が不正です）: {e}")
+            return cls()
+        return cls(fixed)
+
+    def select(
+        self,
+        endpoint: str,
+        prompt_chars: int,
+        expected_items: int = 1,
+        overrides: Optional[Dict[str, Any]] = None
+    ) -> GenerationSettings:
+        """
+        生成設定を選ぶ
+
+        Args:
+            endpoint: "timeblock", "timeblock_packed", "dashboard_summary" など
+            prompt_chars: プロンプトの文字数
+            expected_items: 出力する結果の件数（まとめ分析のブロック数）
+            overrides: リクエストごとの指定（reasoning_effort, max_completion_tokens）
+        """
+        if endpoint not in GENERATION_EFFORT_RULES and endpoint not in self.fixed:
+            return GenerationSettings(CURRENT_REASONING_EFFORT, CURRENT_MAX_COMPLETION_TOKENS, "default")
+
+        effort = CURRENT_REASONING_EFFORT
+        reasons = [endpoint]
+        for max_chars, rule_effort in GENERATION_EFFORT_RULES.get(endpoint, []):
+            if max_chars is None or prompt_chars <= max_chars:
+                effort = rule_effort
+                reasons.append(f"prompt<={max_chars}" if max_chars else "prompt_any")
+                break
+
+        output_tokens = OUTPUT_TOKEN_ESTIMATES.get(endpoint, CURRENT_MAX_COMPLETION_TOKENS // 2) * max(1, expected_items)
+        max_tokens = self._max_tokens(effort, output_tokens, prompt_chars)
+
+        fixed = self.fixed.get(endpoint, {})
+        if fixed:
+            effort = fixed.get("reasoning_effort", effort)
+            max_tokens = fixed.get("max_completion_tokens", max_tokens)
+            reasons.append("env")
+        if overrides:
+            effort = overrides.get("reasoning_effort") or effort
+            max_tokens = overrides.get("max_completion_tokens") or max_tokens
+            reasons.append("request")
+
+        return GenerationSettings(effort, max_tokens, ",".join(reasons))
+
+    @staticmethod
+    def _max_tokens(effort: str, output_tokens: int, prompt_chars: int) -> int:
+        prompt_tokens = prompt_chars / PROMPT_CHARS_PER_TOKEN
+        budget = output_tokens + REASONING_TOKEN_BUDGETS.get(effort, 0) + int(prompt_tokens * PROMPT_TOKEN_ALLOWANCE_RATIO)
+        return max(MIN_COMPLETION_TOKENS, min(budget, MAX_COMPLETION_TOKENS_CAP))
+
+
+def validate_generation_overrides(overrides: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    生成設定の指定を検証する
+
+    Raises:
+        ValueError: 推論の深さ・最大出力トークン数が不正な場合
+    """
+    effort = overrides.get("reasoning_effort")
+    if effort is not None and effort not in REASONING_EFFORTS:
+        raise ValueError(f"reasoning_effortは {', '.join(REASONING_EFFORTS)} のいずれかを指定してください")
+    max_tokens = overrides.get("max_completion_tokens")
+    if max_tokens is not None and (not isinstance(max_tokens, int) or not 1 <= max_tokens <= MAX_COMPLETION_TOKENS_CAP):
+        raise ValueError(f"max_completion_tokensは 1〜{MAX_COMPLETION_TOKENS_CAP} の整数を指定してください")
+    return overrides
+
+
+# プロセス全体で共有する生成設定ポリシー
+generation_policy = GenerationPolicy.from_env()
+
+
+# ==========================================
+# ⏱️ 呼び出し元の期限・キャンセル（request_deadline.py）
+# ==========================================
+# リトライの最小待機秒数（期限までの残りがこれより短い場合はリトライしない）
+RETRY_MIN_WAIT_SECONDS = 4
+
+
+def stop_when_abandoned(retry_state: Any) -> bool:
+    """呼び出し元がキャンセルされた・期限までにリトライできない場合はリトライしない"""
+    remaining = call_timeout()
+    return call_abandoned() or (remaining is not None and remaining < RETRY_MIN_WAIT_SECONDS)
+
+
+def request_options() -> Dict[str, Any]:
+    """
+    1回のAPI呼び出しのオプション（期限がある場合は残り時間をタイムアウトにする）
+
+    Raises:
+        CallAbandoned: 呼び出し元がキャンセルされた・期限を過ぎた場合（リトライしない）
+    """
+    if call_abandoned():
+        raise CallAbandoned("呼び出し元のキャンセル・期限切れのためLLMを呼び出しません")
+    timeout = call_timeout()
+    return {"timeout": timeout} if timeout is not None else {}
+
 
 class LLMProvider(ABC):
     """LLMプロバイダーの抽象基底クラス"""
 
     @abstractmethod
-    def generate(self, prompt: str) -> str:
+    def generate(self, prompt: PromptInput) -> str:
         """
         プロンプトを受け取り、LLMの応答を返す
 
         Args:
-            prompt (str): 入力プロンプト
+            prompt (str | StructuredPrompt): 入力プロンプト
+                StructuredPrompt の場合、指示部分はsystemメッセージとして送信される
 
         Returns:
             str: LLMの応答テキスト
         """
         pass
 
+    def generate_with_usage(
+        self,
+        prompt: PromptInput,
+        settings: Optional[GenerationSettings] = None,
+        partial: Optional[str] = None
+    ) -> Tuple[str, Dict[str, Any]]:
+        """
+        LLMの応答とトークン使用量を返す
+
+        Args:
+            prompt: 入力プロンプト
+            settings: 推論の深さ・最大出力トークン数（省略時はプロバイダーのデフォルト）
+            partial: 途中で切れた前回の出力（指定した場合は続きの部分だけを返す）
+
+        Returns:
+            Tuple[str, Dict]: (応答テキスト, 使用量 {prompt_tokens, completion_tokens, cached_tokens, finish_reason})
+        """
+        return self.generate(prompt), {}
+
     @property
     @abstractmethod
     def model_name(self) -> str:
         """使用中のモデル名を返す（プロバイダー名を含む）"""
         pass
 
+    def build_request_body(
+        self,
+        prompt: PromptInput,
+        settings: Optional[GenerationSettings] = None,
+        partial: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        chat.completions.create に渡すリクエストボディを作成する
+        （バッチAPIのJSONL1行分の body としても使用）
+        """
+        raise NotImplementedError(f"{type(self).__name__} はバッチAPIに対応していません")
+
+    def create_batch_backend(self) -> "BatchBackend":
+        """このプロバイダーのバッチAPIバックエンドを返す"""
+        raise NotImplementedError(f"{type(self).__name__} はバッチAPIに対応していません")
+
 
 class OpenAIProvider(LLMProvider):
     """OpenAI APIプロバイダー"""
@@ -64,23 +581,54 @@ class OpenAIProvider(LLMProvider):
         self._model = model
 
     @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=4, max=10),
-        retry=retry_if_exception_type(Exception)
+        stop=stop_after_attempt(3) | stop_when_abandoned,
+        wait=wait_exponential(multiplier=1, min=RETRY_MIN_WAIT_SECONDS, max=10),
+        retry=retry_if_exception_type(Exception) & retry_if_not_exception_type(CallAbandoned)
     )
-    def generate(self, prompt: str) -> str:
+    def generate_with_usage(
+        self,
+        prompt: PromptInput,
+        settings: Optional[GenerationSettings] = None,
+        partial: Optional[str] = None
+    ) -> Tuple[str, Dict[str, Any]]:
         """OpenAI APIを呼び出してテキスト生成（リトライ付き）"""
         try:
             response = self.client.chat.completions.create(
-                model=self._model,
-                messages=[{"role": "user", "content": prompt}]
+                **self.build_request_body(prompt, settings, partial), **request_options()
             )
-            return response.choices[0].message.content
+            usage = extract_usage(response)
+            prompt_cache_stats.record(isinstance(prompt, StructuredPrompt), usage)
+            # 出力が空の場合（思考だけで上限に達した場合など）content は None になる
+            return response.choices[0].message.content or "", usage
 
         except Exception as e:
             print(f"❌ OpenAI API呼び出しエラー: {e}")
             raise
 
+    def generate(self, prompt: PromptInput) -> str:
+        return self.generate_with_usage(prompt)[0]
+
+    def build_request_body(
+        self,
+        prompt: PromptInput,
+        settings: Optional[GenerationSettings] = None,
+        partial: Optional[str] = None
+    ) -> Dict[str, Any]:
+        params = {
+            "model": self._model,
+            "messages": build_messages(prompt, partial)
+        }
+        if settings is not None:
+            if settings.max_completion_tokens:
+                params["max_completion_tokens"] = settings.max_completion_tokens
+            # 推論モデル（o系・gpt-5系）のみ reasoning_effort を指定できる
+            if settings.reasoning_effort and self._model.startswith(("o", "gpt-5")):
+                params["reasoning_effort"] = settings.reasoning_effort
+        return params
+
+    def create_batch_backend(self) -> "BatchBackend":
+        return OpenAICompatibleBatchBackend(self.client)
+
     @property
     def model_name(self) -> str:
         return f"openai/{self._model}"
@@ -115,38 +663,408 @@ class GroqProvider(LLMProvider):
         self._max_completion_tokens = max_completion_tokens
 
     @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=4, max=10),
-        retry=retry_if_exception_type(Exception)
+        stop=stop_after_attempt(3) | stop_when_abandoned,
+        wait=wait_exponential(multiplier=1, min=RETRY_MIN_WAIT_SECONDS, max=10),
+        retry=retry_if_exception_type(Exception) & retry_if_not_exception_type(CallAbandoned)
     )
-    def generate(self, prompt: str) -> str:
+    def generate_with_usage(
+        self,
+        prompt: PromptInput,
+        settings: Optional[GenerationSettings] = None,
+        partial: Optional[str] = None
+    ) -> Tuple[str, Dict[str, Any]]:
         """Groq APIを呼び出してテキスト生成（リトライ付き）"""
         try:
-            # 基本パラメータ
-            params = {
-                "model": self._model,
-                "messages": [{"role": "user", "content": prompt}],
-                "max_completion_tokens": self._max_completion_tokens,
-                "temperature": 1,
-                "top_p": 1
-            }
-
-            # 推論モデル用のパラメータを追加（openai/で始まるモデルの場合）
-            if self._model.startswith("openai/") and self._reasoning_effort:
-                params["reasoning_effort"] = self._reasoning_effort
-
-            response = self.client.chat.completions.create(**params)
-            return response.choices[0].message.content
+            response = self.client.chat.completions.create(
+                **self.build_request_body(prompt, settings, partial), **request_options()
+            )
+            usage = extract_usage(response)
+            prompt_cache_stats.record(isinstance(prompt, StructuredPrompt), usage)
+            # 出力が空の場合（思考だけで上限に達した場合など）content は None になる
+            return response.choices[0].message.content or "", usage
 
         except Exception as e:
             print(f"❌ Groq API呼び出しエラー: {e}")
             raise
 
+    def generate(self, prompt: PromptInput) -> str:
+        return self.generate_with_usage(prompt)[0]
+
+    def build_request_body(
+        self,
+        prompt: PromptInput,
+        settings: Optional[GenerationSettings] = None,
+        partial: Optional[str] = None
+    ) -> Dict[str, Any]:
+        # 生成設定の指定があれば優先する
+        max_completion_tokens = (settings and settings.max_completion_tokens) or self._max_completion_tokens
+        reasoning_effort = (settings and settings.reasoning_effort) or self._reasoning_effort
+
+        # 基本パラメータ
+        params = {
+            "model": self._model,
+            "messages": build_messages(prompt, partial),
+            "max_completion_tokens": max_completion_tokens,
+            "temperature": 1,
+            "top_p": 1
+        }
+
+        # 推論モデル用のパラメータを追加（openai/で始まるモデルの場合）
+        if self._model.startswith("openai/") and reasoning_effort:
+            params["reasoning_effort"] = reasoning_effort
+
+        return params
+
+    def create_batch_backend(self) -> "BatchBackend":
+        # GroqのバッチAPIはOpenAI互換
+        return OpenAICompatibleBatchBackend(self.client)
+
     @property
     def model_name(self) -> str:
         return f"groq/{self._model}"
 
 
+def expanded_settings(settings: Optional[GenerationSettings]) -> GenerationSettings:
+    """出力が空のまま上限に達した場合の再生成の設定（最大出力トークン数を増やし、推論の深さを1段階下げる）"""
+    effort = settings.reasoning_effort if settings and settings.reasoning_effort else CURRENT_REASONING_EFFORT
+    lower_effort = REASONING_EFFORTS[max(0, REASONING_EFFORTS.index(effort) - 1)] if effort in REASONING_EFFORTS else "low"
+    budget = settings.max_completion_tokens if settings and settings.max_completion_tokens else CURRENT_MAX_COMPLETION_TOKENS
+    return GenerationSettings(
+        lower_effort, min(budget * EMPTY_OUTPUT_TOKEN_MULTIPLIER, MAX_COMPLETION_TOKENS_CAP), "empty_output_retry"
+    )
+
+
+def _add_usage(usage: Dict[str, Any], extra: Dict[str, Any]) -> None:
+    """追加の呼び出しの使用量を合算する（finish_reason は最後の呼び出しのもの）"""
+    for key in ("prompt_tokens", "completion_tokens", "cached_tokens"):
+        if extra.get(key) is not None:
+            usage[key] = (usage.get(key) or 0) + extra[key]
+    usage["finish_reason"] = extra.get("finish_reason")
+
+
+def generate_complete(
+    llm: LLMProvider,
+    prompt: PromptInput,
+    settings: Optional[GenerationSettings] = None
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    LLMの応答を返す（途中で切れた場合は続きを生成してつなぐ）
+
+    finish_reason=length、またはJSONの括弧が閉じていない場合に、途中までの出力をassistantの応答として渡し、
+    続きだけを短い設定（CONTINUATION_*）で最大 MAX_CONTINUATIONS 回生成させる。最初から生成し直すより
+    出力トークンが少なく済む。使用量は合算し、usage["continuations"] に続きの生成回数を記録する。
+
+    思考だけで上限に達し出力が空の場合は続きを生成できないため、最大出力トークン数を増やし推論の深さを
+    下げて最初から生成し直す（EMPTY_OUTPUT_RETRIES 回まで、usage["empty_output_retries"] に記録）。
+    """
+    text, usage = llm.generate_with_usage(prompt, settings=settings)
+    text = text or ""
+    if not is_truncated(text, usage):
+        return text, usage
+
+    usage = dict(usage)
+    retries = 0
+    while not text and retries < EMPTY_OUTPUT_RETRIES and is_truncated(text, usage) and not call_abandoned():
+        retries += 1
+        settings = expanded_settings(settings)
+        print(
+            f"✂️ 思考だけで出力トークンの上限に達しました（出力なし）。"
+            f"上限 {settings.max_completion_tokens}・推論の深さ {settings.reasoning_effort} で生成し直します"
+        )
+        continuation_stats.record_empty_output_retry()
+        text, retry_usage = llm.generate_with_usage(prompt, settings=settings)
+        text = text or ""
+        _add_usage(usage, retry_usage)
+    if retries:
+        usage["empty_output_retries"] = retries
+    if not text:
+        continuation_stats.record(0, False)
+        print("⚠️ 生成し直しても出力が空でした")
+        return text, usage
+
+    continuation_settings = GenerationSettings(
+        CONTINUATION_REASONING_EFFORT, CONTINUATION_MAX_COMPLETION_TOKENS, "continuation"
+    )
+    continuations = 0
+    while continuations < MAX_CONTINUATIONS and is_truncated(text, usage) and not call_abandoned():
+        continuations += 1
+        print(f"✂️ 出力が途中で切れています（{len(text)}文字）。続きを生成します（{continuations}回目）")
+        tail, tail_usage = llm.generate_with_usage(prompt, settings=continuation_settings, partial=text)
+        text = stitch_continuation(text, tail or "")
+        _add_usage(usage, tail_usage)
+
+    completed = not is_truncated(text, usage)
+    usage["continuations"] = continuations
+    continuation_stats.record(continuations, completed)
+    if not completed:
+        print(f"⚠️ {continuations}回続きを生成しても出力が完結しませんでした")
+    return text, usage
+
+
+# ==========================================
+# 📦 バッチAPI（夜間のDashboard Summaryや再処理など、即時性が不要な処理用）
+# ==========================================
+# ポーリング間隔と最大待機時間（ベンダーの完了期限は24時間）
+BATCH_POLL_INTERVAL_SECONDS = 60
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_MAX_WAIT_SECONDS = 24 * 60 * 60
+
+# バッチジョブの終了状態
+BATCH_TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchBackend(ABC):
+    """
+    ベンダーのバッチAPIの抽象基底クラス
+
+    JSONLのアップロード → ジョブ作成 → 状態のポーリング → 結果ファイルのダウンロード
+    """
+
+    @abstractmethod
+    def submit(self, jsonl: str) -> str:
+        """JSONLをアップロードしてバッチジョブを作成し、ジョブIDを返す"""
+        pass
+
+    @abstractmethod
+    def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        """ジョブの状態を返す（status, output_file_id, error_file_id）"""
+        pass
+
+    @abstractmethod
+    def download(self, file_id: str) -> str:
+        """結果ファイル（JSONL）の内容を返す"""
+        pass
+
+
+class OpenAICompatibleBatchBackend(BatchBackend):
+    """OpenAI互換のバッチAPI（OpenAI・Groq共通）"""
+
+    def __init__(self, client: Any):
+        self.client = client
+
+    def submit(self, jsonl: str) -> str:
+        input_file = self.client.files.create(
+            file=("batch_input.jsonl", io.BytesIO(jsonl.encode("utf-8"))),
+            purpose="batch"
+        )
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=BATCH_COMPLETION_WINDOW
+        )
+        return batch.id
+
+    def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        batch = self.client.batches.retrieve(batch_id)
+        return {
+            "status": batch.status,
+            "output_file_id": getattr(batch, "output_file_id", None),
+            "error_file_id": getattr(batch, "error_file_id", None)
+        }
+
+    def download(self, file_id: str) -> str:
+        content = self.client.files.content(file_id)
+        return content.text if hasattr(content, "text") else content.read().decode("utf-8")
+
+
+class LocalBatchStub(BatchBackend):
+    """
+    テスト用のローカルバッチAPI（ベンダーの代わり）
+
+    responder にリクエストボディを渡して応答テキストを作成し、
+    ベンダーと同じ形式の結果JSONLを返す。responder が例外を送出した行はエラー行になる。
+    """
+
+    def __init__(self, responder: Callable[[Dict[str, Any]], str], polls_until_complete: int = 1):
+        self.responder = responder
+        self.polls_until_complete = polls_until_complete
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._files: Dict[str, str] = {}
+
+    def submit(self, jsonl: str) -> str:
+        batch_id = f"batch_local_{uuid.uuid4().hex[:12]}"
+        self._jobs[batch_id] = {"input": jsonl, "polls": 0, "output_file_id": None, "error_file_id": None}
+        return batch_id
+
+    def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        job = self._jobs[batch_id]
+        job["polls"] += 1
+        if job["polls"] < self.polls_until_complete:
+            return {"status": "in_progress", "output_file_id": None, "error_file_id": None}
+
+        if job["output_file_id"] is None:
+            outputs, errors = [], []
+            for line in job["input"].splitlines():
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                try:
+                    content = self.responder(request["body"])
+                    outputs.append({
+                        "id": f"batch_req_{uuid.uuid4().hex[:12]}",
+                        "custom_id": request["custom_id"],
+                        "response": {
+                            "status_code": 200,
+                            "body": {"choices": [{"message": {"role": "assistant", "content": content}}]}
+                        },
+                        "error": None
+                    })
+                except Exception as e:
+                    errors.append({
+                        "id": f"batch_req_{uuid.uuid4().hex[:12]}",
+                        "custom_id": request["custom_id"],
+                        "response": None,
+                        "error": {"message": str(e)}
+                    })
+            job["output_file_id"] = self._store(outputs)
+            job["error_file_id"] = self._store(errors) if errors else None
+
+        return {"status": "completed", "output_file_id": job["output_file_id"], "error_file_id": job["error_file_id"]}
+
+    def download(self, file_id: str) -> str:
+        return self._files[file_id]
+
+    def _store(self, rows: List[Dict[str, Any]]) -> str:
+        file_id = f"file_local_{uuid.uuid4().hex[:12]}"
+        self._files[file_id] = "\n".join(json.dumps(row, ensure_ascii=False) for row in rows)
+        return file_id
+
+
+def build_batch_jsonl(provider: LLMProvider, prompts: List[Tuple[str, str]]) -> str:
+    """
+    (custom_id, prompt) のリストからバッチAPI用のJSONLを作成
+
+    バッチ内のプロンプトに共通する指示部分は自動的にsystemメッセージとして分離する
+    （ベンダー側のプロンプトキャッシュが効くようにする）。
+
+    Args:
+        provider: リクエストボディを作成するプロバイダー
+        prompts: (custom_id, prompt) のリスト
+
+    Returns:
+        str: JSONL文字列
+    """
+    structured = split_shared_prefix([prompt for _, prompt in prompts])
+    lines = []
+    for (custom_id, _), prompt in zip(prompts, structured):
+        lines.append(json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": provider.build_request_body(prompt)
+        }, ensure_ascii=False))
+    return "\n".join(lines)
+
+
+def parse_batch_output(jsonl: str) -> Dict[str, Dict[str, Any]]:
+    """
+    バッチ結果JSONLを custom_id ごとの結果に変換
+
+    Returns:
+        Dict[str, Dict]: custom_id → {"content": 応答テキスト} または {"error": エラー内容}
+    """
+    results: Dict[str, Dict[str, Any]] = {}
+    for line in jsonl.splitlines():
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        custom_id = row.get("custom_id")
+        response = row.get("response") or {}
+        if row.get("error") or response.get("status_code") != 200:
+            results[custom_id] = {"error": row.get("error") or response.get("body")}
+            continue
+        try:
+            results[custom_id] = {"content": response["body"]["choices"][0]["message"]["content"]}
+        except (KeyError, IndexError, TypeError) as e:
+            results[custom_id] = {"error": f"応答形式が不正です: {e}"}
+    return results
+
+
+def run_batch_job(
+    backend: BatchBackend,
+    jsonl: str,
+    poll_interval: float = BATCH_POLL_INTERVAL_SECONDS,
+    max_wait: float = BATCH_MAX_WAIT_SECONDS,
+    on_submitted: Optional[Callable[[str], None]] = None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    バッチジョブを投入し、完了まで待って結果を返す（呼び出しスレッドをブロックする）
+
+    Args:
+        backend: バッチAPIバックエンド
+        jsonl: build_batch_jsonl で作成したJSONL
+        poll_interval: 状態確認の間隔（秒）
+        max_wait: 最大待機時間（秒）
+        on_submitted: ジョブ作成直後にジョブIDを受け取るコールバック
+
+    Returns:
+        Dict[str, Dict]: custom_id → 結果（parse_batch_output 参照）
+
+    Raises:
+        RuntimeError: ジョブが完了以外の状態で終了した場合
+        TimeoutError: max_wait 以内に終了しなかった場合
+    """
+    batch_id = backend.submit(jsonl)
+    print(f"📦 バッチジョブ投入: {batch_id}")
+    if on_submitted:
+        on_submitted(batch_id)
+
+    deadline = time.monotonic() + max_wait
+    while True:
+        state = backend.retrieve(batch_id)
+        if state["status"] in BATCH_TERMINAL_STATUSES:
+            break
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"バッチジョブが{max_wait}秒以内に完了しませんでした: {batch_id}")
+        time.sleep(poll_interval)
+
+    return collect_batch_results(backend, batch_id, state)
+
+
+async def run_batch_job_async(
+    backend: BatchBackend,
+    jsonl: str,
+    poll_interval: float = BATCH_POLL_INTERVAL_SECONDS,
+    max_wait: float = BATCH_MAX_WAIT_SECONDS,
+    on_submitted: Optional[Callable[[str], None]] = None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    run_batch_job のasyncio版（APIサーバー内で使う）
+
+    待機は asyncio.sleep で行い、投入・状態確認・ダウンロードの各呼び出しだけをスレッドで実行する
+    （完了まで最大24時間、スレッドを占有しない）。
+    """
+    batch_id = await asyncio.to_thread(backend.submit, jsonl)
+    print(f"📦 バッチジョブ投入: {batch_id}")
+    if on_submitted:
+        on_submitted(batch_id)
+
+    deadline = time.monotonic() + max_wait
+    while True:
+        state = await asyncio.to_thread(backend.retrieve, batch_id)
+        if state["status"] in BATCH_TERMINAL_STATUSES:
+            break
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"バッチジョブが{max_wait}秒以内に完了しませんでした: {batch_id}")
+        await asyncio.sleep(poll_interval)
+
+    return await asyncio.to_thread(collect_batch_results, backend, batch_id, state)
+
+
+def collect_batch_results(backend: BatchBackend, batch_id: str, state: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """終了したバッチジョブの出力・エラーファイルを取得して結果を返す"""
+    if state["status"] != "completed":
+        raise RuntimeError(f"バッチジョブが失敗しました: {batch_id} (status={state['status']})")
+
+    results: Dict[str, Dict[str, Any]] = {}
+    if state.get("output_file_id"):
+        results.update(parse_batch_output(backend.download(state["output_file_id"])))
+    if state.get("error_file_id"):
+        results.update(parse_batch_output(backend.download(state["error_file_id"])))
+    print(f"✅ バッチジョブ完了: {batch_id} ({len(results)}件)")
+    return results
+
+
 class LLMFactory:
     """LLMプロバイダーのファクトリークラス"""
 
@@ -205,7 +1123,79 @@ class LLMFactory:
             return LLMFactory.create(CURRENT_PROVIDER, CURRENT_MODEL)
 
 
+# 現在のLLMプロバイダーのインスタンス（プロセス内で共有し、HTTP接続プールを再利用する）
+_current_llm: Optional[LLMProvider] = None
+_current_llm_lock = threading.Lock()
+
+
 # 便利な関数：現在のLLMを取得
 def get_current_llm() -> LLMProvider:
-    """現在設定されているLLMプロバイダーを取得（エイリアス）"""
-    return LLMFactory.get_current()
+    """
+    現在設定されているLLMプロバイダーを取得
+
+    初回呼び出し時にインスタンスを作成し、以降は同じインスタンスを返す。
+    マルチワーカー構成ではfork後の各ワーカーで個別に作成される。
+    """
+    global _current_llm
+    if _current_llm is None:
+        with _current_llm_lock:
+            if _current_llm is None:
+                _current_llm = LLMFactory.get_current()
+    return _current_llm
+
+
+# 段階的スコアリング用の高速モデルのインスタンス（必要になった時点で作成）
+_fast_llm: Optional[LLMProvider] = None
+
+
+def fast_generation_settings() -> GenerationSettings:
+    """
+    高速モデルの生成設定
+
+    推論モデル向けに選んだ設定（思考予算を含む最大出力トークン数・推論の深さ）やリクエストの上書きは
+    高速モデルには適用せず、FAST_MAX_COMPLETION_TOKENS を使う。
+    """
+    return GenerationSettings(None, FAST_MAX_COMPLETION_TOKENS, "fast_tier")
+
+
+def get_fast_llm() -> LLMProvider:
+    """段階的スコアリングの一次判定に使う高速モデルを取得"""
+    global _fast_llm
+    if _fast_llm is None:
+        with _current_llm_lock:
+            if _fast_llm is None:
+                print(f"⚡ 高速モデル: {FAST_PROVIDER}/{FAST_MODEL}")
+                if FAST_PROVIDER.lower() == "groq":
+                    _fast_llm = GroqProvider(model=FAST_MODEL, max_completion_tokens=FAST_MAX_COMPLETION_TOKENS)
+                else:
+                    _fast_llm = LLMFactory.create(FAST_PROVIDER, FAST_MODEL)
+    return _fast_llm
+
+
+# バッチAPIバックエンドの差し替え（テスト時に LocalBatchStub を設定する）
+_batch_backend_override: Optional[BatchBackend] = None
+
+
+def set_batch_backend(backend: Optional[BatchBackend]) -> None:
+    """バッチAPIバックエンドを差し替える（Noneで現在のプロバイダーのバックエンドに戻す）"""
+    global _batch_backend_override
+    _batch_backend_override = backend
+
+
+def get_batch_backend() -> BatchBackend:
+    """現在のプロバイダーのバッチAPIバックエンドを取得"""
+    if _batch_backend_override is not None:
+        return _batch_backend_override
+    return get_current_llm().create_batch_backend()
+
+
+def close_current_llm() -> None:
+    """共有しているLLMプロバイダーのHTTPクライアントを閉じる（シャットダウン用）"""
+    global _current_llm, _fast_llm
+    with _current_llm_lock:
+        for llm in (_current_llm, _fast_llm):
+            client = getattr(llm, "client", None)
+            if client is not None and hasattr(client, "close"):
+                client.close()
+        _current_llm = None
+        _fast_llm = None
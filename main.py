@@ -1,24 +1,228 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+# 起動時間の計測（他のモジュールより先に読み込む）
+from startup_profile import startup_profile
+
+with startup_profile.phase("import:fastapi"):
+    from fastapi import FastAPI, HTTPException, Header, Request
+    from fastapi.responses import PlainTextResponse
+    from pydantic import BaseModel
+    from fastapi.middleware.cors import CORSMiddleware
 import os
 import json
 import re
-import math
+import asyncio
+import hmac
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
 from dotenv import load_dotenv
-from fastapi.middleware.cors import CORSMiddleware
 
 # 環境変数の読み込み
 load_dotenv()
 
-# Supabaseクライアントのインポート
-from supabase_client import SupabaseClient
+# Supabaseクライアントのインポート（supabaseパッケージ自体は初期化時に遅延インポート）
+with startup_profile.phase("import:supabase_client"):
+    from supabase_client import SupabaseClient
+
+# LLMプロバイダーのインポート（各SDKは初期化時に遅延インポート）
+with startup_profile.phase("import:llm_providers"):
+    from llm_providers import (
+        get_current_llm, close_current_llm, get_batch_backend, build_batch_jsonl, run_batch_job_async,
+        BATCH_POLL_INTERVAL_SECONDS, CURRENT_PROVIDER, CURRENT_MODEL,
+        prompt_prefix_registry, prompt_cache_stats, get_fast_llm, fast_generation_settings,
+        FAST_PROVIDER, FAST_MODEL, LLMProvider,
+        GenerationSettings, generation_policy, validate_generation_overrides, generate_complete, continuation_stats
+    )
+
+# 分析スケジューリング層のインポート
+with startup_profile.phase("import:analysis_scheduler"):
+    from analysis_scheduler import (
+        SingleFlight, InflightTracker, PriorityScheduler, AdmissionController, AdmissionRejected,
+        AdmissionTicket, parse_lane_shares, parse_device_weights, prompt_hash
+    )
+
+# 処理ステージの計測・プロファイラのインポート
+from profiling import stage_timer, record_stage, sampling_profiler, stage_latency, ProfilerBusyError
+
+# レディネス判定（飽和度・依存先の疎通確認）
+from readiness import DependencyProbe, saturation, READY_MAX_SATURATION
+
+# レスポンス軽量化（項目の絞り込み・高速JSON・圧縮）
+from response_shaping import FastJSONResponse, render_response, add_compression_middleware
+
+# バックグラウンドジョブの記録
+from job_store import JobStore
+
+# Dashboard Summaryの差分更新
+import dashboard_incremental
+
+# 分析結果の型（別名の解決・スコア配列）
+from analysis_results import SLOTS_PER_DAY, TimeBlockResult, DashboardSummaryResult
+
+# audio_aggregatorの変更フィードを取り込むワーカー
+from change_feed_worker import ChangeFeedWorker, CursorPollingSource, ChangeSource, try_acquire_worker_lock
+
+# 複数インスタンス間の分担（device_idのシャードをリースで割り当て）
+from sharding import ShardCoordinator, FileLeaseBackend, SupabaseLeaseBackend
+
+# 段階的スコアリング（高速モデルでの一次判定）
+from tiered_scoring import precheck_prompt, check_fast_result, tiered_scoring_stats
+
+# 呼び出し元の期限・クライアント切断によるキャンセル
+from request_deadline import (
+    Deadline, CallGuard, RequestAbandoned, current_deadline, run_guarded, abandon_stats,
+    TIMEOUT_HEADER, DEADLINE_HEADER, CLIENT_CLOSED_STATUS
+)
+
+# 分析結果のスキーマ（項目単位の検証と、欠けた項目だけの修復）
+from result_schemas import (
+    RESULT_SCHEMAS, RESULT_REPAIR, REPAIR_REASONING_EFFORT, REPAIR_MAX_COMPLETION_TOKENS, repair_stats
+)
+
+# タイムブロックのまとめ分析（パッキング）
+from timeblock_packing import (
+    TIMEBLOCK_PACK_SIZE, PackedResponseError, chunk_time_blocks, build_packed_prompt, split_packed_result
+)
+
+# NDJSONのストリーミング処理（大量の分析対象の受け付けと結果の逐次返却）
+from ndjson_stream import NDJSONStreamingResponse, iter_lines, process_lines
+from response_shaping import shape_response
+
+# LLM分析結果のローカル保存（Supabase保存失敗時の再利用・再保存）
+from result_store import result_store
+
+# LLM・Supabaseの通信の記録（TRAFFIC_CAPTURE=true の場合のみ）
+from traffic_capture import traffic_recorder, CapturingClient, TrafficCaptureMiddleware
+
+# シャットダウン時に実行中のLLM呼び出しの完了を待つ最大秒数
+# （gunicornのgraceful_timeoutより短くすること）
+LLM_DRAIN_TIMEOUT_SECONDS = float(os.getenv("LLM_DRAIN_TIMEOUT_SECONDS", "170"))
+
+# ワーカーあたりのLLM同時呼び出し数と、優先度レーンごとの割合
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_LANE_SHARES = parse_lane_shares(os.getenv("LLM_LANE_SHARES"))
+
+# デバイスごとのLLM同時呼び出し数の上限と、他のデバイスが待機していない場合に上限を超えて使える数
+# （未設定の場合は LLM_MAX_CONCURRENCY の半分と、残り全部）
+# 重みは "device_id=2,device_id2=0.5" 形式（未指定のデバイスは1）
+LLM_DEVICE_MAX_CONCURRENCY = int(os.getenv("LLM_DEVICE_MAX_CONCURRENCY", "0")) or None
+LLM_DEVICE_BURST = int(os.environ["LLM_DEVICE_BURST"]) if os.getenv("LLM_DEVICE_BURST") else None
+LLM_DEVICE_WEIGHTS = parse_device_weights(os.getenv("LLM_DEVICE_WEIGHTS"))
+
+# 受付制御: 推定完了時間がこの秒数を超えるリクエストは処理を始めずに503で拒否する
+# （nginxのproxy_read_timeout 180秒から、プロンプト取得・保存の余裕を引いた値）
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "true").lower() == "true"
+ADMISSION_DEADLINE_SECONDS = float(os.getenv("ADMISSION_DEADLINE_SECONDS", "170"))
+
+# エンドポイントごとのデフォルトの優先度（リクエストのpriorityで上書き可能）
+# アプリから呼ばれるDashboard Summaryは対話的、タイムブロック分析は定期処理として扱う
+DEFAULT_TIMEBLOCK_PRIORITY = "scheduled"
+DEFAULT_DASHBOARD_PRIORITY = "interactive"
+
+# タイムブロック分析を高速モデルで先に試すか（リクエストのtieredで上書き可能）
+# 高速モデルの結果が妥当な場合はそのまま採用し、そうでない場合のみ推論モデルで分析する
+TIERED_SCORING = os.getenv("TIERED_SCORING", "false").lower() == "true"
+
+# Dashboard Summaryを差分更新するか（リクエストのincrementalで上書き可能）
+# 有効な場合、数値項目はローカルで再計算し、総合評価は変化が大きい場合のみLLMで再生成する
+DASHBOARD_INCREMENTAL = os.getenv("DASHBOARD_INCREMENTAL", "false").lower() == "true"
+
+# audio_aggregatorの変更を取り込んで自動的にタイムブロック分析を行うか
+# （コンテナ内で1つのワーカープロセスだけが取り込む）
+CHANGE_FEED_WORKER = os.getenv("CHANGE_FEED_WORKER", "false").lower() == "true"
+
+# 変更フィードを複数インスタンスで分担するか（device_idのシャード単位）
+# リースの保存先: "supabase"（scorer_shard_leases / scorer_shard_members テーブル）または "file"（同一ホスト・テスト用）
+SHARDING = os.getenv("SHARDING", "false").lower() == "true"
+SHARD_BACKEND = os.getenv("SHARD_BACKEND", "supabase")
+
+# Dashboard Summary一括分析: 同時に分析するデバイス数と、まとめて書き込む件数
+DASHBOARD_BATCH_CONCURRENCY = int(os.getenv("DASHBOARD_BATCH_CONCURRENCY", str(LLM_MAX_CONCURRENCY)))
+DASHBOARD_BATCH_WRITE_SIZE = int(os.getenv("DASHBOARD_BATCH_WRITE_SIZE", "50"))
+
+# NDJSONストリーミング分析で同時に処理する対象数（リクエストのconcurrencyで上書き可能、上限はLLM_MAX_CONCURRENCYの2倍）
+STREAM_CONCURRENCY = int(os.getenv("STREAM_CONCURRENCY", str(LLM_MAX_CONCURRENCY)))
 
-# LLMプロバイダーのインポート
-from llm_providers import get_current_llm, CURRENT_PROVIDER, CURRENT_MODEL
+# 未保存の結果を再保存する際にまとめて書き込む件数
+RESULT_REPLAY_WRITE_SIZE = int(os.getenv("RESULT_REPLAY_WRITE_SIZE", "100"))
 
-app = FastAPI(title="VibeGraph Generation API")
+# 管理用エンドポイント（/debug/*）の認証トークン（未設定の場合は /debug/* を無効にする）
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# 非推奨エンドポイント（/analyze/chatgpt, /analyze-vibegraph-supabase）を登録するか（モジュールは初回のリクエストで読み込む）
+ENABLE_LEGACY_ENDPOINTS = os.getenv("ENABLE_LEGACY_ENDPOINTS", "true").lower() == "true"
+
+async def prewarm_clients():
+    """Supabase・LLMクライアントをバックグラウンドで事前に作成する（SDKのインポートを含む）"""
+    try:
+        with startup_profile.phase("warmup:supabase_client", kind="warmup"):
+            await asyncio.to_thread(get_supabase_client)
+    except Exception:
+        # 初期化失敗時は初回リクエスト時に再試行する
+        print("⚠️ Supabaseクライアントの事前初期化に失敗しました（初回リクエスト時に再試行）")
+    try:
+        with startup_profile.phase("warmup:llm_client", kind="warmup"):
+            await asyncio.to_thread(get_current_llm)
+        print("✅ LLM client initialized successfully")
+    except Exception as e:
+        print(f"⚠️ LLMクライアントの事前初期化に失敗しました（初回リクエスト時に再試行）: {e}")
+    startup_profile.mark_warmup_done()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """ワーカーの起動・終了処理（マルチワーカー構成ではワーカーごとに実行される）"""
+    # LLM呼び出し（スレッド実行）がデフォルトのスレッド数（CPU数+4）で頭打ちにならないようにする
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY + 4, thread_name_prefix="llm")
+    )
+
+    # 起動時: クライアントの事前作成はバックグラウンドで行い、起動自体は待たせない
+    warmup_task = asyncio.create_task(prewarm_clients())
+
+    # 変更フィードワーカー（ロックを取得できたワーカープロセスのみ）
+    global change_feed_worker, shard_coordinator
+    feed_task = None
+    feed_lock = try_acquire_worker_lock() if CHANGE_FEED_WORKER else None
+    if feed_lock is not None:
+        shard_coordinator = create_shard_coordinator()
+        change_feed_worker = create_change_feed_worker(coordinator=shard_coordinator)
+        feed_task = asyncio.create_task(run_change_feed(change_feed_worker, shard_coordinator))
+
+    startup_profile.mark_ready()
+
+    yield
+
+    # 終了処理中は /ready で not ready を返し、ロードバランサーに新しいリクエストを振り分けさせない
+    global shutting_down
+    shutting_down = True
+    # 終了時: 実行中のLLM呼び出しを待ってからクライアントを閉じる
+    if not warmup_task.done():
+        warmup_task.cancel()
+    if feed_task is not None:
+        feed_task.cancel()
+        await change_feed_worker.stop(timeout=LLM_DRAIN_TIMEOUT_SECONDS)
+        if shard_coordinator is not None:
+            await shard_coordinator.stop()
+        feed_lock.close()
+    if llm_calls.count > 0:
+        print(f"⏳ 実行中のLLM呼び出しの完了を待機中... ({llm_calls.count}件)")
+        drained = await llm_calls.wait_idle(LLM_DRAIN_TIMEOUT_SECONDS)
+        if drained:
+            print("✅ 実行中のLLM呼び出しが全て完了しました")
+        else:
+            print(f"❌ {LLM_DRAIN_TIMEOUT_SECONDS}秒以内に完了しなかったLLM呼び出しがあります: {llm_calls.count}件")
+    close_current_llm()
+    traffic_recorder.close()
+
+app = FastAPI(title="VibeGraph Generation API", lifespan=lifespan, default_response_class=FastJSONResponse)
+
+# レスポンス圧縮（Accept-Encodingに応じてbrotli/gzip）
+add_compression_middleware(app)
+
+# 分析リクエストの記録（性能の回帰確認用、TRAFFIC_CAPTURE=true の場合のみ）
+if traffic_recorder.enabled:
+    app.add_middleware(TrafficCaptureMiddleware, recorder=traffic_recorder)
 
 # CORS設定
 app.add_middleware(
@@ -31,35 +235,115 @@ app.add_middleware(
 
 # Supabaseクライアントの遅延初期化
 supabase_client = None
+_supabase_client_lock = threading.Lock()
 
 def get_supabase_client():
-    """Supabaseクライアントを遅延初期化して取得"""
+    """Supabaseクライアントを遅延初期化して取得（事前初期化スレッドと競合しないようロックする）"""
     global supabase_client
     if supabase_client is None:
-        try:
-            supabase_client = SupabaseClient()
-            print("✅ Supabase client initialized successfully")
-        except Exception as e:
-            print(f"❌ Failed to initialize Supabase client: {e}")
-            raise e
+        with _supabase_client_lock:
+            if supabase_client is None:
+                try:
+                    client = SupabaseClient()
+                    if traffic_recorder.enabled:
+                        client.client = CapturingClient(client.client, traffic_recorder)
+                    supabase_client = client
+                    print("✅ Supabase client initialized successfully")
+                except Exception as e:
+                    print(f"❌ Failed to initialize Supabase client: {e}")
+                    raise e
     return supabase_client
 
-class PromptRequest(BaseModel):
-    prompt: str
+# 同一対象への重複分析リクエストを集約する（オーケストレーターのリトライ対策）
+analysis_flights = SingleFlight()
 
-class VibeGraphRequest(BaseModel):
-    device_id: str
-    date: Optional[str] = None
+# 実行中のLLM呼び出し（シャットダウン時のdrain用）
+llm_calls = InflightTracker()
+
+# 優先度レーン付きのLLM同時実行数制御（interactive > scheduled > backfill、レーン内はデバイス間で公平に割り当て）
+llm_scheduler = PriorityScheduler(
+    LLM_MAX_CONCURRENCY, LLM_LANE_SHARES, LLM_DEVICE_MAX_CONCURRENCY, LLM_DEVICE_BURST, LLM_DEVICE_WEIGHTS
+)
+
+# 期限内に完了できないリクエストを処理開始前に拒否する受付制御
+admission_controller = AdmissionController(llm_scheduler, ADMISSION_DEADLINE_SECONDS, ADMISSION_CONTROL)
+
+# バックグラウンドジョブ（バッチ処理）の記録と、実行中タスクへの参照
+job_store = JobStore()
+
+# 変更フィードワーカー（CHANGE_FEED_WORKER=true の場合にlifespanで作成）
+change_feed_worker: Optional[ChangeFeedWorker] = None
+shard_coordinator: Optional[ShardCoordinator] = None
+background_tasks = set()
+
+# 終了処理中か（lifespan の終了時に True にする）
+shutting_down = False
+
+def probe_supabase() -> None:
+    """Supabaseの疎通確認（1行だけ取得する軽いクエリ）"""
+    get_supabase_client().client.table('audio_scorer').select('device_id').limit(1).execute()
+
+# 依存先の疎通確認（結果はキャッシュし、/ready のたびにSupabaseへ問い合わせない）
+# LLMはAPI呼び出しに費用がかかるため、クライアントを初期化できるかだけを確認する
+dependency_probes = [
+    DependencyProbe("supabase", probe_supabase),
+    DependencyProbe("llm_client", lambda: get_current_llm()),
+]
+
+def start_background_task(coro) -> asyncio.Task:
+    """レスポンス返却後も続く処理をタスクとして開始（完了までタスクへの参照を保持）"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
 class DashboardSummaryRequest(BaseModel):
     device_id: str
     date: str
+    priority: Optional[str] = None  # "interactive", "scheduled", "backfill"（デフォルト: interactive）
+    incremental: Optional[bool] = None  # 差分更新（デフォルト: DASHBOARD_INCREMENTAL）
+    reasoning_effort: Optional[str] = None  # "low", "medium", "high"（デフォルト: 生成設定ポリシー）
+    max_completion_tokens: Optional[int] = None  # 最大出力トークン数（デフォルト: 生成設定ポリシー）
+    persist_anyway: bool = False  # 期限切れ・切断時も分析を完了して保存する
 
 class TimeBlockAnalysisRequest(BaseModel):
     """タイムブロック単位の分析リクエスト"""
     device_id: str
     date: str
     time_block: str
+    priority: Optional[str] = None  # "interactive", "scheduled", "backfill"（デフォルト: scheduled）
+    tiered: Optional[bool] = None  # 高速モデルでの一次判定（デフォルト: TIERED_SCORING）
+    reasoning_effort: Optional[str] = None  # "low", "medium", "high"（デフォルト: 生成設定ポリシー）
+    max_completion_tokens: Optional[int] = None  # 最大出力トークン数（デフォルト: 生成設定ポリシー）
+    persist_anyway: bool = False  # 期限切れ・切断時も分析を完了して保存する
+
+class PackedTimeBlockAnalysisRequest(BaseModel):
+    """複数タイムブロックのまとめ分析リクエスト（隣接するブロックを pack_size 件ずつ1回のLLM呼び出しで分析）"""
+    device_id: str
+    date: str
+    time_blocks: List[str]
+    pack_size: Optional[int] = None  # デフォルト: TIMEBLOCK_PACK_SIZE
+    priority: Optional[str] = None  # "interactive", "scheduled", "backfill"（デフォルト: scheduled）
+    reasoning_effort: Optional[str] = None  # "low", "medium", "high"（デフォルト: 生成設定ポリシー）
+    max_completion_tokens: Optional[int] = None  # 最大出力トークン数（デフォルト: 生成設定ポリシー）
+
+class DashboardSummaryBatchRequest(BaseModel):
+    """複数デバイスのDashboard Summary一括分析リクエスト（1日分）"""
+    date: str
+    device_ids: Optional[List[str]] = None  # 省略時はその日付のdashboard_summaryがある全デバイス
+    only_unanalyzed: bool = False  # Trueの場合、analysis_resultが未保存のデバイスのみ
+    priority: Optional[str] = None  # "interactive", "scheduled", "backfill"（デフォルト: scheduled）
+
+class AnalysisTarget(BaseModel):
+    """分析対象（タイムブロック分析の場合はtime_blockが必須）"""
+    device_id: str
+    date: str
+    time_block: Optional[str] = None
+
+class OfflineBatchRequest(BaseModel):
+    """ベンダーのバッチAPIで処理する分析リクエスト（夜間処理・再処理など即時性が不要なもの）"""
+    kind: str  # "timeblock" または "dashboard_summary"
+    targets: List[AnalysisTarget]
 
 def extract_json_from_response(raw_response: str) -> Dict[str, Any]:
     """ChatGPTの応答からJSONを抽出し、改善された処理を適用する"""
@@ -98,88 +382,204 @@ def extract_json_from_response(raw_response: str) -> Dict[str, Any]:
         }
 
 def process_nan_values(data: Dict[str, Any]) -> Dict[str, Any]:
-    """NaN文字列をfloat('nan')に変換する"""
+    """NaN文字列をfloat('nan')に変換する（解析直後の結果をその場で書き換え、コピーは作らない）"""
     
     def convert_nan_recursive(obj):
-        if isinstance(obj, dict):
-            return {k: convert_nan_recursive(v) for k, v in obj.items()}
-        elif isinstance(obj, list):
-            return [convert_nan_recursive(item) for item in obj]
-        elif isinstance(obj, str) and obj.lower() == "nan":
-            return float('nan')
-        else:
-            return obj
+        items = obj.items() if isinstance(obj, dict) else enumerate(obj)
+        for k, v in items:
+            if isinstance(v, (dict, list)):
+                convert_nan_recursive(v)
+            elif isinstance(v, str) and v.lower() == "nan":
+                obj[k] = float('nan')
     
-    return convert_nan_recursive(data)
+    if isinstance(data, (dict, list)):
+        convert_nan_recursive(data)
+    return data
 
-def validate_emotion_scores(data: Dict[str, Any]) -> Dict[str, Any]:
-    """emotionScoresの構造をバリデーションし、必要に応じて補完する"""
-    
-    validation_info = {
-        "original_score_count": 0,
-        "expected_score_count": 48,
-        "score_length_warning": False,
-        "missing_scores_filled": 0,
-        "nan_scores_detected": 0
+def print_analysis_result(analysis_result: Dict[str, Any]) -> None:
+    """分析結果をターミナルに表示"""
+    print("\n" + "="*60)
+    print("📊 分析結果:")
+    print("="*60)
+    print(json.dumps(analysis_result, ensure_ascii=False, indent=2))
+    print("="*60 + "\n")
+
+def resolve_priority(priority: Optional[str], default: str) -> str:
+    """リクエストの優先度を検証して返す（未指定の場合はエンドポイントのデフォルト）"""
+    lane = priority or default
+    try:
+        llm_scheduler.validate_lane(lane)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return lane
+
+def admit_request(
+    endpoint: str,
+    priority: str,
+    processing_log: Dict[str, Any],
+    deadline: Optional[Deadline] = None
+) -> AdmissionTicket:
+    """
+    受付制御（期限内に完了できないと推定された場合は 503 + Retry-After）
+
+    プロンプト取得・LLM呼び出しより前に呼び出し、完了時に release_request に渡す。
+    呼び出し元の期限（deadline）が ADMISSION_DEADLINE_SECONDS より短い場合はそちらで判定する。
+    """
+    deadline_seconds = min(ADMISSION_DEADLINE_SECONDS, deadline.remaining()) if deadline else ADMISSION_DEADLINE_SECONDS
+    try:
+        ticket = admission_controller.admit(endpoint, priority, deadline_seconds)
+    except AdmissionRejected as e:
+        print(f"🚦 受付拒否（推定完了 {e.estimated_seconds:.1f}秒 > 期限 {deadline_seconds:.0f}秒）: {endpoint} [{priority}]")
+        raise HTTPException(
+            status_code=503,
+            detail={
+                "message": "混雑のため期限内に処理できません。時間をおいて再試行してください",
+                "estimated_seconds": round(e.estimated_seconds, 1),
+                "deadline_seconds": round(deadline_seconds, 1)
+            },
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    processing_log["admission"] = {"estimated_seconds": round(ticket.estimated_seconds, 1)}
+    return ticket
+
+def release_request(ticket: AdmissionTicket, processing_log: Dict[str, Any], completed: bool) -> None:
+    """受付済みリクエストの完了（正常終了時は処理時間を次回以降の推定に使う）"""
+    queue_wait_ms = processing_log.get("stage_timings_ms", {}).get("queue_wait", 0.0)
+    admission_controller.release(ticket, queue_wait_ms / 1000 if completed else None)
+
+def resolve_deadline(timeout: Optional[str], deadline: Optional[str]) -> Optional[Deadline]:
+    """呼び出し元の期限ヘッダー（X-Request-Timeout / X-Request-Deadline）を検証して返す（未指定の場合はNone）"""
+    try:
+        parsed = Deadline.from_headers(timeout, deadline)
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"{TIMEOUT_HEADER} は残り秒数、{DEADLINE_HEADER} はUNIX時刻（秒）で指定してください"
+        )
+    if parsed is not None and parsed.expired():
+        raise HTTPException(status_code=504, detail="リクエストの期限を過ぎています")
+    return parsed
+
+def abandoned_error(e: RequestAbandoned, processing_log: Dict[str, Any]) -> HTTPException:
+    """期限切れ（504）・クライアント切断（499）で打ち切ったリクエストのエラー"""
+    processing_log["abandoned"] = e.reason
+    if e.reason == "client_disconnected":
+        print(f"🔌 クライアントが切断したため分析をキャンセルしました")
+        return HTTPException(status_code=CLIENT_CLOSED_STATUS, detail="クライアントが切断しました")
+    print(f"⏱️ 期限を過ぎたため分析をキャンセルしました")
+    return HTTPException(status_code=504, detail="期限内に分析が完了しなかったためキャンセルしました")
+
+def persisting_response(
+    e: RequestAbandoned,
+    ticket: AdmissionTicket,
+    processing_log: Dict[str, Any],
+    **target: str
+) -> FastJSONResponse:
+    """
+    persist_anyway のリクエストが期限を過ぎた場合の応答（202、分析は継続して保存する）
+
+    受付の完了は継続した分析の完了時に記録する。
+    """
+    processing_log["abandoned"] = e.reason
+    e.task.add_done_callback(
+        lambda task: release_request(ticket, processing_log, not task.cancelled() and task.exception() is None)
+    )
+    return FastJSONResponse(
+        status_code=202,
+        content={
+            "status": "accepted",
+            "message": "期限内に完了しなかったため、分析を継続して保存します",
+            **target,
+            "persist_anyway": True
+        }
+    )
+
+def resolve_generation_overrides(request: BaseModel) -> Optional[Dict[str, Any]]:
+    """リクエストの生成設定（reasoning_effort, max_completion_tokens）を検証して返す（未指定の場合はNone）"""
+    overrides = {
+        "reasoning_effort": getattr(request, "reasoning_effort", None),
+        "max_completion_tokens": getattr(request, "max_completion_tokens", None)
     }
-    
-    # emotionScoresが存在するかチェック
-    if "emotionScores" in data and isinstance(data["emotionScores"], list):
-        original_scores = data["emotionScores"]
-        validation_info["original_score_count"] = len(original_scores)
-        
-        # NaN値の数をカウント
-        for score in original_scores:
-            if isinstance(score, float) and math.isnan(score):
-                validation_info["nan_scores_detected"] += 1
-            elif isinstance(score, str) and score.lower() == "nan":
-                validation_info["nan_scores_detected"] += 1
-        
-        # 48個に満たない場合は補完
-        if len(original_scores) < 48:
-            missing_count = 48 - len(original_scores)
-            validation_info["missing_scores_filled"] = missing_count
-            validation_info["score_length_warning"] = True
-            
-            # NaNで補完
-            data["emotionScores"] = original_scores + [float('nan')] * missing_count
-        
-        # averageScoreを再計算（NaNを除外）
-        valid_scores = []
-        for score in data["emotionScores"]:
-            if isinstance(score, (int, float)) and not math.isnan(score):
-                valid_scores.append(score)
-        
-        if valid_scores:
-            data["averageScore"] = sum(valid_scores) / len(valid_scores)
-            validation_info["average_calculated_from"] = len(valid_scores)
-        else:
-            data["averageScore"] = float('nan')
-            validation_info["average_calculated_from"] = 0
-    
-    elif "emotionScores" not in data:
-        # emotionScoresが存在しない場合は空のリストで初期化
-        data["emotionScores"] = [float('nan')] * 48
-        validation_info["missing_scores_filled"] = 48
-        validation_info["score_length_warning"] = True
-        data["averageScore"] = float('nan')
-    
-    return data, validation_info
+    if not any(value is not None for value in overrides.values()):
+        return None
+    try:
+        return validate_generation_overrides(overrides)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-async def call_llm_with_retry(prompt: str) -> Dict[str, Any]:
-    """リトライ機能付きLLM呼び出し（プロバイダー抽象化）"""
+async def call_llm_with_retry(
+    prompt: str,
+    processing_log: Optional[Dict[str, Any]] = None,
+    priority: str = DEFAULT_TIMEBLOCK_PRIORITY,
+    llm: Optional[LLMProvider] = None,
+    generation: Optional[GenerationSettings] = None,
+    device_id: Optional[str] = None,
+    schema: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    リトライ機能付きLLM呼び出し（プロバイダー抽象化）
+
+    llm を指定しない場合は現在設定されているLLMプロバイダーを使用する。
+    generation（推論の深さ・最大出力トークン数）を指定しない場合はプロバイダーのデフォルトを使用し、
+    指定した場合は processing_log["generation"] に記録する。
+
+    priority の優先度レーンで実行枠を確保してから呼び出す。レーン内では device_id ごとに公平に割り当てられる。
+    processing_log を渡すと、実行枠の待ち時間・LLM呼び出し・JSON抽出・NaN処理の所要時間を
+    processing_log["stage_timings_ms"] に、トークン使用量（キャッシュ分を含む）を
+    processing_log["llm_usage"] に記録する。
+
+    schema（RESULT_SCHEMAS のキー）を指定すると結果を項目単位で検証し、欠けている・不正な項目だけを
+    修復する（repair_result）。
+
+    リクエストの期限（current_deadline）はスレッドで実行するプロバイダーに伝わり、呼び出しのタイムアウトと
+    リトライの判定に使われる。キャンセルされた場合は、スレッド側でもそれ以降のリトライ・続きの生成を行わない。
+    """
     try:
         # 現在設定されているLLMプロバイダーを取得
-        llm = get_current_llm()
+        llm = llm or get_current_llm()
+
+        # 直近のプロンプトと共通の指示部分をsystemメッセージとして分離（ベンダー側のプロンプトキャッシュ対象）
+        structured_prompt = prompt_prefix_registry.structure(prompt)
+
+        if generation is not None:
+            print(f"🎛️ 生成設定: reasoning_effort={generation.reasoning_effort}, "
+                  f"max_completion_tokens={generation.max_completion_tokens} ({generation.reason})")
+            if processing_log is not None:
+                processing_log["generation"] = generation.to_dict()
 
-        # LLM呼び出し（各プロバイダーのリトライ機能が適用される）
-        raw_response = llm.generate(prompt)
+        # 優先度レーンの実行枠を確保してからLLM呼び出し（各プロバイダーのリトライ機能が適用される）
+        # 同期APIのためスレッドで実行し、待機中もイベントループを塞がない
+        async with llm_scheduler.slot(priority, device_id) as waited:
+            record_stage(processing_log, "queue_wait", waited)
+            with stage_timer(processing_log, "llm_call"):
+                with traffic_recorder.llm_call(prompt, llm.model_name, generation) as call:
+                    async with llm_calls.track():
+                        # 出力が途中で切れた場合は続きを生成してつなぐ（最初から生成し直さない）
+                        guard = CallGuard(current_deadline())
+                        try:
+                            raw_response, usage = await asyncio.to_thread(
+                                guard.run, generate_complete, llm, structured_prompt, generation
+                            )
+                        except asyncio.CancelledError:
+                            guard.cancel()
+                            raise
+                    call.update(raw_response=raw_response, usage=usage)
+
+        if processing_log is not None and usage:
+            processing_log["llm_usage"] = usage
 
         # JSON抽出処理
-        extracted_data = extract_json_from_response(raw_response)
+        with stage_timer(processing_log, "json_extraction"):
+            extracted_data = extract_json_from_response(raw_response)
 
         # NaN値の処理
-        processed_data = process_nan_values(extracted_data)
+        with stage_timer(processing_log, "nan_processing"):
+            processed_data = process_nan_values(extracted_data)
+
+        if schema and RESULT_REPAIR:
+            processed_data = await repair_result(
+                schema, prompt, processed_data, processing_log, priority, llm, device_id
+            )
 
         return processed_data
 
@@ -187,47 +587,143 @@ async def call_llm_with_retry(prompt: str) -> Dict[str, Any]:
         print(f"LLM API呼び出しエラー: {e}")
         raise
 
+async def repair_result(
+    schema: str,
+    prompt: str,
+    result: Dict[str, Any],
+    processing_log: Optional[Dict[str, Any]],
+    priority: str,
+    llm: LLMProvider,
+    device_id: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    分析結果の欠けている・不正な項目だけをLLMに出力させてマージする
+
+    元の回答を添えて問題のある項目だけを短い設定（REPAIR_*）で生成させるため、分析をやり直すより
+    出力トークンが少なく、元のプロンプト部分はプロンプトキャッシュの対象になる。
+    修復できなかった項目はそのまま残し、processing_log["repair"] に記録する。
+    """
+    result_schema = RESULT_SCHEMAS[schema]
+    if "processing_error" in result:
+        return result
+    problems = result_schema.problems(result)
+    if not problems:
+        return result
+
+    print(f"🩹 分析結果の項目が欠けています・不正です: {problems}。該当項目のみ修復します")
+    repair_log: Dict[str, Any] = {}
+    repaired: List[str] = []
+    error = None
+    with stage_timer(processing_log, "repair"):
+        try:
+            repair = await call_llm_with_retry(
+                result_schema.repair_prompt(prompt, result, problems), repair_log, priority, llm=llm,
+                generation=GenerationSettings(REPAIR_REASONING_EFFORT, REPAIR_MAX_COMPLETION_TOKENS, "repair"),
+                device_id=device_id
+            )
+            repaired = result_schema.merge(result, repair, problems)
+        except Exception as e:
+            print(f"⚠️ 修復に失敗しました: {e}")
+            error = f"{type(e).__name__}: {e}"
+
+    repair_stats.record(schema, problems, repaired, error is not None)
+    remaining = [name for name in problems if name not in repaired]
+    if remaining:
+        print(f"⚠️ 修復できなかった項目: {remaining}")
+    else:
+        print(f"✅ 修復完了: {repaired}")
+    if processing_log is not None:
+        processing_log["repair"] = {
+            "problems": problems,
+            "repaired": repaired,
+            "remaining": remaining,
+            "error": error,
+            "llm_usage": repair_log.get("llm_usage")
+        }
+    return result
+
 @app.get("/")
 async def root():
     return {"message": "VibeGraph Generation API"}
 
-@app.post("/analyze/chatgpt")
-async def relay_to_chatgpt(request: PromptRequest):
+def require_admin_token(x_admin_token: Optional[str]) -> None:
+    """管理用エンドポイントの認証（ADMIN_TOKEN が設定されていない場合は管理用エンドポイント自体を無効にする）"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="管理用エンドポイントは無効です（ADMIN_TOKEN が未設定）")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="管理用トークンが不正です")
+
+@app.get("/debug/startup")
+async def debug_startup(x_admin_token: Optional[str] = Header(None)):
+    """起動時間の内訳（インポート・初期化・事前初期化の所要時間）"""
+    require_admin_token(x_admin_token)
+    return startup_profile.report()
+
+@app.post("/debug/profile")
+async def debug_profile(
+    seconds: float = 10.0,
+    interval_ms: float = 10.0,
+    format: str = "folded",
+    x_admin_token: Optional[str] = Header(None)
+):
     """
-    ⚠️ このエンドポイントは現在使用していません
+    サンプリングプロファイラを指定秒数実行し、CPUのホットスポットを返す
+
+    - format=folded: flamegraph.pl / speedscope で読める folded 形式（テキスト）
+    - format=json: folded 形式に加えてサンプル数などのメタ情報を含むJSON
 
-    プロンプトをChatGPT APIに中継し、応答をJSON形式（dict）で返します。
-    改善されたJSON抽出処理とNaN対応を含みます。
+    マルチワーカー構成ではリクエストを受けたワーカーのみが対象。
     """
+    require_admin_token(x_admin_token)
     try:
-        # LLM呼び出し（プロバイダー抽象化）
-        llm = get_current_llm()
-        raw_response = llm.generate(request.prompt)
+        # 計測中もリクエスト処理を続けられるようスレッドで実行
+        result = await asyncio.to_thread(sampling_profiler.run, seconds, interval_ms)
+    except ProfilerBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
-        # 改善されたJSON抽出処理
-        extracted_data = extract_json_from_response(raw_response)
+    if format == "json":
+        return result
+    return PlainTextResponse(result["folded"] + "\n")
 
-        # NaN値の処理
-        processed_data = process_nan_values(extracted_data)
+@app.get("/debug/result-store")
+async def debug_result_store(x_admin_token: Optional[str] = Header(None)):
+    """ローカルに保存したLLM分析結果の件数（Supabase未保存の件数を含む）"""
+    require_admin_token(x_admin_token)
+    return await asyncio.to_thread(result_store.stats)
 
-        return processed_data
-    
-    except Exception as e:
-        import traceback
-        error_details = {
-            "error_type": type(e).__name__,
-            "error_message": str(e),
-            "traceback": traceback.format_exc().split('\n')[-5:]
+@app.post("/debug/result-store/replay")
+async def debug_result_store_replay(
+    limit: Optional[int] = None,
+    dry_run: bool = False,
+    x_admin_token: Optional[str] = Header(None)
+):
+    """Supabase未保存のLLM分析結果をまとめて保存し直す（python result_store.py replay と同じ）"""
+    require_admin_token(x_admin_token)
+    return await replay_unsaved_results(limit=limit, dry_run=dry_run)
+
+@app.get("/scheduler/metrics")
+async def scheduler_metrics():
+    """優先度レーンごとの待ち行列の長さ・実行数・待ち時間（このワーカー分）"""
+    return {
+        "pid": os.getpid(),
+        "llm": llm_scheduler.metrics(),
+        "admission": admission_controller.metrics(),
+        "coalescing": {
+            "inflight_keys": analysis_flights.inflight_count(),
+            **analysis_flights.stats
+        },
+        "change_feed": change_feed_worker.metrics() if change_feed_worker else None,
+        "sharding": shard_coordinator.metrics() if shard_coordinator else None,
+        "tiered_scoring": tiered_scoring_stats.snapshot(),
+        "traffic_capture": traffic_recorder.metrics(),
+        "continuation": continuation_stats.snapshot(),
+        "repair": repair_stats.snapshot(),
+        "abandoned": abandon_stats.snapshot(),
+        "prompt_cache": {
+            **prompt_cache_stats.snapshot(),
+            "known_prefixes": prompt_prefix_registry.known_prefixes()
         }
-        print(f"❌ ERROR in relay_to_chatgpt: {error_details}")
-        
-        raise HTTPException(
-            status_code=500, 
-            detail={
-                "message": "ChatGPT APIでエラーが発生しました",
-                "error_details": error_details
-            }
-        )
+    }
 
 @app.get("/health")
 async def health_check():
@@ -239,244 +735,372 @@ async def health_check():
         "llm_model": CURRENT_MODEL
     }
 
-@app.post("/analyze-vibegraph-supabase")
-async def analyze_vibegraph_supabase(request: VibeGraphRequest):
+@app.get("/ready")
+async def readiness_check():
     """
-    ⚠️ このエンドポイントは現在使用していません
+    レディネスチェック（ロードバランサー・オートスケーリング用、このワーカー分）
+
+    以下のいずれかに該当する場合は 503 を返す。
+    - 終了処理中
+    - 依存先（Supabase・LLMクライアント）の疎通確認に失敗
+    - 飽和度（(実行中のLLM呼び出し + 待ち行列) / 同時実行数）が READY_MAX_SATURATION 以上
+    - 受付制御が有効で、新しい対話的リクエストが期限内に完了しないと推定される
 
-    Supabase統合版の心理グラフ(VibeGraph)処理
-    vibe_whisper_promptテーブルからプロンプトを取得し、処理後にvibe_whisper_summaryテーブルに保存
+    飽和度は X-Saturation ヘッダーにも返す（オートスケーリングの指標）。
     """
+    llm = llm_scheduler.metrics()
+    level = saturation(llm["inflight"], llm["queue_depth"], llm["capacity"])
+    wait, processing = admission_controller.estimate("timeblock", "interactive")
+    dependencies = dict(zip(
+        [probe.name for probe in dependency_probes],
+        await asyncio.gather(*(probe.status() for probe in dependency_probes))
+    ))
+
+    reasons = []
+    if shutting_down:
+        reasons.append("shutting_down")
+    reasons += [f"{name}_unreachable" for name, status in dependencies.items() if not status["ok"]]
+    if level >= READY_MAX_SATURATION:
+        reasons.append("saturated")
+    if admission_controller.enabled and wait > 0 and wait + processing > admission_controller.deadline_seconds:
+        reasons.append("deadline_exceeded")
+
+    return FastJSONResponse(
+        {
+            "status": "not_ready" if reasons else "ready",
+            "reasons": reasons,
+            "pid": os.getpid(),
+            "saturation": level,
+            "llm": {
+                "inflight": llm["inflight"],
+                "capacity": llm["capacity"],
+                "queue_depth": llm["queue_depth"],
+                "service_ms_p95": llm["service_ms_p95"],
+                "lanes": {
+                    name: {key: lane[key] for key in ("limit", "inflight", "queue_depth", "wait_ms_p95")}
+                    for name, lane in llm["lanes"].items()
+                }
+            },
+            "estimated_wait_seconds": round(wait, 2),
+            "stages": stage_latency.snapshot(),
+            "dependencies": dependencies,
+            "timestamp": datetime.now().isoformat()
+        },
+        status_code=503 if reasons else 200,
+        headers={"X-Saturation": str(level)}
+    )
+
+async def fetch_timeblock_prompt(
+    supabase: SupabaseClient,
+    device_id: str,
+    date: str,
+    time_block: str,
+    processing_log: Optional[Dict[str, Any]] = None
+) -> str:
+    """audio_aggregatorテーブルからタイムブロック分析用のプロンプトを取得"""
+    print("📥 audio_aggregatorテーブルからプロンプト取得中...")
     try:
-        device_id = request.device_id
-        
-        # 日付パラメータは必須
-        if not request.date:
-            raise HTTPException(
-                status_code=400,
-                detail="date parameter is required"
-            )
-        
-        search_date = request.date  # 検索用の日付
-        
-        processing_log = {
-            "start_time": datetime.now().isoformat(),
-            "mode": "supabase",
-            "processing_steps": [],
-            "complete": False,
-            "warnings": [],
-            "search_date": search_date
-        }
-        
-        # Supabaseクライアントの取得
-        supabase = get_supabase_client()
-        
-        # 1) vibe_whisper_promptテーブルからプロンプト取得
-        prompt_data = await supabase.get_vibe_whisper_prompt(device_id, search_date)
-        if prompt_data is None:
+        with stage_timer(processing_log, "fetch_prompt"):
+            result = supabase.client.table('audio_aggregator').select('vibe_aggregator_result').eq('device_id', device_id).eq('date', date).eq('time_block', time_block).execute()
+
+        if not result.data or len(result.data) == 0:
             raise HTTPException(
                 status_code=404,
-                detail=f"プロンプトが見つかりません: device_id={device_id}, date={search_date}"
+                detail=f"audio_aggregatorにデータが見つかりません: device_id={device_id}, date={date}, time_block={time_block}"
             )
-        processing_log["processing_steps"].append("vibe_whisper_promptからプロンプト取得完了")
-        
-        if "prompt" not in prompt_data:
+
+        prompt = result.data[0].get('vibe_aggregator_result')
+        if not prompt:
             raise HTTPException(
-                status_code=400, 
-                detail="プロンプトデータに'prompt'フィールドが見つかりません"
+                status_code=404,
+                detail=f"vibe_aggregator_resultが空です: device_id={device_id}, date={date}, time_block={time_block}"
             )
-        
-        # 実際のデータの日付を取得（prompt_dataの日付を優先）
-        actual_date = prompt_data.get('date', search_date)
-        if actual_date != search_date:
-            processing_log["warnings"].append(f"検索日付({search_date})と実データ日付({actual_date})が異なります")
-            processing_log["actual_date"] = actual_date
-        
-        # 2) LLM処理（リトライ付き）
-        analysis_result = await call_llm_with_retry(prompt_data["prompt"])
-        processing_log["processing_steps"].append("LLM処理完了")
-        
-        # 3) 構造バリデーション
-        validated_data, validation_info = validate_emotion_scores(analysis_result)
-        processing_log["validation_info"] = validation_info
-        processing_log["processing_steps"].append("構造バリデーション完了")
-        
-        # 警告の追加
-        if validation_info.get("score_length_warning", False):
-            processing_log["warnings"].append(f"emotionScores不足: {validation_info['missing_scores_filled']}個のスコアをNaNで補完")
-        
-        if validation_info.get("nan_scores_detected", 0) > 0:
-            processing_log["warnings"].append(f"{validation_info['nan_scores_detected']}個のNaN値を検出")
-        
-        # 4) データを整形してvibe_whisper_summaryテーブルに保存
-        # emotionScoresをvibe_scoresに変換（キー名の変更）
-        vibe_scores = validated_data.get("emotionScores", [])
-        
-        save_success = await supabase.save_to_vibe_whisper_summary(
-            device_id=device_id,
-            target_date=actual_date,
-            vibe_scores=vibe_scores,
-            average_score=validated_data.get("averageScore", 0.0),
-            positive_hours=validated_data.get("positiveHours", 0.0),
-            negative_hours=validated_data.get("negativeHours", 0.0),
-            neutral_hours=validated_data.get("neutralHours", 0.0),
-            insights=validated_data.get("insights", []),
-            vibe_changes=validated_data.get("emotionChanges", []),
-            processing_log=processing_log
-        )
-        
-        if save_success:
-            processing_log["processing_steps"].append("vibe_whisper_summaryテーブルに保存完了")
-            final_status = "success"
-        else:
-            processing_log["processing_steps"].append("vibe_whisper_summaryテーブルへの保存失敗")
-            processing_log["warnings"].append("データベースへの保存に失敗しました")
-            final_status = "failed"
-        
-        processing_log["complete"] = True
-        processing_log["end_time"] = datetime.now().isoformat()
-        
-        return {
-            "status": final_status,
-            "message": "Supabase統合心理グラフ(VibeGraph)処理が完了しました" if final_status == "success" else "処理中にエラーが発生しました",
-            "device_id": device_id,
-            "date": actual_date,
-            "search_date": search_date,
-            "database_save": save_success,
-            "processed_at": datetime.now().isoformat(),
-            "processing_log": processing_log,
-            "validation_summary": {
-                "total_warnings": len(processing_log["warnings"]),
-                "structure_valid": not validation_info.get("score_length_warning", False),
-                "nan_handling": "completed" if validation_info.get("nan_scores_detected", 0) > 0 else "not_required"
-            },
-            "summary": {
-                "vibe_scores": vibe_scores,
-                "average_score": validated_data.get("averageScore", 0.0),
-                "positive_hours": validated_data.get("positiveHours", 0.0),
-                "negative_hours": validated_data.get("negativeHours", 0.0),
-                "neutral_hours": validated_data.get("neutralHours", 0.0),
-                "insights": validated_data.get("insights", []),
-                "vibe_changes": validated_data.get("emotionChanges", [])
-            }
-        }
-        
+
+        print(f"  ✅ プロンプト取得完了: {len(prompt)} chars")
+        return prompt
     except HTTPException:
         raise
     except Exception as e:
-        import traceback
-        error_details = {
-            "error_type": type(e).__name__,
-            "error_message": str(e),
-            "traceback": traceback.format_exc().split('\n')[-5:],  # 最後の5行のみ
-            "device_id": device_id,
-            "search_date": search_date,
-            "processing_step": processing_log.get("processing_steps", [])[-1] if processing_log.get("processing_steps") else "初期化前"
-        }
-        
-        # エラーログを出力
-        print(f"❌ ERROR in analyze_vibegraph_supabase: {error_details}")
-        
+        print(f"❌ プロンプト取得失敗: {e}")
         raise HTTPException(
-            status_code=500, 
-            detail={
-                "message": "Supabase統合心理グラフ(VibeGraph)処理中にエラーが発生しました",
-                "error_details": error_details
-            }
+            status_code=500,
+            detail=f"プロンプト取得エラー: {str(e)}"
+        )
+
+def build_audio_scorer_row(
+    device_id: str,
+    date: str,
+    time_block: str,
+    analysis_result: Dict[str, Any],
+    analyzed_at: Optional[str] = None
+) -> Dict[str, Any]:
+    """audio_scorerテーブルに保存する1行（analyzed_at省略時は現在時刻）"""
+    return {
+        'device_id': device_id,
+        'date': date,
+        'time_block': time_block,
+        **TimeBlockResult.decode(analysis_result).columns(),
+        'vibe_scorer_result': analysis_result,  # JSONB型として保存
+        'vibe_analyzed_at': analyzed_at or datetime.now().isoformat(),
+        'updated_at': datetime.now().isoformat()
+    }
+
+async def remember_result(
+    endpoint: str,
+    device_id: str,
+    date: str,
+    time_block: Optional[str],
+    prompt: str,
+    analysis_result: Dict[str, Any],
+    model_used: Optional[str]
+) -> Optional[str]:
+    """
+    LLMの分析結果をSupabaseへの保存前にローカルの結果ストアに追記し、レコードIDを返す
+
+    JSON解析に失敗した結果は保存しない。追記に失敗しても分析は続行する。
+    ファイル操作（ロック待ち・compact を含む）はイベントループを止めないようスレッドで実行する。
+    """
+    if "processing_error" in analysis_result:
+        return None
+    try:
+        return await asyncio.to_thread(
+            result_store.append_result,
+            endpoint, device_id, date, time_block, prompt_hash(prompt), analysis_result, model_used
+        )
+    except Exception as e:
+        print(f"⚠️ 分析結果のローカル保存に失敗しました: {e}")
+        return None
+
+async def find_unsaved_result(
+    endpoint: str,
+    device_id: str,
+    date: str,
+    time_block: Optional[str],
+    prompt: str
+) -> Optional[Dict[str, Any]]:
+    """同じプロンプトの分析結果がSupabase未保存のまま残っていれば返す（LLMを呼ばずに再利用する）"""
+    try:
+        return await asyncio.to_thread(
+            result_store.find_unsaved, endpoint, device_id, date, time_block, prompt_hash(prompt)
+        )
+    except Exception as e:
+        print(f"⚠️ ローカルの分析結果の参照に失敗しました: {e}")
+        return None
+
+async def mark_results_saved(record_ids: List[Optional[str]]) -> None:
+    """Supabaseへの保存が完了した結果を結果ストアに記録"""
+    try:
+        await asyncio.to_thread(result_store.mark_saved, record_ids)
+    except Exception as e:
+        print(f"⚠️ 結果ストアへの保存完了の記録に失敗しました: {e}")
+
+async def save_timeblock_result(
+    supabase: SupabaseClient,
+    device_id: str,
+    date: str,
+    time_block: str,
+    analysis_result: Dict[str, Any],
+    processing_log: Optional[Dict[str, Any]] = None
+) -> bool:
+    """audio_scorerテーブルに分析結果を保存（UPSERT）。失敗時はFalseを返す"""
+    audio_scorer_data = build_audio_scorer_row(device_id, date, time_block, analysis_result)
+
+    print("💾 audio_scorerテーブルに保存中...")
+    try:
+        with stage_timer(processing_log, "db_save"):
+            supabase.client.table('audio_scorer').upsert(audio_scorer_data).execute()
+        print(f"✅ audio_scorerテーブルへの保存完了")
+        return True
+    except Exception as e:
+        print(f"❌ audio_scorerテーブルへの保存失敗: {e}")
+        # 保存に失敗してもレスポンスは返す
+        return False
+
+async def analyze_timeblock_prompt(
+    prompt: str,
+    processing_log: Dict[str, Any],
+    priority: str = DEFAULT_TIMEBLOCK_PRIORITY,
+    tiered: bool = False,
+    overrides: Optional[Dict[str, Any]] = None,
+    device_id: Optional[str] = None
+) -> Tuple[Dict[str, Any], str]:
+    """
+    タイムブロック1件をLLMで分析し、(分析結果, 使用モデル) を返す
+
+    tiered の場合はまず高速モデルで分析し、結果の判定（JSON・必須項目・スコアの極端さ）を
+    通過すればそのまま採用する。通過しない場合は推論モデルで分析し直す。
+    """
+    generation = generation_policy.select("timeblock", len(prompt), overrides=overrides)
+    if tiered:
+        reasons = precheck_prompt(prompt)
+        fast_model = f"{FAST_PROVIDER}/{FAST_MODEL}"
+        if not reasons:
+            print(f"⚡ 高速モデルで一次判定中... ({fast_model})")
+            fast_log: Dict[str, Any] = {}
+            with stage_timer(processing_log, "fast_pass"):
+                try:
+                    fast_result = await call_llm_with_retry(
+                        prompt, fast_log, priority, llm=get_fast_llm(), generation=fast_generation_settings(),
+                        device_id=device_id
+                    )
+                    reasons = check_fast_result(fast_result)
+                except Exception as e:
+                    print(f"⚠️ 高速モデルの呼び出しに失敗しました: {e}")
+                    reasons = ["fast_model_error"]
+
+            if not reasons:
+                tiered_scoring_stats.record(accepted=True)
+                processing_log["tiered"] = {"model": fast_model, "escalated": False, "llm_usage": fast_log.get("llm_usage")}
+                print(f"✅ 高速モデルの結果を採用")
+                return fast_result, fast_model
+
+        tiered_scoring_stats.record(accepted=False, reasons=reasons)
+        processing_log["tiered"] = {"model": fast_model, "escalated": True, "reasons": reasons}
+        print(f"⤴️ 推論モデルで分析します: {', '.join(reasons)}")
+
+    # LLM処理（プロバイダー抽象化）
+    print(f"📤 LLMに送信中... ({CURRENT_PROVIDER}/{CURRENT_MODEL})")
+    analysis_result = await call_llm_with_retry(
+        prompt, processing_log, priority, generation=generation, device_id=device_id, schema="timeblock"
+    )
+    print(f"✅ LLM処理完了")
+    return analysis_result, f"{CURRENT_PROVIDER}/{CURRENT_MODEL}"
+
+async def run_timeblock_analysis(
+    supabase: SupabaseClient,
+    device_id: str,
+    date: str,
+    time_block: str,
+    prompt: str,
+    processing_log: Dict[str, Any],
+    priority: str = DEFAULT_TIMEBLOCK_PRIORITY,
+    tiered: Optional[bool] = None,
+    overrides: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    タイムブロック1件のLLM分析と保存を行い、レスポンス本体を返す（tiered省略時は TIERED_SCORING）
+
+    分析結果は保存前に結果ストアに追記する。同じプロンプトの結果が未保存のまま残っていれば
+    LLMを呼ばずにその結果を保存し直す。
+    """
+    stored = await find_unsaved_result("timeblock", device_id, date, time_block, prompt)
+    if stored:
+        print(f"♻️ 未保存の分析結果を再利用します（LLM呼び出しなし）: {stored['created_at']}")
+        analysis_result, model_used, record_id = stored["analysis_result"], stored["model_used"], stored["id"]
+        processing_log["reused_result"] = {"record_id": record_id, "created_at": stored["created_at"]}
+    else:
+        analysis_result, model_used = await analyze_timeblock_prompt(
+            prompt, processing_log, priority, TIERED_SCORING if tiered is None else tiered, overrides, device_id
         )
+        record_id = await remember_result("timeblock", device_id, date, time_block, prompt, analysis_result, model_used)
+
+    # 結果をターミナルに表示
+    with stage_timer(processing_log, "pretty_print"):
+        print_analysis_result(analysis_result)
+
+    # audio_scorerテーブルに保存（UPSERT）
+    save_success = await save_timeblock_result(supabase, device_id, date, time_block, analysis_result, processing_log)
+    if save_success:
+        await mark_results_saved([record_id])
+    processing_log["end_time"] = datetime.now().isoformat()
+
+    return {
+        "status": "success" if save_success else "partial_success",
+        "message": "タイムブロック分析が完了しました" + ("（DB保存成功）" if save_success else "（DB保存失敗）"),
+        "device_id": device_id,
+        "date": date,
+        "time_block": time_block,
+        "analysis_result": analysis_result,
+        "database_save": save_success,
+        "processed_at": datetime.now().isoformat(),
+        "model_used": model_used,
+        "processing_log": processing_log
+    }
 
 @app.post("/analyze-timeblock")
-async def analyze_timeblock(request: TimeBlockAnalysisRequest):
+async def analyze_timeblock(
+    request: TimeBlockAnalysisRequest,
+    http_request: Request,
+    fields: Optional[str] = None,
+    verbose: bool = True,
+    x_request_timeout: Optional[str] = Header(None),
+    x_request_deadline: Optional[str] = Header(None)
+):
     """
     タイムブロック単位の分析処理 + audio_scorerテーブルへの保存
+
+    同じ (device_id, date, time_block) かつ同じプロンプトの分析が実行中の場合は、
+    新たにLLMを呼び出さず実行中の分析結果を共有する（DB保存も1回のみ）。
+
+    混雑時に期限（ADMISSION_DEADLINE_SECONDS）内に完了できないと推定された場合は、
+    プロンプト取得・LLM呼び出しを行わずに 503（Retry-After付き）を返す。
+
+    呼び出し元の期限（X-Request-Timeout / X-Request-Deadline）を過ぎた場合は 504、クライアントが
+    切断した場合は 499 とし、実行中のLLM呼び出し・DB保存をキャンセルする。
+    persist_anyway の場合はキャンセルせず、期限になったら 202 を返して分析・保存を継続する。
+
+    - fields: 返すトップレベル項目（カンマ区切り、例: "status,database_save"）
+    - verbose: falseの場合、analysis_result・processing_logを省略
     """
+    ticket = None
+    completed = False
     try:
         print(f"\n🔍 タイムブロック分析開始")
         print(f"  - Device ID: {request.device_id}")
         print(f"  - Date: {request.date}")
         print(f"  - Time Block: {request.time_block}")
 
+        priority = resolve_priority(request.priority, DEFAULT_TIMEBLOCK_PRIORITY)
+        overrides = resolve_generation_overrides(request)
+        processing_log = {
+            "start_time": datetime.now().isoformat(),
+            "mode": "timeblock",
+            "priority": priority
+        }
+
+        deadline = resolve_deadline(x_request_timeout, x_request_deadline)
+
+        # 受付制御（期限内に完了できない場合はここで503）
+        ticket = admit_request("timeblock", priority, processing_log, None if request.persist_anyway else deadline)
+
         # Supabaseクライアントの取得
         supabase = get_supabase_client()
 
-        # audio_aggregatorテーブルからプロンプトを取得
-        print("📥 audio_aggregatorテーブルからプロンプト取得中...")
-        try:
-            result = supabase.client.table('audio_aggregator').select('vibe_aggregator_result').eq('device_id', request.device_id).eq('date', request.date).execute()
+        async def analyze() -> Tuple[Dict[str, Any], bool]:
+            # audio_aggregatorテーブルからプロンプトを取得
+            prompt = await fetch_timeblock_prompt(
+                supabase, request.device_id, request.date, request.time_block, processing_log
+            )
 
-            if not result.data or len(result.data) == 0:
-                raise HTTPException(
-                    status_code=404,
-                    detail=f"audio_aggregatorにデータが見つかりません: device_id={request.device_id}, date={request.date}"
-                )
-
-            prompt = result.data[0].get('vibe_aggregator_result')
-            if not prompt:
-                raise HTTPException(
-                    status_code=404,
-                    detail=f"vibe_aggregator_resultが空です: device_id={request.device_id}, date={request.date}"
-                )
-
-            print(f"  ✅ プロンプト取得完了: {len(prompt)} chars")
-        except HTTPException:
-            raise
-        except Exception as e:
-            print(f"❌ プロンプト取得失敗: {e}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"プロンプト取得エラー: {str(e)}"
+            # 分析対象 + プロンプトハッシュで重複リクエストを集約
+            flight_key = ("timeblock", request.device_id, request.date, request.time_block, prompt_hash(prompt))
+            return await analysis_flights.run(
+                flight_key,
+                lambda: run_timeblock_analysis(
+                    supabase, request.device_id, request.date, request.time_block, prompt, processing_log, priority,
+                    request.tiered, overrides
+                ),
+                persist=request.persist_anyway
             )
 
-        # LLM処理（プロバイダー抽象化）
-        print(f"📤 LLMに送信中... ({CURRENT_PROVIDER}/{CURRENT_MODEL})")
-        analysis_result = await call_llm_with_retry(prompt)
-        print(f"✅ LLM処理完了")
-        
-        # 結果をターミナルに表示
-        print("\n" + "="*60)
-        print("📊 分析結果:")
-        print("="*60)
-        print(json.dumps(analysis_result, ensure_ascii=False, indent=2))
-        print("="*60 + "\n")
-
-        # audio_scorerテーブルへの保存用データを準備
-        audio_scorer_data = {
-            'device_id': request.device_id,
-            'date': request.date,
-            'time_block': request.time_block,
-            'vibe_summary': analysis_result.get('summary'),
-            'vibe_behavior': analysis_result.get('behavior'),
-            'vibe_score': analysis_result.get('vibe_score'),
-            'vibe_scorer_result': analysis_result,  # JSONB型として保存
-            'vibe_analyzed_at': datetime.now().isoformat(),
-            'updated_at': datetime.now().isoformat()
-        }
+        # 期限・クライアント切断を監視しながら分析
+        response, coalesced = await run_guarded(analyze(), http_request.receive, deadline, request.persist_anyway)
+        if coalesced:
+            print(f"🔁 実行中の同一タイムブロック分析の結果を共有しました")
 
-        # audio_scorerテーブルに保存（UPSERT）
-        print("💾 audio_scorerテーブルに保存中...")
-        try:
-            result = supabase.client.table('audio_scorer').upsert(audio_scorer_data).execute()
-            print(f"✅ audio_scorerテーブルへの保存完了")
-            save_success = True
-        except Exception as e:
-            print(f"❌ audio_scorerテーブルへの保存失敗: {e}")
-            save_success = False
-            # 保存に失敗してもレスポンスは返す
-        
-        return {
-            "status": "success" if save_success else "partial_success",
-            "message": "タイムブロック分析が完了しました" + ("（DB保存成功）" if save_success else "（DB保存失敗）"),
-            "device_id": request.device_id,
-            "date": request.date,
-            "time_block": request.time_block,
-            "analysis_result": analysis_result,
-            "database_save": save_success,
-            "processed_at": datetime.now().isoformat(),
-            "model_used": f"{CURRENT_PROVIDER}/{CURRENT_MODEL}"
-        }
+        completed = True
+        return render_response({**response, "coalesced": coalesced}, fields, verbose)
         
     except HTTPException:
         raise
+    except RequestAbandoned as e:
+        if e.task is None:
+            raise abandoned_error(e, processing_log)
+        response = persisting_response(
+            e, ticket, processing_log, device_id=request.device_id, date=request.date, time_block=request.time_block
+        )
+        ticket = None
+        return response
     except Exception as e:
         import traceback
         error_details = {
@@ -494,13 +1118,613 @@ async def analyze_timeblock(request: TimeBlockAnalysisRequest):
                 "error_details": error_details
             }
         )
+    finally:
+        if ticket is not None:
+            release_request(ticket, processing_log, completed)
+
+async def run_packed_timeblock_chunk(
+    supabase: SupabaseClient,
+    device_id: str,
+    date: str,
+    block_prompts: List[tuple],
+    priority: str,
+    overrides: Optional[Dict[str, Any]] = None
+) -> List[Dict[str, Any]]:
+    """
+    隣接するタイムブロック（最大 pack_size 件）を1回のLLM呼び出しで分析し、ブロックごとに保存する
+
+    応答に含まれたブロックの結果は、欠けている・不正な項目だけをブロックのプロンプトで修復する（repair_result）。
+    応答に含まれなかったブロック（応答全体を解析できない場合は全ブロック）は、ブロック単位の通常の分析にフォールバックする。
+    同じプロンプトの結果が未保存のまま残っているブロックは、まとめずにその結果を保存し直す。
+    """
+    time_blocks = [time_block for time_block, _ in block_prompts]
+    processing_log = {
+        "start_time": datetime.now().isoformat(),
+        "mode": "timeblock_packed",
+        "priority": priority,
+        "time_blocks": time_blocks
+    }
+
+    reusable = {
+        time_block for time_block, prompt in block_prompts
+        if await find_unsaved_result("timeblock", device_id, date, time_block, prompt)
+    }
+    pack_prompts = [(time_block, prompt) for time_block, prompt in block_prompts if time_block not in reusable]
+    pack_blocks = [time_block for time_block, _ in pack_prompts]
+    model_used = f"{CURRENT_PROVIDER}/{CURRENT_MODEL}"
+
+    block_results = None
+    fallback_blocks: List[str] = []
+    if len(pack_prompts) > 1:
+        try:
+            with stage_timer(processing_log, "build_prompt"):
+                packed_prompt = build_packed_prompt(pack_prompts)
+            print(f"📤 LLMに送信中（{len(pack_blocks)}ブロックまとめ）: {', '.join(pack_blocks)}")
+            generation = generation_policy.select(
+                "timeblock_packed", len(packed_prompt), expected_items=len(pack_blocks), overrides=overrides
+            )
+            packed_result = await call_llm_with_retry(
+                packed_prompt, processing_log, priority, generation=generation, device_id=device_id
+            )
+            block_results, fallback_blocks = split_packed_result(packed_result, pack_blocks)
+            if fallback_blocks:
+                print(f"⚠️ まとめ分析の応答にないブロックはブロック単位で再分析します: {', '.join(fallback_blocks)}")
+                processing_log["fallback_reason"] = f"応答に含まれないタイムブロック: {', '.join(fallback_blocks)}"
+            if RESULT_REPAIR:
+                block_results = await repair_packed_results(
+                    block_results, dict(pack_prompts), processing_log, priority, device_id
+                )
+        except PackedResponseError as e:
+            print(f"⚠️ まとめ分析の応答を分割できませんでした。ブロック単位で再分析します: {e}")
+            processing_log["fallback_reason"] = str(e)
+        except Exception as e:
+            print(f"⚠️ まとめ分析に失敗しました。ブロック単位で再分析します: {e}")
+            processing_log["fallback_reason"] = f"{type(e).__name__}: {e}"
+
+    results = []
+    single_prompts = block_prompts
+    if block_results is not None:
+        for time_block, prompt in pack_prompts:
+            if time_block not in block_results:
+                continue
+            record_id = await remember_result(
+                "timeblock", device_id, date, time_block, prompt, block_results[time_block], model_used
+            )
+            save_success = await save_timeblock_result(
+                supabase, device_id, date, time_block, block_results[time_block], processing_log
+            )
+            if save_success:
+                await mark_results_saved([record_id])
+            results.append({
+                "time_block": time_block,
+                "status": "success" if save_success else "partial_success",
+                "mode": "packed",
+                "database_save": save_success,
+                "analysis_result": block_results[time_block]
+            })
+        processing_log["end_time"] = datetime.now().isoformat()
+        results[0]["processing_log"] = processing_log
+        single_prompts = [
+            (time_block, prompt) for time_block, prompt in block_prompts
+            if time_block in reusable or time_block in fallback_blocks
+        ]
+
+    # ブロック単位の通常の分析（同一ブロックの実行中の分析とは集約する）
+    # 未保存の結果が残っているブロックはその結果を再利用し、まとめ分析に失敗した場合はフォールバックとして実行する
+    for time_block, prompt in single_prompts:
+        block_log = {
+            "start_time": datetime.now().isoformat(),
+            "mode": "timeblock",
+            "priority": priority
+        }
+        try:
+            response, _ = await analysis_flights.run(
+                ("timeblock", device_id, date, time_block, prompt_hash(prompt)),
+                lambda time_block=time_block, prompt=prompt, block_log=block_log: run_timeblock_analysis(
+                    supabase, device_id, date, time_block, prompt, block_log, priority, overrides=overrides
+                )
+            )
+            if "reused_result" in response["processing_log"]:
+                mode = "reused"
+            elif (block_results is None and len(pack_prompts) > 1) or time_block in fallback_blocks:
+                mode = "fallback"
+            else:
+                mode = "single"
+            results.append({
+                "time_block": time_block,
+                "status": response["status"],
+                "mode": mode,
+                "database_save": response["database_save"],
+                "analysis_result": response["analysis_result"],
+                "processing_log": response["processing_log"]
+            })
+        except Exception as e:
+            print(f"❌ タイムブロック分析失敗: {time_block}: {e}")
+            results.append({"time_block": time_block, "status": "llm_error", "error": str(e)})
+    if block_results is None and len(pack_prompts) > 1:
+        results[0].setdefault("packed_processing_log", processing_log)
+    return results
+
+async def repair_packed_results(
+    block_results: Dict[str, Dict[str, Any]],
+    block_prompts: Dict[str, str],
+    processing_log: Dict[str, Any],
+    priority: str,
+    device_id: str
+) -> Dict[str, Dict[str, Any]]:
+    """
+    まとめ分析のブロックごとの結果を検証し、問題のあるブロックだけをそのブロックのプロンプトで修復する
+
+    修復の記録は processing_log["repairs"][time_block] に残す。
+    """
+    llm = get_current_llm()
+    schema = RESULT_SCHEMAS["timeblock"]
+    failing = [time_block for time_block, result in block_results.items() if schema.problems(result)]
+    if not failing:
+        return block_results
+
+    repair_logs = {time_block: {} for time_block in failing}
+    repaired = await asyncio.gather(*(
+        repair_result(
+            "timeblock", block_prompts[time_block], block_results[time_block],
+            repair_logs[time_block], priority, llm, device_id
+        )
+        for time_block in failing
+    ))
+    processing_log["repairs"] = {time_block: log.get("repair") for time_block, log in repair_logs.items()}
+    return {**block_results, **dict(zip(failing, repaired))}
+
+async def score_stream_line(number: int, line: str, default_priority: str) -> Dict[str, Any]:
+    """NDJSONストリーミング分析の1行（TimeBlockAnalysisRequest と同じ項目）を分析し、結果の1行を返す"""
+    try:
+        target = TimeBlockAnalysisRequest.model_validate_json(line)
+    except ValueError as e:
+        return {"line": number, "status": "error", "status_code": 400, "error": f"不正な行です: {e}"}
+
+    identity = {"line": number, "device_id": target.device_id, "date": target.date, "time_block": target.time_block}
+    try:
+        priority = resolve_priority(target.priority, default_priority)
+        overrides = resolve_generation_overrides(target)
+        processing_log = {
+            "start_time": datetime.now().isoformat(),
+            "mode": "stream",
+            "priority": priority
+        }
+        supabase = get_supabase_client()
+        prompt = await fetch_timeblock_prompt(supabase, target.device_id, target.date, target.time_block, processing_log)
+        response, coalesced = await analysis_flights.run(
+            ("timeblock", target.device_id, target.date, target.time_block, prompt_hash(prompt)),
+            lambda: run_timeblock_analysis(
+                supabase, target.device_id, target.date, target.time_block, prompt, processing_log, priority,
+                target.tiered, overrides
+            )
+        )
+        return {**identity, **response, "coalesced": coalesced}
+    except HTTPException as e:
+        return {**identity, "status": "error", "status_code": e.status_code, "error": e.detail}
+
+@app.post("/analyze-timeblocks/stream")
+async def analyze_timeblocks_stream(
+    request: Request,
+    priority: Optional[str] = None,
+    concurrency: Optional[int] = None,
+    fields: Optional[str] = None,
+    verbose: bool = False
+):
+    """
+    NDJSONストリーミングのタイムブロック分析 + audio_scorerテーブルへの保存
+
+    リクエストボディは1行1件の分析対象（{"device_id", "date", "time_block", ...}）のNDJSON。
+    行が届いた順に分析を始め、完了した順に結果を1行ずつNDJSONで返し、最後に件数の集計（"done": true）を返す。
+    同時に分析するのは concurrency 件までで、結果が読み取られるまで次の行は読み込まないため、
+    対象が何件あってもメモリ使用量は一定。
+
+    - priority: 行で指定がない場合の優先度（デフォルト: scheduled）
+    - fields / verbose: 各行の結果の項目（デフォルトは analysis_result・processing_log を省略）
+    """
+    default_priority = resolve_priority(priority, DEFAULT_TIMEBLOCK_PRIORITY)
+    limit = min(concurrency or STREAM_CONCURRENCY, LLM_MAX_CONCURRENCY * 2)
+    print(f"\n🌊 NDJSONストリーミング分析開始（同時実行数 {limit}）")
+
+    async def handle(number: int, line: str) -> Dict[str, Any]:
+        result = await score_stream_line(number, line, default_priority)
+        return {"line": number, **shape_response(result, fields, verbose)}
+
+    return NDJSONStreamingResponse(process_lines(iter_lines(request.stream()), handle, limit))
+
+@app.post("/analyze-timeblocks/packed")
+async def analyze_timeblocks_packed(
+    request: PackedTimeBlockAnalysisRequest,
+    fields: Optional[str] = None,
+    verbose: bool = True
+):
+    """
+    複数タイムブロックのまとめ分析 + audio_scorerテーブルへの保存
+
+    隣接するタイムブロックを pack_size 件ずつ1回のLLM呼び出しにまとめ、
+    タイムブロックをキーにしたJSONで結果を受け取ってブロックごとに保存する。
+    応答が不正な場合はそのまとまりだけブロック単位の分析にフォールバックする。
+
+    - fields: 返すトップレベル項目（カンマ区切り、例: "status,summary"）
+    - verbose: falseの場合、ブロックごとの結果（results・summary）を省略
+    """
+    if not request.time_blocks:
+        raise HTTPException(status_code=400, detail="time_blocksが空です")
+
+    priority = resolve_priority(request.priority, DEFAULT_TIMEBLOCK_PRIORITY)
+    overrides = resolve_generation_overrides(request)
+    pack_size = request.pack_size or TIMEBLOCK_PACK_SIZE
+    chunks = chunk_time_blocks(request.time_blocks, pack_size)
+
+    print(f"\n🔍 タイムブロックまとめ分析開始")
+    print(f"  - Device ID: {request.device_id}")
+    print(f"  - Date: {request.date}")
+    print(f"  - Time Blocks: {sum(len(chunk) for chunk in chunks)}件（{len(chunks)}回に分けて分析）")
+
+    supabase = get_supabase_client()
+
+    async def analyze_chunk(chunk: List[str]) -> List[Dict[str, Any]]:
+        block_prompts = []
+        results = []
+        for time_block in chunk:
+            try:
+                prompt = await fetch_timeblock_prompt(supabase, request.device_id, request.date, time_block)
+                block_prompts.append((time_block, prompt))
+            except HTTPException as e:
+                results.append({"time_block": time_block, "status": "prompt_not_found", "error": str(e.detail)})
+        if block_prompts:
+            results.extend(await run_packed_timeblock_chunk(
+                supabase, request.device_id, request.date, block_prompts, priority, overrides
+            ))
+        return results
+
+    # まとまりごとに並行して分析（同時実行数は優先度レーンの実行枠で制限される）
+    chunk_results = await asyncio.gather(*(analyze_chunk(chunk) for chunk in chunks))
+    results = sorted((r for chunk in chunk_results for r in chunk), key=lambda r: r["time_block"])
+
+    summary = {}
+    for result in results:
+        key = result.get("mode", result["status"])
+        summary[key] = summary.get(key, 0) + 1
+    saved = sum(1 for result in results if result.get("database_save"))
+
+    return render_response({
+        "status": "success" if saved == len(results) else ("partial_success" if saved else "failed"),
+        "device_id": request.device_id,
+        "date": request.date,
+        "pack_size": max(1, min(pack_size, max(len(chunk) for chunk in chunks))),
+        "saved": saved,
+        "total": len(results),
+        "summary": summary,
+        "results": results,
+        "processed_at": datetime.now().isoformat(),
+        "model_used": f"{CURRENT_PROVIDER}/{CURRENT_MODEL}"
+    }, fields, verbose)
+
+def build_dashboard_prompt_text(prompt_data: Any) -> str:
+    """dashboard_summary.prompt（JSONB）をLLMに渡す文字列に変換"""
+    # promptがJSONBの場合、文字列に変換
+    if isinstance(prompt_data, dict):
+        # promptがJSON形式の場合、適切に文字列化
+        if 'content' in prompt_data:
+            return prompt_data['content']
+        elif 'text' in prompt_data:
+            return prompt_data['text']
+        else:
+            # JSON全体を文字列として使用
+            return json.dumps(prompt_data, ensure_ascii=False, indent=2)
+    elif isinstance(prompt_data, list):
+        # リスト形式の場合、結合
+        return "\n".join([str(item) for item in prompt_data])
+    else:
+        return str(prompt_data)
+
+def extract_dashboard_fields(analysis_result: Dict[str, Any]) -> Dict[str, Any]:
+    """analysis_resultからdashboard_summaryの個別カラムに保存する値を抽出"""
+    fields = DashboardSummaryResult.decode(analysis_result).columns()
+    
+    # cumulative_evaluationをinsightsとして保存（iOSアプリではこれをインサイトサマリーとして使用）
+    if 'cumulative_evaluation' in analysis_result:
+        print(f"📝 cumulative_evaluation検出: insightsカラムに保存")
+    
+    if 'burst_events' in analysis_result:
+        burst_events = fields["burst_events"]
+        print(f"📊 burst_events検出: {len(burst_events) if burst_events else 0}個のイベント")
+    
+    return fields
+
+async def run_dashboard_summary_analysis(
+    supabase: SupabaseClient,
+    device_id: str,
+    target_date: str,
+    prompt_text: str,
+    processing_log: Dict[str, Any],
+    priority: str = DEFAULT_DASHBOARD_PRIORITY,
+    incremental_state: Optional[Dict[str, Any]] = None,
+    overrides: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    Dashboard SummaryのLLM分析と保存を行い、レスポンス本体を返す
+
+    incremental_state を渡すと dashboard_summary.incremental_state に保存し、次回の差分更新の基準にする。
+    分析結果は保存前に結果ストアに追記し、同じプロンプトの結果が未保存のまま残っていれば再利用する。
+    """
+    stored = await find_unsaved_result("dashboard_summary", device_id, target_date, None, prompt_text)
+    if stored:
+        print(f"♻️ 未保存の分析結果を再利用します（LLM呼び出しなし）: {stored['created_at']}")
+        analysis_result, record_id = stored["analysis_result"], stored["id"]
+        processing_log["reused_result"] = {"record_id": record_id, "created_at": stored["created_at"]}
+        processing_log["processing_steps"].append("未保存の分析結果を再利用")
+    else:
+        # 2) LLM処理（リトライ付き）
+        print(f"📤 LLMに送信中... ({CURRENT_PROVIDER}/{CURRENT_MODEL})")
+        generation = generation_policy.select("dashboard_summary", len(prompt_text), overrides=overrides)
+        analysis_result = await call_llm_with_retry(
+            prompt_text, processing_log, priority, generation=generation, device_id=device_id,
+            schema="dashboard_summary"
+        )
+        processing_log["processing_steps"].append("LLM処理完了")
+        print(f"✅ LLM処理完了")
+
+        record_id = await remember_result(
+            "dashboard_summary", device_id, target_date, None, prompt_text, analysis_result,
+            f"{CURRENT_PROVIDER}/{CURRENT_MODEL}"
+        )
+    
+    # 結果をターミナルに表示
+    with stage_timer(processing_log, "pretty_print"):
+        print_analysis_result(analysis_result)
+    
+    # 3) analysis_resultから情報を抽出（オプション）
+    with stage_timer(processing_log, "field_extraction"):
+        fields = extract_dashboard_fields(analysis_result)
+    
+    # 4) dashboard_summaryテーブルのanalysis_resultフィールドを更新
+    # （サニタイズ処理を含む。保存に失敗しても分析結果はレスポンスと結果ストアに残す）
+    print("💾 dashboard_summaryテーブルに保存中...")
+    try:
+        with stage_timer(processing_log, "db_save"):
+            save_success = await supabase.update_dashboard_summary_analysis(
+                device_id=device_id,
+                target_date=target_date,
+                analysis_result=analysis_result,
+                incremental_state=None if "processing_error" in analysis_result else incremental_state,
+                **fields
+            )
+    except Exception as e:
+        print(f"❌ dashboard_summaryテーブルへの保存エラー: {e}")
+        save_success = False
+    
+    if save_success:
+        await mark_results_saved([record_id])
+        processing_log["processing_steps"].append("dashboard_summaryテーブルへの保存完了")
+        print(f"✅ dashboard_summaryテーブルへの保存完了")
+        final_status = "success"
+    else:
+        processing_log["processing_steps"].append("dashboard_summaryテーブルへの保存失敗")
+        processing_log["warnings"].append("データベースへの保存に失敗しました")
+        print(f"❌ dashboard_summaryテーブルへの保存失敗")
+        final_status = "failed"
+    
+    processing_log["end_time"] = datetime.now().isoformat()
+    
+    return {
+        "status": final_status,
+        "message": "Dashboard Summary分析が完了しました" if final_status == "success" else "処理中にエラーが発生しました",
+        "device_id": device_id,
+        "date": target_date,
+        "update_mode": processing_log.get("incremental", {}).get("decision", "full"),
+        "database_save": save_success,
+        "processed_at": datetime.now().isoformat(),
+        "model_used": f"{CURRENT_PROVIDER}/{CURRENT_MODEL}",
+        "processing_log": processing_log,
+        "analysis_result": analysis_result
+    }
+
+async def score_changed_block(row: Dict[str, Any]) -> Dict[str, Any]:
+    """変更フィードで受け取ったaudio_aggregatorの行1件をタイムブロック分析する"""
+    device_id, date, time_block = row["device_id"], row["date"], row["time_block"]
+    print(f"\n🛰️ 変更フィードからタイムブロック分析: {device_id} {date} {time_block}")
+    processing_log = {
+        "start_time": datetime.now().isoformat(),
+        "mode": "change_feed",
+        "priority": DEFAULT_TIMEBLOCK_PRIORITY
+    }
+
+    supabase = get_supabase_client()
+    prompt = row.get('vibe_aggregator_result') or await fetch_timeblock_prompt(
+        supabase, device_id, date, time_block, processing_log
+    )
+
+    # HTTP経由の同一タイムブロックの分析とも集約する
+    response, _ = await analysis_flights.run(
+        ("timeblock", device_id, date, time_block, prompt_hash(prompt)),
+        lambda: run_timeblock_analysis(
+            supabase, device_id, date, time_block, prompt, processing_log, DEFAULT_TIMEBLOCK_PRIORITY
+        )
+    )
+    return response
+
+def create_shard_coordinator() -> Optional[ShardCoordinator]:
+    """シャードの分担を作成（SHARDING=false の場合はNone = 全てのdevice_idを担当）"""
+    if not SHARDING:
+        return None
+    if SHARD_BACKEND == "file":
+        return ShardCoordinator(FileLeaseBackend())
+    return ShardCoordinator(SupabaseLeaseBackend(get_supabase_client))
+
+def create_change_feed_worker(
+    source: Optional[ChangeSource] = None,
+    coordinator: Optional[ShardCoordinator] = None
+) -> ChangeFeedWorker:
+    """
+    変更フィードワーカーを作成（取得元の指定がなければaudio_aggregatorをカーソルでポーリング）
+
+    coordinator を指定した場合は担当シャードのdevice_idのみ分析し、
+    シャードを引き継いだ際は前の担当インスタンスのチェックポイントから取り込み直す。
+    """
+    worker = ChangeFeedWorker(
+        source or CursorPollingSource(get_supabase_client),
+        score_changed_block,
+        fingerprint=lambda row: prompt_hash(row['vibe_aggregator_result']) if row.get('vibe_aggregator_result') else None,
+        owns=(lambda row: coordinator.owns(row['device_id'])) if coordinator else (lambda row: True)
+    )
+    if coordinator is not None:
+        coordinator.checkpoint = worker.checkpoint
+        coordinator.on_acquire = lambda shard, checkpoint: worker.rewind(checkpoint)
+    return worker
+
+async def run_change_feed(worker: ChangeFeedWorker, coordinator: Optional[ShardCoordinator] = None) -> None:
+    """変更フィードの取り込み（シャーディング有効時は、最初の担当シャードが決まってから取り込みを始める）"""
+    if coordinator is None:
+        await worker.run()
+        return
+    coordinator_task = asyncio.create_task(coordinator.run())
+    try:
+        await coordinator.ready.wait()
+        await worker.run()
+    finally:
+        coordinator_task.cancel()
+
+async def fetch_scored_blocks(
+    supabase: SupabaseClient,
+    device_id: str,
+    date: str,
+    processing_log: Optional[Dict[str, Any]] = None
+) -> List[Dict[str, Any]]:
+    """audio_scorerテーブルから1日分のタイムブロックのスコアを取得"""
+    with stage_timer(processing_log, "fetch_scored_blocks"):
+        result = supabase.client.table('audio_scorer').select('time_block, vibe_score').eq('device_id', device_id).eq('date', date).execute()
+    return result.data or []
+
+async def run_dashboard_summary_refresh(
+    supabase: SupabaseClient,
+    device_id: str,
+    target_date: str,
+    dashboard_data: Dict[str, Any],
+    prompt_text: str,
+    processing_log: Dict[str, Any],
+    priority: str = DEFAULT_DASHBOARD_PRIORITY,
+    overrides: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    Dashboard Summaryの差分更新
+
+    audio_scorerのスコアから数値項目（vibe_scores・average_vibe・burst_events）をローカルで再計算し、
+    保存済みの vibe_scores と比べて変化したタイムブロックを検出する。
+    総合評価を生成した時点からの変化が閾値を超えた場合のみLLMで再生成する。
+    前回の基準（incremental_state カラム）がない場合は通常の分析を行う。
+    """
+    rows = await fetch_scored_blocks(supabase, device_id, target_date, processing_log)
+    previous = dashboard_data.get('analysis_result')
+    state = dashboard_data.get('incremental_state')
+
+    with stage_timer(processing_log, "incremental_recompute"):
+        scores = dashboard_incremental.build_vibe_scores(rows)
+        average = dashboard_incremental.average_score(scores)
+        events = dashboard_incremental.detect_burst_events(
+            scores, previous.get('burst_events') if isinstance(previous, dict) else None
+        )
+
+    if not isinstance(state, dict) or not isinstance(previous, dict) or "processing_error" in previous:
+        processing_log["incremental"] = {"decision": "full", "reason": "no_previous_state"}
+        return await run_dashboard_summary_analysis(
+            supabase, device_id, target_date, prompt_text, processing_log, priority,
+            incremental_state=dashboard_incremental.build_incremental_state(scores, events),
+            overrides=overrides
+        )
+
+    basis_scores = dashboard_incremental.stored_vibe_scores(state.get('basis_scores')) or [None] * SLOTS_PER_DAY
+    stored_scores = dashboard_incremental.stored_vibe_scores(dashboard_data.get('vibe_scores')) or basis_scores
+    changed = dashboard_incremental.changed_time_blocks(scores, stored_scores)
+    change = dashboard_incremental.narrative_change(
+        basis_scores,
+        scores,
+        state.get('basis_burst_events') or [],
+        events
+    )
+    processing_log["incremental"] = {"changed_time_blocks": changed, **change}
+    print(f"🧮 差分: 更新ブロック {len(changed)}件 / 総合評価生成時からの変化 {change['changed_slots']}スロット（平均 {change['average_shift']}）")
+
+    # 変化が大きい場合は総合評価をLLMで再生成
+    if change["significant"]:
+        processing_log["incremental"]["decision"] = "narrative_regenerated"
+        print(f"📝 変化が閾値を超えたため総合評価を再生成します: {', '.join(change['reasons'])}")
+        return await run_dashboard_summary_analysis(
+            supabase, device_id, target_date, prompt_text, processing_log, priority,
+            incremental_state=dashboard_incremental.build_incremental_state(scores, events),
+            overrides=overrides
+        )
+
+    if not changed:
+        # 保存済みのスコアから変化がなければ保存済みの結果をそのまま返す
+        processing_log["incremental"]["decision"] = "unchanged"
+        save_success = True
+        analysis_result = previous
+        print("✅ 変化なし（保存済みの結果を返します）")
+    else:
+        # 数値項目のみ更新（総合評価は前回のまま）
+        processing_log["incremental"]["decision"] = "numeric_only"
+        analysis_result = DashboardSummaryResult.decode(previous).with_numeric_fields(scores, average, events)
+
+        print("💾 dashboard_summaryテーブルに保存中（数値項目のみ）...")
+        with stage_timer(processing_log, "db_save"):
+            save_success = await supabase.update_dashboard_summary_analysis(
+                device_id=device_id,
+                target_date=target_date,
+                analysis_result=analysis_result,
+                vibe_scores=scores,
+                average_vibe=average,
+                burst_events=events,
+                incremental_state={**state, "recomputed_at": datetime.now().isoformat()}
+            )
+        if save_success:
+            processing_log["processing_steps"].append("dashboard_summaryテーブルの数値項目を更新")
+        else:
+            processing_log["processing_steps"].append("dashboard_summaryテーブルへの保存失敗")
+            processing_log["warnings"].append("データベースへの保存に失敗しました")
+
+    processing_log["end_time"] = datetime.now().isoformat()
+
+    return {
+        "status": "success" if save_success else "failed",
+        "message": "Dashboard Summaryを差分更新しました" if save_success else "処理中にエラーが発生しました",
+        "device_id": device_id,
+        "date": target_date,
+        "update_mode": processing_log["incremental"]["decision"],
+        "database_save": save_success,
+        "processed_at": datetime.now().isoformat(),
+        "model_used": None,
+        "processing_log": processing_log,
+        "analysis_result": analysis_result
+    }
 
 @app.post("/analyze-dashboard-summary")
-async def analyze_dashboard_summary(request: DashboardSummaryRequest):
+async def analyze_dashboard_summary(
+    request: DashboardSummaryRequest,
+    http_request: Request,
+    fields: Optional[str] = None,
+    verbose: bool = True,
+    x_request_timeout: Optional[str] = Header(None),
+    x_request_deadline: Optional[str] = Header(None)
+):
     """
     dashboard_summaryテーブルのpromptフィールドを使用してChatGPT分析を行い、
     結果をanalysis_resultフィールドに保存
+
+    同じ (device_id, date) かつ同じプロンプトの分析が実行中の場合は、
+    実行中の分析結果を共有する（DB保存も1回のみ）。
+
+    混雑時に期限（ADMISSION_DEADLINE_SECONDS）内に完了できないと推定された場合は、
+    データ取得・LLM呼び出しを行わずに 503（Retry-After付き）を返す。
+
+    呼び出し元の期限・クライアント切断の扱いは /analyze-timeblock と同じ（504 / 499、persist_anyway は 202）。
+
+    - fields: 返すトップレベル項目（カンマ区切り、例: "status,database_save"）
+    - verbose: falseの場合、analysis_result・processing_logを省略
     """
+    ticket = None
+    completed = False
     try:
         device_id = request.device_id
         target_date = request.date
@@ -509,135 +1733,80 @@ async def analyze_dashboard_summary(request: DashboardSummaryRequest):
         print(f"  - Device ID: {device_id}")
         print(f"  - Date: {target_date}")
         
+        priority = resolve_priority(request.priority, DEFAULT_DASHBOARD_PRIORITY)
+        overrides = resolve_generation_overrides(request)
         processing_log = {
             "start_time": datetime.now().isoformat(),
             "mode": "dashboard_summary",
+            "priority": priority,
             "processing_steps": [],
             "warnings": []
         }
+
+        deadline = resolve_deadline(x_request_timeout, x_request_deadline)
+
+        # 受付制御（期限内に完了できない場合はここで503）
+        ticket = admit_request("dashboard_summary", priority, processing_log, None if request.persist_anyway else deadline)
         
         # Supabaseクライアントの取得
         supabase = get_supabase_client()
         
-        # 1) dashboard_summaryテーブルからデータ取得
-        dashboard_data = await supabase.get_dashboard_summary_prompt(device_id, target_date)
-        if dashboard_data is None:
-            raise HTTPException(
-                status_code=404,
-                detail=f"Dashboard summaryデータが見つかりません: device_id={device_id}, date={target_date}"
-            )
-        processing_log["processing_steps"].append("dashboard_summaryからデータ取得完了")
-        
-        # promptフィールドの確認
-        prompt_data = dashboard_data.get('prompt')
-        if not prompt_data:
-            raise HTTPException(
-                status_code=400,
-                detail="dashboard_summaryにpromptデータが存在しません"
-            )
-        
-        # promptがJSONBの場合、文字列に変換
-        if isinstance(prompt_data, dict):
-            # promptがJSON形式の場合、適切に文字列化
-            if 'content' in prompt_data:
-                prompt_text = prompt_data['content']
-            elif 'text' in prompt_data:
-                prompt_text = prompt_data['text']
+        async def analyze() -> Tuple[Dict[str, Any], bool]:
+            # 1) dashboard_summaryテーブルからデータ取得
+            with stage_timer(processing_log, "fetch_prompt"):
+                dashboard_data = await supabase.get_dashboard_summary_prompt(device_id, target_date)
+            if dashboard_data is None:
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"Dashboard summaryデータが見つかりません: device_id={device_id}, date={target_date}"
+                )
+            processing_log["processing_steps"].append("dashboard_summaryからデータ取得完了")
+
+            # promptフィールドの確認
+            prompt_data = dashboard_data.get('prompt')
+            if not prompt_data:
+                raise HTTPException(
+                    status_code=400,
+                    detail="dashboard_summaryにpromptデータが存在しません"
+                )
+
+            with stage_timer(processing_log, "prompt_build"):
+                prompt_text = build_dashboard_prompt_text(prompt_data)
+
+            print(f"  - Prompt length: {len(prompt_text)} chars")
+            processing_log["processing_steps"].append(f"プロンプト準備完了（{len(prompt_text)}文字）")
+
+            # 差分更新（数値項目はローカルで再計算し、総合評価は変化が大きい場合のみ再生成）
+            incremental = DASHBOARD_INCREMENTAL if request.incremental is None else request.incremental
+            if incremental:
+                run_analysis = lambda: run_dashboard_summary_refresh(
+                    supabase, device_id, target_date, dashboard_data, prompt_text, processing_log, priority, overrides
+                )
             else:
-                # JSON全体を文字列として使用
-                prompt_text = json.dumps(prompt_data, ensure_ascii=False, indent=2)
-        elif isinstance(prompt_data, list):
-            # リスト形式の場合、結合
-            prompt_text = "\n".join([str(item) for item in prompt_data])
-        else:
-            prompt_text = str(prompt_data)
-        
-        print(f"  - Prompt length: {len(prompt_text)} chars")
-        processing_log["processing_steps"].append(f"プロンプト準備完了（{len(prompt_text)}文字）")
-        
-        # 2) LLM処理（リトライ付き）
-        print(f"📤 LLMに送信中... ({CURRENT_PROVIDER}/{CURRENT_MODEL})")
-        analysis_result = await call_llm_with_retry(prompt_text)
-        processing_log["processing_steps"].append("LLM処理完了")
-        print(f"✅ LLM処理完了")
-        
-        # 結果をターミナルに表示
-        print("\n" + "="*60)
-        print("📊 分析結果:")
-        print("="*60)
-        print(json.dumps(analysis_result, ensure_ascii=False, indent=2))
-        print("="*60 + "\n")
-        
-        # 3) analysis_resultから情報を抽出（オプション）
-        vibe_scores = None
-        average_vibe = None
-        insights = None
-        burst_events = None  # 追加
-        
-        # emotionScoresやvibeScoresがある場合は抽出
-        if 'emotionScores' in analysis_result:
-            vibe_scores = analysis_result['emotionScores']
-        elif 'vibeScores' in analysis_result:
-            vibe_scores = analysis_result['vibeScores']
-        
-        # averageScoreやaverageVibeがある場合は抽出
-        if 'averageScore' in analysis_result:
-            average_vibe = analysis_result['averageScore']
-        elif 'averageVibe' in analysis_result:
-            average_vibe = analysis_result['averageVibe']
-        
-        # cumulative_evaluationをinsightsとして保存（新規追加）
-        # iOSアプリではこれをインサイトサマリーとして使用
-        if 'cumulative_evaluation' in analysis_result:
-            insights = analysis_result['cumulative_evaluation']
-            print(f"📝 cumulative_evaluation検出: insightsカラムに保存")
-        # 従来のinsightsフィールドも対応（後方互換性）
-        elif 'insights' in analysis_result:
-            insights = analysis_result['insights']
-        
-        # burst_eventsがある場合は抽出（新規追加）
-        if 'burst_events' in analysis_result:
-            burst_events = analysis_result['burst_events']
-            print(f"📊 burst_events検出: {len(burst_events) if burst_events else 0}個のイベント")
-        
-        # 4) dashboard_summaryテーブルのanalysis_resultフィールドを更新
-        print("💾 dashboard_summaryテーブルに保存中...")
-        save_success = await supabase.update_dashboard_summary_analysis(
-            device_id=device_id,
-            target_date=target_date,
-            analysis_result=analysis_result,
-            vibe_scores=vibe_scores,
-            average_vibe=average_vibe,
-            insights=insights,
-            burst_events=burst_events  # 追加
-        )
-        
-        if save_success:
-            processing_log["processing_steps"].append("dashboard_summaryテーブルへの保存完了")
-            print(f"✅ dashboard_summaryテーブルへの保存完了")
-            final_status = "success"
-        else:
-            processing_log["processing_steps"].append("dashboard_summaryテーブルへの保存失敗")
-            processing_log["warnings"].append("データベースへの保存に失敗しました")
-            print(f"❌ dashboard_summaryテーブルへの保存失敗")
-            final_status = "failed"
-        
-        processing_log["end_time"] = datetime.now().isoformat()
+                run_analysis = lambda: run_dashboard_summary_analysis(
+                    supabase, device_id, target_date, prompt_text, processing_log, priority, overrides=overrides
+                )
+
+            # 分析対象 + プロンプトハッシュで重複リクエストを集約
+            flight_key = ("dashboard_summary", device_id, target_date, prompt_hash(prompt_text), incremental)
+            return await analysis_flights.run(flight_key, run_analysis, persist=request.persist_anyway)
+
+        # 期限・クライアント切断を監視しながら分析
+        response, coalesced = await run_guarded(analyze(), http_request.receive, deadline, request.persist_anyway)
+        if coalesced:
+            print(f"🔁 実行中の同一Dashboard Summary分析の結果を共有しました")
         
-        return {
-            "status": final_status,
-            "message": "Dashboard Summary分析が完了しました" if final_status == "success" else "処理中にエラーが発生しました",
-            "device_id": device_id,
-            "date": target_date,
-            "database_save": save_success,
-            "processed_at": datetime.now().isoformat(),
-            "model_used": f"{CURRENT_PROVIDER}/{CURRENT_MODEL}",
-            "processing_log": processing_log,
-            "analysis_result": analysis_result
-        }
+        completed = True
+        return render_response({**response, "coalesced": coalesced}, fields, verbose)
         
     except HTTPException:
         raise
+    except RequestAbandoned as e:
+        if e.task is None:
+            raise abandoned_error(e, processing_log)
+        response = persisting_response(e, ticket, processing_log, device_id=device_id, date=target_date)
+        ticket = None
+        return response
     except Exception as e:
         import traceback
         error_details = {
@@ -657,6 +1826,406 @@ async def analyze_dashboard_summary(request: DashboardSummaryRequest):
                 "error_details": error_details
             }
         )
+    finally:
+        if ticket is not None:
+            release_request(ticket, processing_log, completed)
+
+async def run_dashboard_summary_batch_job(job: Dict[str, Any], rows: List[Dict[str, Any]]) -> None:
+    """
+    複数デバイスのDashboard Summaryを一括で分析する
+
+    1. 各デバイスのLLM分析を同時実行数を制限して並行実行
+    2. 完了した結果を DASHBOARD_BATCH_WRITE_SIZE 件ずつまとめて書き込み（既存の行のみUPDATE）
+    """
+    devices = job["devices"]
+    semaphore = asyncio.Semaphore(max(1, DASHBOARD_BATCH_CONCURRENCY))
+    pending_writes: List[Dict[str, Any]] = []
+    record_ids: Dict[str, Optional[str]] = {}
+    write_lock = asyncio.Lock()
+
+    async def flush() -> None:
+        """書き込み待ちの結果をまとめて保存"""
+        async with write_lock:
+            if not pending_writes:
+                return
+            batch = list(pending_writes)
+            pending_writes.clear()
+            try:
+                saved_keys = await supabase.update_dashboard_summary_analyses(batch)
+            except Exception as e:
+                print(f"❌ dashboard_summaryへの一括保存失敗: {e}")
+                saved_keys = set()
+            saved = [row for row in batch if (row["device_id"], row["date"]) in saved_keys]
+            for row in batch:
+                devices[row["device_id"]]["status"] = "saved" if (row["device_id"], row["date"]) in saved_keys else "save_failed"
+            if saved:
+                await mark_results_saved([record_ids.get(row["device_id"]) for row in saved])
+            job_store.save(job)
+
+    async def analyze_device(row: Dict[str, Any]) -> None:
+        device_id = row["device_id"]
+        device = devices[device_id]
+        prompt_text = build_dashboard_prompt_text(row["prompt"])
+        stored = await find_unsaved_result("dashboard_summary", device_id, job["date"], None, prompt_text)
+        if stored:
+            # 前回保存に失敗した同じプロンプトの結果を再利用
+            analysis_result = stored["analysis_result"]
+            record_ids[device_id] = stored["id"]
+            device["reused"] = True
+        else:
+            async with semaphore:
+                try:
+                    generation = generation_policy.select("dashboard_summary", len(prompt_text))
+                    analysis_result = await call_llm_with_retry(
+                        prompt_text, priority=job["priority"], generation=generation, device_id=device_id,
+                        schema="dashboard_summary"
+                    )
+                except Exception as e:
+                    print(f"❌ Dashboard Summary分析失敗: {device_id}: {e}")
+                    device["status"] = "llm_error"
+                    device["error"] = f"{type(e).__name__}: {e}"
+                    return
+
+            if "processing_error" in analysis_result:
+                device["status"] = "llm_error"
+                device["error"] = analysis_result["processing_error"]
+                return
+            record_ids[device_id] = await remember_result(
+                "dashboard_summary", device_id, job["date"], None, prompt_text, analysis_result, job["model_used"]
+            )
+
+        device["status"] = "analyzed"
+        pending_writes.append({
+            "device_id": device_id,
+            "date": job["date"],
+            "analysis_result": analysis_result,
+            **extract_dashboard_fields(analysis_result)
+        })
+        if len(pending_writes) >= DASHBOARD_BATCH_WRITE_SIZE:
+            await flush()
+
+    try:
+        supabase = get_supabase_client()
+        job["status"] = "running"
+        job_store.save(job)
+
+        await asyncio.gather(*(analyze_device(row) for row in rows))
+        await flush()
+        job["status"] = "completed"
+    except Exception as e:
+        print(f"❌ ERROR in run_dashboard_summary_batch_job: {e}")
+        job["status"] = "failed"
+        job["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        summary: Dict[str, int] = {}
+        for device in devices.values():
+            summary[device["status"]] = summary.get(device["status"], 0) + 1
+        job["summary"] = summary
+        job["completed_at"] = datetime.now().isoformat()
+        job_store.save(job)
+        print(f"📦 Dashboard Summary一括分析完了: {job['job_id']} {summary}")
+
+@app.post("/analyze-dashboard-summary/batch")
+async def analyze_dashboard_summary_batch(request: DashboardSummaryBatchRequest):
+    """
+    複数デバイスのDashboard Summaryを一括分析（夜間処理用）
+
+    対象デバイスのpromptを1回のクエリでまとめて取得し、LLM分析を並行実行して、
+    結果をまとめて書き込む。分析はバックグラウンドで行い、
+    進捗とデバイスごとの状態は GET /analyze-dashboard-summary/batch/{job_id} で確認する。
+    """
+    priority = resolve_priority(request.priority, DEFAULT_TIMEBLOCK_PRIORITY)
+    if request.device_ids is not None and not request.device_ids:
+        raise HTTPException(status_code=400, detail="device_idsが空です")
+
+    supabase = get_supabase_client()
+    try:
+        rows = await supabase.get_dashboard_summary_prompts(
+            request.date, request.device_ids, request.only_unanalyzed
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"dashboard_summaryの取得エラー: {str(e)}")
+
+    devices: Dict[str, Dict[str, Any]] = {}
+    runnable = []
+    for row in rows:
+        if row.get("prompt"):
+            devices[row["device_id"]] = {"status": "queued"}
+            runnable.append(row)
+        else:
+            devices[row["device_id"]] = {"status": "prompt_not_found"}
+    for device_id in request.device_ids or []:
+        devices.setdefault(device_id, {"status": "not_found"})
+
+    job = job_store.create(
+        "dashboard_summary_batch",
+        date=request.date,
+        priority=priority,
+        model_used=f"{CURRENT_PROVIDER}/{CURRENT_MODEL}",
+        devices=devices
+    )
+    start_background_task(run_dashboard_summary_batch_job(job, runnable))
+    print(f"📦 Dashboard Summary一括分析ジョブ作成: {job['job_id']} ({len(runnable)}/{len(devices)}デバイス)")
+
+    return {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "date": request.date,
+        "device_count": len(devices),
+        "runnable_count": len(runnable)
+    }
+
+@app.get("/analyze-dashboard-summary/batch/{job_id}")
+async def get_dashboard_summary_batch_job(job_id: str, verbose: bool = True):
+    """Dashboard Summary一括分析ジョブの状態（verbose=falseの場合はデバイスごとの状態を省略）"""
+    job = job_store.get(job_id)
+    if job is None or job.get("kind") != "dashboard_summary_batch":
+        raise HTTPException(status_code=404, detail=f"ジョブが見つかりません: {job_id}")
+    if not verbose:
+        job.pop("devices", None)
+    return job
+
+OFFLINE_BATCH_KINDS = ("timeblock", "dashboard_summary")
+
+async def fetch_offline_batch_prompt(supabase: SupabaseClient, kind: str, target: Dict[str, Any]) -> str:
+    """バッチ処理対象1件分のプロンプトを取得（見つからない場合はHTTPException）"""
+    if kind == "timeblock":
+        return await fetch_timeblock_prompt(supabase, target["device_id"], target["date"], target["time_block"])
+
+    dashboard_data = await supabase.get_dashboard_summary_prompt(target["device_id"], target["date"])
+    if dashboard_data is None or not dashboard_data.get('prompt'):
+        raise HTTPException(status_code=404, detail="dashboard_summaryにpromptデータが存在しません")
+    return build_dashboard_prompt_text(dashboard_data['prompt'])
+
+async def save_offline_batch_result(
+    supabase: SupabaseClient,
+    kind: str,
+    target: Dict[str, Any],
+    analysis_result: Dict[str, Any]
+) -> bool:
+    """バッチ処理の結果1件を通常の分析と同じ保存処理で保存"""
+    if kind == "timeblock":
+        return await save_timeblock_result(
+            supabase, target["device_id"], target["date"], target["time_block"], analysis_result
+        )
+    try:
+        return await supabase.update_dashboard_summary_analysis(
+            device_id=target["device_id"],
+            target_date=target["date"],
+            analysis_result=analysis_result,
+            **extract_dashboard_fields(analysis_result)
+        )
+    except Exception as e:
+        print(f"❌ dashboard_summaryテーブルへの保存失敗: {e}")
+        return False
+
+async def run_offline_batch_job(job: Dict[str, Any]) -> None:
+    """
+    ベンダーのバッチAPIでジョブを実行する
+
+    1. 各対象のプロンプトを取得してJSONLを作成
+    2. バッチジョブを投入し、完了までポーリング
+    3. 結果を custom_id（対象のインデックス）で対象に対応付け、通常のJSON抽出・保存処理を実行
+    """
+    kind = job["analysis_kind"]
+    targets = job["targets"]
+    try:
+        supabase = get_supabase_client()
+
+        # 1) プロンプト取得
+        job["status"] = "preparing"
+        job_store.save(job)
+        prompts = []
+        for index, target in enumerate(targets):
+            try:
+                prompt = await fetch_offline_batch_prompt(supabase, kind, target)
+                prompts.append((f"t{index}", prompt))
+            except HTTPException as e:
+                target["status"] = "prompt_not_found"
+                target["error"] = str(e.detail)
+
+        if not prompts:
+            job["status"] = "failed"
+            job["error"] = "処理可能なプロンプトがありません"
+            return
+
+        # 2) バッチジョブの投入と完了待ち（待機はイベントループ上で行い、状態確認の呼び出しのみスレッドで実行）
+        backend = get_batch_backend()
+        jsonl = build_batch_jsonl(get_current_llm(), prompts)
+
+        def on_submitted(batch_id: str) -> None:
+            job["status"] = "submitted"
+            job["batch_id"] = batch_id
+            job_store.save(job)
+
+        results = await run_batch_job_async(backend, jsonl, BATCH_POLL_INTERVAL_SECONDS, on_submitted=on_submitted)
+
+        # 3) 結果の対応付けと保存
+        job["status"] = "saving"
+        job_store.save(job)
+        for custom_id, prompt in prompts:
+            target = targets[int(custom_id[1:])]
+            result = results.get(custom_id)
+            if result is None or "error" in result:
+                target["status"] = "llm_error"
+                target["error"] = str(result.get("error")) if result else "バッチ結果に含まれていません"
+                continue
+            analysis_result = process_nan_values(extract_json_from_response(result["content"]))
+            record_id = await remember_result(
+                kind, target["device_id"], target["date"], target.get("time_block") if kind == "timeblock" else None,
+                prompt, analysis_result, job["model_used"]
+            )
+            saved = await save_offline_batch_result(supabase, kind, target, analysis_result)
+            if saved:
+                await mark_results_saved([record_id])
+            target["status"] = "saved" if saved else "save_failed"
+
+        job["status"] = "completed"
+    except Exception as e:
+        print(f"❌ ERROR in run_offline_batch_job: {e}")
+        job["status"] = "failed"
+        job["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        summary: Dict[str, int] = {}
+        for target in targets:
+            status = target.get("status", "pending")
+            summary[status] = summary.get(status, 0) + 1
+        job["summary"] = summary
+        job_store.save(job)
+
+@app.post("/offline-batch/jobs")
+async def create_offline_batch_job(request: OfflineBatchRequest):
+    """
+    ベンダーのバッチAPIを使った分析ジョブを作成（即時性が不要な夜間処理・再処理用）
+
+    同期APIのレート制限を消費しないため、リアルタイムの分析リクエストに影響しない。
+    結果は通常の分析と同じテーブルに保存される。進捗は GET /offline-batch/jobs/{job_id} で確認する。
+    """
+    if request.kind not in OFFLINE_BATCH_KINDS:
+        raise HTTPException(status_code=400, detail=f"kindは {', '.join(OFFLINE_BATCH_KINDS)} のいずれかを指定してください")
+    if not request.targets:
+        raise HTTPException(status_code=400, detail="targetsが空です")
+    if request.kind == "timeblock" and any(not target.time_block for target in request.targets):
+        raise HTTPException(status_code=400, detail="タイムブロック分析ではtime_blockが必須です")
+
+    job = job_store.create(
+        "offline_batch",
+        analysis_kind=request.kind,
+        model_used=f"{CURRENT_PROVIDER}/{CURRENT_MODEL}",
+        batch_id=None,
+        targets=[target.model_dump() for target in request.targets]
+    )
+    start_background_task(run_offline_batch_job(job))
+    print(f"📦 オフラインバッチジョブ作成: {job['job_id']} ({request.kind}, {len(request.targets)}件)")
+
+    return {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "kind": request.kind,
+        "target_count": len(request.targets)
+    }
+
+@app.get("/offline-batch/jobs/{job_id}")
+async def get_offline_batch_job(job_id: str, verbose: bool = True):
+    """オフラインバッチジョブの状態（verbose=falseの場合は対象ごとの結果を省略）"""
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"ジョブが見つかりません: {job_id}")
+    if not verbose:
+        job.pop("targets", None)
+    return job
+
+async def replay_unsaved_results(limit: Optional[int] = None, dry_run: bool = False) -> Dict[str, Any]:
+    """
+    結果ストアに残っているSupabase未保存の分析結果をまとめて保存し直す
+
+    - タイムブロック分析: audio_scorer に RESULT_REPLAY_WRITE_SIZE 件ずつUPSERT
+    - Dashboard Summary: dashboard_summary の既存の行を RESULT_REPLAY_WRITE_SIZE 件ずつUPDATE
+    保存できた結果は保存済みとして記録し、最後に保存済みの結果をファイルから削除する。
+    """
+    records = await asyncio.to_thread(result_store.unsaved, limit)
+    by_endpoint: Dict[str, List[Dict[str, Any]]] = {}
+    for record in records:
+        by_endpoint.setdefault(record["key"][0], []).append(record)
+    counts = {endpoint: len(items) for endpoint, items in by_endpoint.items()}
+    print(f"♻️ 未保存の分析結果: {len(records)}件 {counts}")
+    if dry_run or not records:
+        return {"dry_run": dry_run, "unsaved": len(records), "by_endpoint": counts, "saved": 0, "failed": 0}
+
+    supabase = get_supabase_client()
+    saved_ids: List[str] = []
+    for endpoint, items in by_endpoint.items():
+        for start in range(0, len(items), RESULT_REPLAY_WRITE_SIZE):
+            chunk = items[start:start + RESULT_REPLAY_WRITE_SIZE]
+            try:
+                if endpoint == "timeblock":
+                    rows = [
+                        build_audio_scorer_row(*record["key"][1:4], record["analysis_result"], record["created_at"])
+                        for record in chunk
+                    ]
+                    supabase.client.table('audio_scorer').upsert(rows).execute()
+                    saved = chunk
+                elif endpoint == "dashboard_summary":
+                    saved_keys = await supabase.update_dashboard_summary_analyses([
+                        {
+                            "device_id": record["key"][1],
+                            "date": record["key"][2],
+                            "analysis_result": record["analysis_result"],
+                            **extract_dashboard_fields(record["analysis_result"])
+                        }
+                        for record in chunk
+                    ])
+                    saved = [record for record in chunk if tuple(record["key"][1:3]) in saved_keys]
+                else:
+                    print(f"⚠️ 再保存に対応していない分析結果です: {endpoint}")
+                    saved = []
+            except Exception as e:
+                print(f"❌ 未保存の分析結果の再保存失敗（{endpoint}, {len(chunk)}件）: {e}")
+                saved = []
+            saved_ids.extend(record["id"] for record in saved)
+
+    await asyncio.to_thread(result_store.mark_saved, saved_ids)
+    remaining = await asyncio.to_thread(result_store.compact)
+    print(f"✅ 未保存の分析結果を再保存しました: {len(saved_ids)}/{len(records)}件（残り {remaining}件）")
+    return {
+        "dry_run": False,
+        "unsaved": len(records),
+        "by_endpoint": counts,
+        "saved": len(saved_ids),
+        "failed": len(records) - len(saved_ids),
+        "remaining": remaining
+    }
+
+class LazyLegacyRouter:
+    """
+    非推奨エンドポイントのルーター（起動時には読み込まず、最初のリクエストで読み込んで転送する）
+
+    パスだけを先に登録しておき、legacy_endpoints.py の読み込みとルーターの作成は初回のリクエスト時に行う。
+    """
+
+    PATHS = ("/analyze/chatgpt", "/analyze-vibegraph-supabase")
+
+    def __init__(self):
+        self._router = None
+        self._lock = asyncio.Lock()
+
+    async def _load(self):
+        async with self._lock:
+            if self._router is None:
+                with startup_profile.phase("import:legacy_endpoints", kind="lazy"):
+                    from legacy_endpoints import create_legacy_router
+                    self._router = create_legacy_router(get_supabase_client, call_llm_with_retry)
+        return self._router
+
+    async def __call__(self, scope, receive, send):
+        router = self._router or await self._load()
+        await router(scope, receive, send)
+
+# 非推奨エンドポイントはパスのみ登録し、モジュールは最初のリクエストで読み込む
+if ENABLE_LEGACY_ENDPOINTS:
+    legacy_router = LazyLegacyRouter()
+    for legacy_path in LazyLegacyRouter.PATHS:
+        app.add_route(legacy_path, legacy_router, methods=["POST"], include_in_schema=False)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,146 @@
+"""
+NDJSON（1行1JSON）のストリーミング処理
+
+大量の分析対象を1つのリクエストで受け付け、行が届いた順に処理を始め、完了した順に結果を1行ずつ返す。
+リクエスト・レスポンスとも全体をメモリに載せないため、対象数によらずメモリ使用量は一定。
+
+- 同時に処理する行は concurrency 件まで。結果をクライアントが読み取るまで次の行は読み込まない（背圧）
+- 1行の処理に失敗しても他の行は続行し、その行の結果として status=error を返す
+- 最後の行に件数の集計（"done": true）を返す
+- ボディの読み込み中にクライアントが切断した場合は、処理中の行を止めて結果を返さずに終了する
+"""
+
+import asyncio
+import json
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from starlette.requests import ClientDisconnect
+from starlette.responses import StreamingResponse
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# 1行の最大バイト数（これを超える行があった場合は読み込みを打ち切る）
+MAX_LINE_BYTES = 64 * 1024
+
+try:
+    import orjson
+
+    def _dumps(value: Dict[str, Any]) -> bytes:
+        return orjson.dumps(value) + b"\n"
+except ImportError:
+    def _dumps(value: Dict[str, Any]) -> bytes:
+        return (json.dumps(value, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+
+
+class LineTooLongError(ValueError):
+    """MAX_LINE_BYTES を超える行"""
+
+
+async def iter_lines(chunks: AsyncIterator[bytes], max_line_bytes: int = MAX_LINE_BYTES) -> AsyncIterator[str]:
+    """バイト列のチャンクを行に分割する（空行は読み飛ばす）"""
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line.decode("utf-8")
+        if len(buffer) > max_line_bytes:
+            raise LineTooLongError(f"1行が{max_line_bytes}バイトを超えています")
+    if buffer.strip():
+        yield buffer.decode("utf-8")
+
+
+async def process_lines(
+    lines: AsyncIterator[str],
+    handle: Callable[[int, str], Awaitable[Dict[str, Any]]],
+    concurrency: int
+) -> AsyncIterator[bytes]:
+    """
+    行を concurrency 件ずつ並行して handle(行番号, 行) で処理し、完了した順に結果をNDJSONで返す
+
+    結果の待ち行列も concurrency 件までとし、読み取られていない結果がある間は処理枠を空けない。
+    """
+    concurrency = max(1, concurrency)
+    slots = asyncio.Semaphore(concurrency)
+    results: asyncio.Queue = asyncio.Queue(maxsize=concurrency)
+    running = set()
+    counts = {"total": 0, "succeeded": 0, "failed": 0}
+    read_error: Optional[str] = None
+
+    async def run_line(number: int, line: str) -> None:
+        try:
+            result = await handle(number, line)
+        except Exception as e:
+            result = {"line": number, "status": "error", "error": f"{type(e).__name__}: {e}"}
+        try:
+            await results.put(result)
+        finally:
+            slots.release()
+
+    async def read() -> None:
+        nonlocal read_error
+        try:
+            async for line in lines:
+                await slots.acquire()
+                counts["total"] += 1
+                task = asyncio.create_task(run_line(counts["total"], line))
+                running.add(task)
+                task.add_done_callback(running.discard)
+        except (asyncio.CancelledError, ClientDisconnect):
+            # 切断した場合は結果を受け取る相手がいないため、処理中の行も止める（呼び出し側に伝える）
+            raise
+        except Exception as e:
+            read_error = f"{type(e).__name__}: {e}"
+        if running:
+            await asyncio.gather(*list(running))
+        await results.put(None)
+
+    def stop() -> None:
+        if not reader.done():
+            reader.cancel()
+        for task in list(running):
+            task.cancel()
+
+    reader = asyncio.create_task(read())
+    getter: Optional[asyncio.Future] = None
+    try:
+        while True:
+            # 結果を待つ間も読み込み側の切断を監視する
+            getter = asyncio.ensure_future(results.get())
+            await asyncio.wait({getter, reader}, return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done() and reader.exception() is not None:
+                if isinstance(reader.exception(), ClientDisconnect):
+                    print(f"🔌 クライアントが切断しました。処理中の{len(running)}行を中止します")
+                    return
+                raise reader.exception()
+            result = await getter
+            if result is None:
+                break
+            counts["succeeded" if result.get("status") not in ("error", "failed") else "failed"] += 1
+            yield _dumps(result)
+        yield _dumps({"done": True, **counts, "read_error": read_error})
+    finally:
+        # クライアントの切断などで途中終了した場合は、読み込みと処理中の行を止める
+        if getter is not None and not getter.done():
+            getter.cancel()
+        stop()
+
+
+class NDJSONStreamingResponse(StreamingResponse):
+    """
+    リクエストボディを読みながら結果を返すストリーミングレスポンス
+
+    StreamingResponse は送信中に receive() で切断を監視するが、ボディの読み込みと競合するため監視しない
+    （切断はボディの読み込み側で ClientDisconnect として検知される）。
+    圧縮ミドルウェアが行をまとめてしまわないよう Content-Encoding: identity を付ける。
+    """
+
+    media_type = NDJSON_MEDIA_TYPE
+
+    def __init__(self, content: AsyncIterator[bytes], **kwargs):
+        super().__init__(content, **kwargs)
+        self.headers["Content-Encoding"] = "identity"
+
+    async def __call__(self, scope, receive, send) -> None:
+        await self.stream_response(send)
@@ -0,0 +1,163 @@
+"""
+処理ステージの計測とサンプリングプロファイラ
+
+- stage_timer: 各処理ステージ（JSON抽出・NaN処理・保存など）の所要時間を processing_log に記録する
+- StageLatency: ステージごとの直近の所要時間を保持し、p50/p95 を返す（/ready 用）
+- SamplingProfiler: 指定秒数だけ全スレッドのスタックを定期的に採取し、
+  flamegraph.pl / speedscope で読める folded 形式で出力する
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Optional
+
+# サンプリングプロファイラの上限（本番環境での誤操作対策）
+MAX_PROFILE_SECONDS = 60
+MIN_PROFILE_INTERVAL_MS = 1
+
+# ステージごとに保持する直近の所要時間のサンプル数
+STAGE_SAMPLE_SIZE = 500
+
+
+class StageLatency:
+    """ステージごとの直近の所要時間（プロセス全体）"""
+
+    def __init__(self, sample_size: int = STAGE_SAMPLE_SIZE):
+        self.sample_size = sample_size
+        self._lock = threading.Lock()
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.get(stage)
+            if samples is None:
+                samples = self._samples[stage] = deque(maxlen=self.sample_size)
+            samples.append(seconds)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """ステージごとのサンプル数・p50・p95（ミリ秒）"""
+        with self._lock:
+            stages = {stage: sorted(samples) for stage, samples in self._samples.items()}
+        return {
+            stage: {
+                "count": len(ordered),
+                "p50_ms": round(ordered[int(0.5 * (len(ordered) - 1))] * 1000, 2),
+                "p95_ms": round(ordered[int(0.95 * (len(ordered) - 1))] * 1000, 2),
+            }
+            for stage, ordered in stages.items()
+            if ordered
+        }
+
+
+# プロセス全体で共有するステージ所要時間の統計
+stage_latency = StageLatency()
+
+
+def record_stage(processing_log: Optional[Dict[str, Any]], stage: str, seconds: float) -> None:
+    """
+    ステージの所要時間を processing_log["stage_timings_ms"][stage] に記録する
+
+    同じステージ名で複数回記録した場合は合算する。processing_log が None の場合は
+    プロセス全体の統計（stage_latency）にのみ記録する。
+    """
+    stage_latency.record(stage, seconds)
+    if processing_log is None:
+        return
+    timings = processing_log.setdefault("stage_timings_ms", {})
+    timings[stage] = round(timings.get(stage, 0.0) + seconds * 1000, 2)
+
+
+@contextmanager
+def stage_timer(processing_log: Optional[Dict[str, Any]], stage: str):
+    """with ブロックの所要時間を processing_log["stage_timings_ms"][stage] に記録する"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(processing_log, stage, time.perf_counter() - start)
+
+
+class ProfilerBusyError(RuntimeError):
+    """別のプロファイリングが実行中"""
+
+
+class SamplingProfiler:
+    """
+    低負荷のサンプリングプロファイラ
+
+    計測対象のコードには手を入れず、別スレッドから sys._current_frames() で
+    各スレッドのスタックを一定間隔で採取する。同時に実行できるのは1つだけ。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def run(self, seconds: float, interval_ms: float = 10.0) -> Dict[str, Any]:
+        """
+        指定秒数サンプリングし、folded 形式のスタックを返す（呼び出しスレッドをブロックする）
+
+        Args:
+            seconds: 計測秒数（最大 MAX_PROFILE_SECONDS）
+            interval_ms: サンプリング間隔（ミリ秒）
+
+        Returns:
+            Dict: folded（"スタック;...;関数 件数" の改行区切り）とサンプル数などのメタ情報
+
+        Raises:
+            ProfilerBusyError: 別のプロファイリングが実行中の場合
+        """
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusyError("別のプロファイリングが実行中です")
+        try:
+            seconds = max(0.1, min(float(seconds), MAX_PROFILE_SECONDS))
+            interval = max(float(interval_ms), MIN_PROFILE_INTERVAL_MS) / 1000
+            return self._sample(seconds, interval)
+        finally:
+            self._lock.release()
+
+    def _sample(self, seconds: float, interval: float) -> Dict[str, Any]:
+        own_thread_id = threading.get_ident()
+        thread_names = {}
+        stacks: Counter = Counter()
+        samples = 0
+
+        started = time.perf_counter()
+        deadline = started + seconds
+        while time.perf_counter() < deadline:
+            if len(thread_names) != threading.active_count():
+                thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+                stacks[self._fold(thread_names.get(thread_id, str(thread_id)), frame)] += 1
+            samples += 1
+            time.sleep(interval)
+
+        folded = "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+        return {
+            "pid": os.getpid(),
+            "duration_seconds": round(time.perf_counter() - started, 3),
+            "interval_ms": round(interval * 1000, 3),
+            "samples": samples,
+            "unique_stacks": len(stacks),
+            "folded": folded,
+        }
+
+    @staticmethod
+    def _fold(thread_name: str, frame) -> str:
+        """フレームを root から順に ';' で連結した1行にする"""
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name}@{os.path.basename(code.co_filename)}")
+            frame = frame.f_back
+        names.append(f"thread:{thread_name.replace(' ', '_')}")
+        return ";".join(reversed(names))
+
+
+# プロセス全体で共有するプロファイラ
+sampling_profiler = SamplingProfiler()
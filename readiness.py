@@ -0,0 +1,81 @@
+"""
+レディネス判定（ロードバランサーの振り分け・オートスケーリング用）
+
+/health はプロセスが応答できることだけを返す（liveness）。
+/ready はこのワーカーが新しいリクエストを受けられるかを、実際の負荷と依存先の状態から判定する。
+
+- 飽和度: (実行中のLLM呼び出し + 待ち行列) / 同時実行数の上限
+  1.0 で全枠が埋まった状態、それを超えた分は待ち行列。オートスケーリングの指標に使う
+- 依存先の疎通確認はキャッシュする（/ready が頻繁に呼ばれても Supabase に負荷をかけない）
+"""
+
+import asyncio
+import os
+import time
+from typing import Any, Callable, Dict, Optional
+
+# 依存先の疎通確認結果をキャッシュする秒数
+READY_PROBE_TTL_SECONDS = float(os.getenv("READY_PROBE_TTL_SECONDS", "15"))
+
+# 依存先の疎通確認のタイムアウト（秒）
+READY_PROBE_TIMEOUT_SECONDS = float(os.getenv("READY_PROBE_TIMEOUT_SECONDS", "3"))
+
+# この飽和度以上のワーカーは not ready を返す（2.0 = 同時実行数と同じ件数が待ち行列にある）
+READY_MAX_SATURATION = float(os.getenv("READY_MAX_SATURATION", "2.0"))
+
+
+def saturation(inflight: int, queued: int, capacity: int) -> float:
+    """飽和度（(実行中 + 待ち行列) / 同時実行数の上限）"""
+    return round((inflight + queued) / max(1, capacity), 3)
+
+
+class DependencyProbe:
+    """
+    依存先の疎通確認（結果を ttl 秒キャッシュする）
+
+    check はスレッドで実行する同期関数で、例外を送出しなければ疎通ありとみなす。
+    キャッシュ切れの際に同時に呼ばれた場合も、確認は1回だけ行う。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        check: Callable[[], Any],
+        ttl: float = READY_PROBE_TTL_SECONDS,
+        timeout: float = READY_PROBE_TIMEOUT_SECONDS
+    ):
+        self.name = name
+        self.check = check
+        self.ttl = ttl
+        self.timeout = timeout
+        self._result: Optional[Dict[str, Any]] = None
+        self._checked_at = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _fresh(self) -> bool:
+        return self._result is not None and time.monotonic() - self._checked_at < self.ttl
+
+    async def status(self) -> Dict[str, Any]:
+        """疎通確認の結果（ok, latency_ms, error, checked_at）"""
+        if self._fresh():
+            return self._result
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._fresh():
+                return self._result
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(asyncio.to_thread(self.check), self.timeout)
+                result = {"ok": True, "error": None}
+            except asyncio.TimeoutError:
+                result = {"ok": False, "error": f"{self.timeout}秒以内に応答がありません"}
+            except Exception as e:
+                result = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            result["latency_ms"] = round((time.perf_counter() - start) * 1000, 2)
+            result["checked_at"] = time.time()
+            self._result = result
+            self._checked_at = time.monotonic()
+            if not result["ok"]:
+                print(f"⚠️ 依存先の疎通確認に失敗しました: {self.name}: {result['error']}")
+            return result
@@ -0,0 +1,241 @@
+"""
+呼び出し元の期限とクライアント切断の扱い
+
+オーケストレーターやnginxが待つのをやめたリクエストの処理を続けると、LLMの実行枠とベンダーへの呼び出し
+（リトライを含む）が、結果を受け取る相手のいない処理に使われ続ける。
+
+- 期限はリクエストヘッダーで受け取る（X-Request-Timeout: 残り秒数、X-Request-Deadline: UNIX時刻）
+- 期限は contextvars でLLM呼び出し（スレッドで実行するプロバイダーのリトライ）まで伝わる
+  1回の呼び出しのタイムアウトを期限までの残り時間にし、期限を過ぎたらリトライ・続きの生成を行わない
+- 期限切れ・クライアント切断でリクエストの処理（プロンプト取得・LLM呼び出し・DB保存）をキャンセルする
+- persist_anyway のリクエストはキャンセルせず、最後まで処理して保存する（期限になったら先に応答を返す）
+
+同期SDKの呼び出しはスレッドで実行しているため、送信済みのHTTPリクエストそのものは中断できない。
+キャンセル時は実行枠をすぐに返し、以降のリトライ・続きの生成・修復を行わない（実行中の1回は
+タイムアウトで打ち切られ、結果は破棄される）。
+"""
+
+import asyncio
+import contextvars
+import math
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+TIMEOUT_HEADER = "X-Request-Timeout"
+DEADLINE_HEADER = "X-Request-Deadline"
+
+# クライアント切断時に記録するステータス（nginxの 499 Client Closed Request と同じ）
+CLIENT_CLOSED_STATUS = 499
+
+
+class Deadline:
+    """リクエストの期限（time.monotonic 基準）"""
+
+    __slots__ = ("expires_at",)
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def from_headers(cls, timeout: Optional[str], deadline: Optional[str]) -> Optional["Deadline"]:
+        """
+        ヘッダーの値から期限を作る（どちらもない場合は None、両方ある場合は早い方）
+
+        Raises:
+            ValueError: 数値として解釈できない場合
+        """
+        candidates = []
+        if timeout:
+            candidates.append(float(timeout))
+        if deadline:
+            candidates.append(float(deadline) - time.time())
+        return cls(min(candidates)) if candidates else None
+
+    def remaining(self) -> float:
+        """期限までの残り秒数（期限のない呼び出し元が相乗りした場合は inf）"""
+        return self.expires_at - time.monotonic()
+
+    def copy(self) -> "Deadline":
+        deadline = Deadline(0)
+        deadline.expires_at = self.expires_at
+        return deadline
+
+    def extend(self, other: Optional["Deadline"]) -> None:
+        """other の期限まで延長する（other が None の場合は期限なし）"""
+        self.expires_at = math.inf if other is None else max(self.expires_at, other.expires_at)
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+_deadline: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar("request_deadline", default=None)
+_call: contextvars.ContextVar[Optional["CallGuard"]] = contextvars.ContextVar("llm_call_guard", default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    """実行中のリクエストの期限（期限のないリクエスト・バックグラウンド処理では None）"""
+    return _deadline.get()
+
+
+class CallAbandoned(Exception):
+    """LLM呼び出しの前に、呼び出し元のキャンセル・期限切れを検出した"""
+
+
+class CallGuard:
+    """
+    LLM呼び出し1回分のキャンセルと期限（スレッド側から参照する）
+
+    asyncio 側でキャンセルされたら cancel() を呼び、スレッド側はそれ以降のリトライ・続きの生成を行わない。
+    """
+
+    __slots__ = ("deadline", "_cancelled")
+
+    def __init__(self, deadline: Optional[Deadline] = None):
+        self.deadline = deadline
+        self._cancelled = threading.Event()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    def run(self, func: Callable[..., Any], *args) -> Any:
+        """この呼び出しを対象として func を実行する（asyncio.to_thread に渡す）"""
+        token = _call.set(self)
+        try:
+            return func(*args)
+        finally:
+            _call.reset(token)
+
+
+def call_abandoned() -> bool:
+    """実行中のLLM呼び出しがキャンセルされた・期限を過ぎたか（スレッド側から呼ぶ）"""
+    guard = _call.get()
+    if guard is None:
+        return False
+    return guard._cancelled.is_set() or (guard.deadline is not None and guard.deadline.expired())
+
+
+def call_timeout() -> Optional[float]:
+    """実行中のLLM呼び出しの期限までの残り秒数（期限がない場合は None）"""
+    guard = _call.get()
+    if guard is None or guard.deadline is None:
+        return None
+    remaining = guard.deadline.remaining()
+    return None if math.isinf(remaining) else max(0.0, remaining)
+
+
+class RequestAbandoned(Exception):
+    """
+    期限切れ・クライアント切断で応答を打ち切った
+
+    task: persist_anyway で処理を継続している場合、そのタスク（完了時に後片付けを行うため）
+    """
+
+    def __init__(self, reason: str, task: Optional[asyncio.Task] = None):
+        super().__init__(reason)
+        self.reason = reason
+        self.task = task
+
+
+class AbandonStats:
+    """打ち切ったリクエストの件数（理由別、persist_anyway で継続した件数）"""
+
+    def __init__(self):
+        self.client_disconnected = 0
+        self.deadline_exceeded = 0
+        self.persisted = 0
+
+    def record(self, reason: str, persisted: bool) -> None:
+        setattr(self, reason, getattr(self, reason) + 1)
+        self.persisted += int(persisted)
+
+    def snapshot(self) -> Dict[str, int]:
+        return {
+            "client_disconnected": self.client_disconnected,
+            "deadline_exceeded": self.deadline_exceeded,
+            "persisted": self.persisted
+        }
+
+
+# プロセス全体で共有する統計と、persist_anyway で継続中のタスク（ガベージコレクション対策）
+abandon_stats = AbandonStats()
+_persisting: Set[asyncio.Task] = set()
+
+
+def _finish_persisting(task: asyncio.Task) -> None:
+    _persisting.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"❌ 継続した分析が失敗しました: {task.exception()}")
+
+
+def shared_deadline() -> Optional[Deadline]:
+    """
+    複数の呼び出し元で共有する処理（SingleFlight）の期限を、実行中のリクエストの期限から作る
+
+    呼び出し元の期限そのものではなく複製を返す。相乗りした呼び出し元の期限まで extend() で延長し、
+    最初の呼び出し元の期限で共有の処理が打ち切られないようにする（各呼び出し元の期限は run_guarded が待機に適用する）。
+    """
+    deadline = _deadline.get()
+    return None if deadline is None else deadline.copy()
+
+
+async def with_deadline(work: Awaitable[Any], deadline: Optional[Deadline]) -> Any:
+    """deadline を期限として work を実行する（独立したタスクとして実行すること）"""
+    _deadline.set(deadline)
+    return await work
+
+
+async def wait_for_disconnect(receive: Callable[[], Awaitable[Dict[str, Any]]]) -> None:
+    """クライアントが切断するまで待つ（リクエストボディは読み終えていること）"""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def run_guarded(
+    work: Awaitable[Any],
+    receive: Callable[[], Awaitable[Dict[str, Any]]],
+    deadline: Optional[Deadline] = None,
+    persist: bool = False
+) -> Any:
+    """
+    work を期限とクライアント切断を監視しながら実行する
+
+    期限切れ・切断の場合は work をキャンセルして（キャンセルの完了を待ってから）RequestAbandoned を送出する。
+    persist の場合は切断を監視せず、期限になったら work を継続したまま RequestAbandoned を送出する
+    （期限はLLM呼び出しに伝えない）。
+    """
+    token = _deadline.set(None if persist else deadline)
+    try:
+        task = asyncio.ensure_future(work)
+    finally:
+        _deadline.reset(token)
+    watcher = None if persist else asyncio.ensure_future(wait_for_disconnect(receive))
+    waiting = {task} if watcher is None else {task, watcher}
+
+    try:
+        done, _ = await asyncio.wait(
+            waiting, timeout=deadline.remaining() if deadline else None, return_when=asyncio.FIRST_COMPLETED
+        )
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+
+    if task in done:
+        return task.result()
+
+    reason = "client_disconnected" if watcher in done else "deadline_exceeded"
+    abandon_stats.record(reason, persist)
+    if persist:
+        print(f"⏳ 応答期限を過ぎました。分析は継続して保存します")
+        _persisting.add(task)
+        task.add_done_callback(_finish_persisting)
+        raise RequestAbandoned(reason, task)
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    raise RequestAbandoned(reason)
@@ -0,0 +1,95 @@
+"""
+レスポンスの軽量化
+
+- fields= / verbose=false によるレスポンス項目の絞り込み
+- orjson による高速なJSONレンダリング（未インストール時は標準のJSONResponse）
+- gzip / brotli 圧縮（Accept-Encoding に応じて選択、brotli は brotli-asgi がある場合のみ）
+"""
+
+from typing import Any, Dict, Optional
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse as FastJSONResponse
+except ImportError:
+    FastJSONResponse = JSONResponse
+
+# verbose=false のときに省略する項目（バッチ処理のオーケストレーターは status だけ見れば十分）
+VERBOSE_ONLY_FIELDS = ("analysis_result", "processing_log", "summary", "validation_summary", "results")
+
+# 圧縮対象とする最小サイズ（バイト）と圧縮レベル（t4g.small のCPU負荷を考慮して控えめにする）
+COMPRESSION_MINIMUM_SIZE = 1000
+GZIP_COMPRESS_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def parse_fields(fields: Optional[str]) -> Optional[list]:
+    """カンマ区切りの fields パラメータをリストに変換（未指定・空の場合はNone）"""
+    if not fields:
+        return None
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    return names or None
+
+
+def shape_response(payload: Dict[str, Any], fields: Optional[str] = None, verbose: bool = True) -> Dict[str, Any]:
+    """
+    レスポンス本体を fields / verbose に従って絞り込む
+
+    Args:
+        payload: エンドポイントのレスポンス本体
+        fields: 返すトップレベル項目（カンマ区切り）。指定時は verbose より優先
+        verbose: False の場合、分析結果・処理ログなどの大きな項目を省略する
+
+    Returns:
+        Dict: 絞り込んだレスポンス本体
+    """
+    names = parse_fields(fields)
+    if names is not None:
+        return {name: payload[name] for name in names if name in payload}
+    if not verbose:
+        return {key: value for key, value in payload.items() if key not in VERBOSE_ONLY_FIELDS}
+    return payload
+
+
+def render_response(payload: Dict[str, Any], fields: Optional[str] = None, verbose: bool = True):
+    """
+    絞り込んだレスポンスを高速JSONレスポンスとして返す
+
+    Responseオブジェクトを直接返すため、FastAPIの jsonable_encoder による変換を経由しない。
+    orjson は NaN/Infinity を null として出力する。
+    """
+    return FastJSONResponse(shape_response(payload, fields, verbose))
+
+
+def add_compression_middleware(app: FastAPI) -> str:
+    """
+    圧縮ミドルウェアを追加する
+
+    brotli-asgi がインストールされていれば brotli（非対応クライアントには gzip）、
+    なければ gzip のみを使用する。
+
+    Returns:
+        str: 有効になった圧縮方式
+    """
+    try:
+        from brotli_asgi import BrotliMiddleware
+    except ImportError:
+        from fastapi.middleware.gzip import GZipMiddleware
+
+        app.add_middleware(
+            GZipMiddleware,
+            minimum_size=COMPRESSION_MINIMUM_SIZE,
+            compresslevel=GZIP_COMPRESS_LEVEL
+        )
+        return "gzip"
+
+    app.add_middleware(
+        BrotliMiddleware,
+        quality=BROTLI_QUALITY,
+        minimum_size=COMPRESSION_MINIMUM_SIZE,
+        gzip_fallback=True
+    )
+    return "br,gzip"
@@ -0,0 +1,218 @@
+"""
+エンドポイントごとの分析結果のスキーマ（項目単位の検証と修復）
+
+LLMの応答で一部の項目が欠けている・不正な場合（vibe_score がない、emotionScores が48個に満たないなど）、
+そのまま保存すると欠損が残る。分析全体をやり直す代わりに、問題のある項目だけを
+元の応答を添えて短い設定で生成させ（修復）、結果にマージする。
+
+- スキーマは起動時に項目ごとの検証関数に変換しておく（応答ごとに定義を解釈しない）
+- 修復のプロンプトは元のプロンプトの後ろに付け足す（元のプロンプトがプロンプトキャッシュの対象になる）
+- 修復で得た値も同じ検証を通過したものだけをマージする
+"""
+
+import json
+import math
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from analysis_results import SLOTS_PER_DAY, VIBE_SCORES_KEYS, AVERAGE_VIBE_KEYS, INSIGHTS_KEYS, first_key
+
+# 項目の欠け・不正を検出した場合に修復を行うか
+RESULT_REPAIR = os.getenv("RESULT_REPAIR", "true").lower() == "true"
+
+# 修復は問題のある項目だけを出力させるため、思考を短くし出力トークン数も小さくする
+REPAIR_REASONING_EFFORT = "low"
+REPAIR_MAX_COMPLETION_TOKENS = int(os.getenv("REPAIR_MAX_COMPLETION_TOKENS", "2048"))
+
+# スコアの範囲
+SCORE_RANGE = (-100, 100)
+
+REPAIR_INSTRUCTION = (
+    "上記のデータに対するあなたの回答（下記）は、一部の項目が欠けているか不正です。"
+    "指定した項目だけを、項目名をキーとするJSONオブジェクトで出力してください。"
+    "他の項目や説明は出力しないでください。"
+)
+
+# 検証で見つかった問題（理由）
+REASON_TEXT = {
+    "missing": "欠けています",
+    "empty": "空です",
+    "not_text": "文字列ではありません",
+    "not_numeric": "数値ではありません",
+    "out_of_range": f"{SCORE_RANGE[0]}〜{SCORE_RANGE[1]}の範囲外です",
+    "not_list": "配列ではありません",
+    "wrong_length": f"要素数が{SLOTS_PER_DAY}個ではありません",
+    "invalid_items": "数値・null以外の要素、または範囲外の値を含みます",
+}
+
+
+def _no_data(value: Any) -> bool:
+    """データなしを表す値（null、または process_nan_values で float('nan') に変換された "NaN"）"""
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def _is_score(value: Any) -> bool:
+    return (
+        not isinstance(value, bool) and isinstance(value, (int, float))
+        and SCORE_RANGE[0] <= value <= SCORE_RANGE[1]
+    )
+
+
+def _check_text(value: Any) -> Optional[str]:
+    if not isinstance(value, str):
+        return "not_text"
+    return None if value.strip() else "empty"
+
+
+def _check_content(value: Any) -> Optional[str]:
+    return None if value not in ("", [], {}) else "empty"
+
+
+def _check_score(value: Any) -> Optional[str]:
+    # 観測がない場合の null・NaN は正しい回答として扱う
+    if _no_data(value):
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return "not_numeric"
+    return None if _is_score(value) else "out_of_range"
+
+
+def _check_scores(value: Any) -> Optional[str]:
+    # 未分析のスロットは null または NaN（process_nan_values で float('nan') に変換されている）
+    if not isinstance(value, list):
+        return "not_list"
+    if len(value) != SLOTS_PER_DAY:
+        return "wrong_length"
+    return None if all(_no_data(item) or _is_score(item) for item in value) else "invalid_items"
+
+
+_CHECKS: Dict[str, Callable[[Any], Optional[str]]] = {
+    "text": _check_text,
+    "content": _check_content,
+    "score": _check_score,
+    "scores": _check_scores,
+}
+
+
+class FieldRule:
+    """スキーマの1項目（keys は別名を含むキー、元の応答にない場合は先頭のキーで修復を指示する）"""
+
+    __slots__ = ("keys", "kind", "description", "required", "check")
+
+    def __init__(self, keys: Tuple[str, ...], kind: str, description: str, required: bool = True):
+        self.keys = keys
+        self.kind = kind
+        self.description = description
+        self.required = required
+        self.check = _CHECKS[kind]
+
+    def key_in(self, result: Dict[str, Any]) -> str:
+        """result で使われているキー（ない場合は先頭のキー）"""
+        return first_key(result, self.keys) or self.keys[0]
+
+    def problem(self, result: Dict[str, Any]) -> Optional[str]:
+        """項目の問題（なければ None、スコアの null・NaN はデータなしとして問題にしない）"""
+        key = first_key(result, self.keys)
+        if key is None or (result[key] is None and self.kind not in ("score", "scores")):
+            return "missing" if self.required else None
+        return self.check(result[key])
+
+
+class ResultSchema:
+    """エンドポイントの分析結果のスキーマ"""
+
+    __slots__ = ("endpoint", "rules", "_by_key")
+
+    def __init__(self, endpoint: str, rules: List[FieldRule]):
+        self.endpoint = endpoint
+        self.rules = rules
+        self._by_key = {key: rule for rule in rules for key in rule.keys}
+
+    def problems(self, result: Dict[str, Any]) -> Dict[str, str]:
+        """欠けている・不正な項目（result で使われているキー → 理由）"""
+        found = {}
+        for rule in self.rules:
+            reason = rule.problem(result)
+            if reason:
+                found[rule.key_in(result)] = reason
+        return found
+
+    def repair_prompt(self, prompt: str, result: Dict[str, Any], problems: Dict[str, str]) -> str:
+        """問題のある項目だけを出力させる修復用のプロンプト（元のプロンプト + 元の回答 + 項目の指定）"""
+        fields = "\n".join(
+            f"- {name}: {REASON_TEXT.get(reason, reason)}（{self._by_key[name].description}）"
+            for name, reason in problems.items()
+        )
+        answer = json.dumps(result, ensure_ascii=False, default=str)
+        return f"{prompt}\n\n---\n{REPAIR_INSTRUCTION}\n\nあなたの回答:\n{answer}\n\n出力する項目:\n{fields}"
+
+    def merge(self, result: Dict[str, Any], repair: Dict[str, Any], problems: Dict[str, str]) -> List[str]:
+        """修復の応答のうち検証を通過した項目を result にマージし、修復できた項目名を返す"""
+        repaired = []
+        for name in problems:
+            rule = self._by_key[name]
+            # 修復の応答が別名で返した場合も、元の応答で使われていたキーに書き込む
+            key = name if name in repair else first_key(repair, rule.keys)
+            if key is None or repair[key] is None or rule.problem({key: repair[key]}):
+                continue
+            result[name] = repair[key]
+            repaired.append(name)
+        return repaired
+
+
+RESULT_SCHEMAS: Dict[str, ResultSchema] = {
+    "timeblock": ResultSchema("timeblock", [
+        FieldRule(("summary",), "text", "30分間の状況説明"),
+        FieldRule(("behavior",), "text", "行動を表す短い文字列"),
+        FieldRule(("vibe_score",), "score", f"{SCORE_RANGE[0]}〜{SCORE_RANGE[1]}の数値（観測がない場合は null）"),
+    ]),
+    "dashboard_summary": ResultSchema("dashboard_summary", [
+        FieldRule(INSIGHTS_KEYS, "content", "1日の総合評価"),
+        FieldRule(VIBE_SCORES_KEYS, "scores", f"30分ごとの{SLOTS_PER_DAY}個のスコア（データがないスロットは null）", required=False),
+        FieldRule(AVERAGE_VIBE_KEYS, "score", "1日の平均スコア", required=False),
+    ]),
+    "vibegraph": ResultSchema("vibegraph", [
+        FieldRule(("emotionScores",), "scores", f"30分ごとの{SLOTS_PER_DAY}個のスコア（データがないスロットは null）"),
+    ]),
+}
+
+
+class RepairStats:
+    """修復の件数（項目別の検出数を含む）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.attempted = 0
+        self.repaired = 0
+        self.partial = 0
+        self.failed = 0
+        self.fields: Dict[str, int] = {}
+
+    def record(self, endpoint: str, problems: Dict[str, str], repaired: List[str], error: bool = False) -> None:
+        with self._lock:
+            self.attempted += 1
+            if error or not repaired:
+                self.failed += 1
+            elif len(repaired) < len(problems):
+                self.partial += 1
+            else:
+                self.repaired += 1
+            for name in problems:
+                field = f"{endpoint}.{name}"
+                self.fields[field] = self.fields.get(field, 0) + 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": RESULT_REPAIR,
+                "attempted": self.attempted,
+                "repaired": self.repaired,
+                "partial": self.partial,
+                "failed": self.failed,
+                "fields": dict(self.fields)
+            }
+
+
+# プロセス全体で共有する統計
+repair_stats = RepairStats()
@@ -0,0 +1,298 @@
+"""
+LLM分析結果のローカル保存（追記専用）
+
+LLMの分析結果を、Supabaseへの保存より先にローカルファイルへ追記する。
+Supabaseへの保存に失敗しても結果は失われず、同じ分析の再リクエスト時にはLLMを呼ばずに再利用でき、
+Supabaseが復旧したらまとめて保存し直せる（replay）。
+
+- 1行1レコードのJSONL（追記のみ）。読み込みは mmap で行う
+- キー: (endpoint, device_id, date, time_block, prompt_hash)
+- レコード種別: "result"（分析結果）, "saved"（Supabaseへの保存完了）
+- 同一コンテナ内の全ワーカーで共有する（追記と compact はロックファイル（<path>.lock）で直列化）
+- ファイルが RESULT_STORE_COMPACT_BYTES を超えたら、保存済みの結果を削除して作り直す（compact）
+- メモリ上の索引は未保存の結果のみを持つ（保存済みになった結果は索引から外す）
+
+未保存の結果の再保存:
+    python result_store.py replay [--dry-run] [--limit N]
+"""
+
+import fcntl
+import json
+import mmap
+import os
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+# 保存先（コンテナの再作成後も残す場合はボリュームをマウントする）
+RESULT_STORE_PATH = os.getenv(
+    "RESULT_STORE_PATH", os.path.join(tempfile.gettempdir(), "vibe-scorer-results", "results.jsonl")
+)
+
+# ファイルがこのサイズを超えたら compact する（未保存の結果だけで超えている場合は、その2倍になるまで行わない）
+RESULT_STORE_COMPACT_BYTES = int(os.getenv("RESULT_STORE_COMPACT_BYTES", str(32 * 1024 * 1024)))
+
+ResultKey = Tuple[str, str, str, str, str]
+
+
+def result_key(endpoint: str, device_id: str, date: str, time_block: Optional[str], prompt_hash: str) -> ResultKey:
+    """レコードのキー（time_blockがないエンドポイントは空文字）"""
+    return (endpoint, device_id, date, time_block or "", prompt_hash)
+
+
+class ResultStore:
+    """
+    LLM分析結果の追記専用ストア
+
+    ファイルの末尾まで読み込んだ位置を覚えておき、他のワーカーが追記した分だけを差分で読み込む。
+    compact() でファイルが置き換えられた場合は最初から読み直す。
+    索引のオフセットは索引を作ったファイルハンドルから読む（他のワーカーが置き換えた後のファイルを読まない）。
+    """
+
+    def __init__(self, path: str = RESULT_STORE_PATH, compact_bytes: int = RESULT_STORE_COMPACT_BYTES):
+        self.path = path
+        # compact() は self.path を置き換えるため、ロックは置き換えない別のファイルで取る
+        self.lock_path = path + ".lock"
+        self.compact_bytes = compact_bytes
+        self._compact_at = compact_bytes
+        self._lock = threading.Lock()
+        # 索引を作ったファイルのハンドル
+        self._file: Optional[BinaryIO] = None
+        self._reset_index()
+
+    def _reset_index(self) -> None:
+        if getattr(self, "_file", None) is not None:
+            self._file.close()
+        self._file = None
+        self._file_id: Optional[Tuple[int, int]] = None
+        self._scanned = 0
+        # 未保存の結果のみ: キー → (オフセット, レコードID)（同じキーは最新の結果のみ）
+        self._latest: Dict[ResultKey, Tuple[int, str]] = {}
+        # 未保存の結果のレコードID → キー（"saved" レコードで索引から外すため）
+        self._ids: Dict[str, ResultKey] = {}
+        # 分析対象 (endpoint, device_id, date, time_block) → 最新の結果のキー
+        self._targets: Dict[Tuple[str, str, str, str], ResultKey] = {}
+        self._results = 0
+
+    # ---------- 書き込み ----------
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        """追記・compact を複数プロセス間で直列化するロック"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.lock_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _append(self, records: List[Dict[str, Any]]) -> int:
+        """レコードを1回のwriteで追記し、追記後のファイルサイズを返す"""
+        data = b"".join(
+            (json.dumps(record, ensure_ascii=False, default=str) + "\n").encode("utf-8") for record in records
+        )
+        with self._file_lock():
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+                return os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+
+    def _maybe_compact(self, size: int) -> None:
+        if self.compact_bytes > 0 and size >= self._compact_at:
+            kept = self.compact()
+            print(f"🧹 結果ストアを整理しました（未保存 {kept}件を保持）")
+
+    def append_result(
+        self,
+        endpoint: str,
+        device_id: str,
+        date: str,
+        time_block: Optional[str],
+        prompt_hash: str,
+        analysis_result: Dict[str, Any],
+        model_used: Optional[str] = None
+    ) -> str:
+        """分析結果を追記し、レコードIDを返す"""
+        record_id = uuid.uuid4().hex
+        size = self._append([{
+            "t": "result",
+            "id": record_id,
+            "key": list(result_key(endpoint, device_id, date, time_block, prompt_hash)),
+            "analysis_result": analysis_result,
+            "model_used": model_used,
+            "created_at": datetime.now().isoformat()
+        }])
+        self._maybe_compact(size)
+        return record_id
+
+    def mark_saved(self, record_ids: List[Optional[str]]) -> None:
+        """Supabaseへの保存が完了したレコードを記録する"""
+        saved_at = datetime.now().isoformat()
+        records = [{"t": "saved", "id": record_id, "saved_at": saved_at} for record_id in record_ids if record_id]
+        if records:
+            self._maybe_compact(self._append(records))
+
+    # ---------- 読み込み ----------
+
+    def _refresh(self) -> None:
+        """前回読み込んだ位置以降のレコードを索引に追加する（呼び出し元で _lock を保持すること）"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._reset_index()
+            return
+        if (stat.st_ino, stat.st_dev) != self._file_id or stat.st_size < self._scanned:
+            self._reset_index()
+            try:
+                self._file = open(self.path, "rb")
+            except FileNotFoundError:
+                return
+            # stat 後に置き換えられた場合に備え、開いたハンドル自体のIDを使う
+            opened = os.fstat(self._file.fileno())
+            self._file_id = (opened.st_ino, opened.st_dev)
+        size = os.fstat(self._file.fileno()).st_size
+        if size <= self._scanned:
+            return
+
+        with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            position = self._scanned
+            size = len(mm)
+            while position < size:
+                end = mm.find(b"\n", position)
+                if end < 0:
+                    break  # 書き込み途中の行は次回読み込む
+                self._index_line(mm[position:end], position)
+                position = end + 1
+            self._scanned = position
+
+    def _index_line(self, line: bytes, offset: int) -> None:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return
+        if record.get("t") == "result":
+            key = tuple(record["key"])
+            previous = self._latest.get(key)
+            if previous is not None:
+                self._ids.pop(previous[1], None)
+            self._latest[key] = (offset, record["id"])
+            self._ids[record["id"]] = key
+            self._targets[key[:4]] = key
+            self._results += 1
+        elif record.get("t") == "saved":
+            key = self._ids.pop(record["id"], None)
+            if key is None:
+                return
+            # 保存済みの結果は索引から外す（同じ分析対象の古い結果も、より新しい結果が保存済みなので再保存しない）
+            del self._latest[key]
+            if self._targets.get(key[:4]) == key:
+                del self._targets[key[:4]]
+
+    def _read_entry(self, key: ResultKey) -> Optional[Dict[str, Any]]:
+        """索引のエントリのレコードを読む（レコードIDかキーが索引と一致しない場合は None）"""
+        offset, record_id = self._latest[key]
+        self._file.seek(offset)
+        try:
+            record = json.loads(self._file.readline())
+        except ValueError:
+            return None
+        if record.get("id") != record_id or tuple(record.get("key") or ()) != key:
+            print(f"⚠️ 結果ストアの索引と一致しないレコードを読み飛ばしました: {record_id}")
+            return None
+        return record
+
+    def _pending_keys(self) -> List[ResultKey]:
+        """
+        分析対象ごとの最新の結果のうち、Supabase未保存のもののキー（古い順）
+
+        同じ分析対象により新しい結果（別のプロンプト）がある場合、古い結果は再保存しない。
+        """
+        return sorted(self._targets.values(), key=lambda key: self._latest[key][0])
+
+    def _read_pending(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        records = (self._read_entry(key) for key in self._pending_keys()[:limit])
+        return [record for record in records if record is not None]
+
+    def find_unsaved(
+        self,
+        endpoint: str,
+        device_id: str,
+        date: str,
+        time_block: Optional[str],
+        prompt_hash: str
+    ) -> Optional[Dict[str, Any]]:
+        """同じキーの最新の結果がSupabase未保存であれば返す（LLMを呼ばずに再利用する）"""
+        with self._lock:
+            self._refresh()
+            key = result_key(endpoint, device_id, date, time_block, prompt_hash)
+            return self._read_entry(key) if key in self._latest else None
+
+    def unsaved(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Supabase未保存の結果（分析対象ごとに最新のもの、古い順）"""
+        with self._lock:
+            self._refresh()
+            return self._read_pending(limit)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._refresh()
+            return {
+                "path": self.path,
+                "size_bytes": self._scanned,
+                "results": self._results,
+                "targets": len(self._targets),
+                "unsaved": len(self._targets)
+            }
+
+    def compact(self) -> int:
+        """
+        未保存の結果だけを残してファイルを作り直す（保存済み・より新しい結果がある結果は削除）
+
+        Returns:
+            int: 残したレコード数
+        """
+        with self._lock, self._file_lock():
+            # 他のプロセスの追記と競合しないよう、ロックを取得してから読み込んで置き換える
+            self._refresh()
+            keep = self._read_pending()
+            tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".tmp")
+            with os.fdopen(tmp_fd, "w", encoding="utf-8") as f:
+                for record in keep:
+                    f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                size = f.tell()
+            os.replace(tmp_path, self.path)
+            self._reset_index()
+            self._compact_at = max(self.compact_bytes, size * 2)
+            return len(keep)
+
+
+# プロセス全体で共有するストア
+result_store = ResultStore()
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+
+    parser = argparse.ArgumentParser(description="ローカルに保存したLLM分析結果の管理")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    replay_parser = subparsers.add_parser("replay", help="Supabase未保存の結果をまとめて保存し直す")
+    replay_parser.add_argument("--dry-run", action="store_true", help="保存せず対象件数だけ表示する")
+    replay_parser.add_argument("--limit", type=int, default=None, help="保存する最大件数")
+    subparsers.add_parser("stats", help="保存件数・未保存件数を表示する")
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        print(json.dumps(result_store.stats(), ensure_ascii=False, indent=2))
+    else:
+        from main import replay_unsaved_results
+
+        summary = asyncio.run(replay_unsaved_results(limit=args.limit, dry_run=args.dry_run))
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
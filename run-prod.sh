@@ -34,8 +34,9 @@ fi
 echo -e "${GREEN}✅ イメージプル成功${NC}"
 
 # 3. 既存コンテナを停止
-echo -e "\n${YELLOW}🛑 既存コンテナを停止中...${NC}"
-docker-compose -f docker-compose.prod.yml down
+# SIGTERMを受けたgunicornは新規受付を止め、実行中の分析（LLM呼び出し）の完了を待ってから終了する
+echo -e "\n${YELLOW}🛑 既存コンテナを停止中（実行中の分析の完了を待機）...${NC}"
+docker-compose -f docker-compose.prod.yml down --timeout 190
 echo -e "${GREEN}✅ 既存コンテナ停止完了${NC}"
 
 # 4. 新しいコンテナを起動
@@ -0,0 +1,387 @@
+"""
+複数インスタンス間の処理の分担（リースによるシャーディング）
+
+device_id を固定数のシャードにハッシュで割り当て、各シャードの担当インスタンスを期限付きのリースで決める。
+変更フィードのワーカーを複数インスタンスで動かしても、同じ (device_id, date, time_block) を
+重複して分析しない。
+
+- シャード数（SHARD_COUNT）はインスタンス数によらず固定。device_id → シャードの対応は変わらない
+- 各インスタンスは生存中のインスタンス数で割った数（切り上げ）までシャードのリースを取得する
+  どのシャードを優先するかはインスタンスIDとのハッシュ（rendezvous hashing）で決めるため、
+  インスタンスの増減時に移動するシャードは少ない
+- リースは lease_ttl 秒ごとに更新する。インスタンスが停止するとリースが切れ、他のインスタンスが引き継ぐ
+- インスタンスが増えた場合は、担当数が上限を超えたインスタンスがシャードを解放して渡す
+- リースには担当していたインスタンスの取り込み位置（チェックポイント）を保存し、
+  引き継いだインスタンスはそこから取り込み直す
+
+リースの保存先:
+- SupabaseLeaseBackend: Supabaseのテーブル（本番、複数ホスト）
+- FileLeaseBackend: ローカルファイル（同一ホストの複数プロセス、テスト用）
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import json
+import math
+import os
+import socket
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# シャード数（インスタンス数の上限の目安。変更すると device_id の割り当てが変わる）
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "64"))
+
+# リースの有効期間（秒）。この1/3の間隔で更新する
+SHARD_LEASE_TTL_SECONDS = float(os.getenv("SHARD_LEASE_TTL_SECONDS", "30"))
+
+# リースの期限のこの割合が過ぎたら、更新できていなくても担当をやめる（他のインスタンスとの重複防止）
+LEASE_SAFETY_RATIO = 0.8
+
+# ファイルでリースを管理する場合の保存先
+SHARD_LEASE_PATH = os.getenv(
+    "SHARD_LEASE_PATH", os.path.join(tempfile.gettempdir(), "vibe-scorer-shards", "leases.json")
+)
+
+# Supabaseでリースを管理する場合のテーブル
+SHARD_LEASE_TABLE = "scorer_shard_leases"
+SHARD_MEMBER_TABLE = "scorer_shard_members"
+
+# (取得できたか, 前の担当インスタンスが保存したチェックポイント)
+AcquireResult = Tuple[bool, Optional[str]]
+
+
+def shard_of(device_id: str, shard_count: int = SHARD_COUNT) -> int:
+    """device_id のシャード番号（プロセス・ホストによらず同じ値）"""
+    digest = hashlib.sha1(str(device_id).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shard_count
+
+
+def _rank(instance_id: str, shard: int) -> int:
+    """インスタンスがシャードを優先する度合い（rendezvous hashing）"""
+    digest = hashlib.sha1(f"{instance_id}:{shard}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def default_instance_id() -> str:
+    return os.getenv("SHARD_INSTANCE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+
+class LeaseBackend(ABC):
+    """シャードのリースとインスタンスの生存情報の保存先（各メソッドはスレッドで呼ばれる）"""
+
+    @abstractmethod
+    def heartbeat(self, instance_id: str, ttl: float) -> List[str]:
+        """インスタンスの生存を記録し、生存中のインスタンスIDの一覧を返す"""
+
+    @abstractmethod
+    def leases(self) -> Dict[int, Dict[str, Any]]:
+        """シャード番号 → {"owner", "expires_at"（UNIX時刻）, "checkpoint"}"""
+
+    @abstractmethod
+    def acquire(self, shard: int, instance_id: str, ttl: float) -> AcquireResult:
+        """担当者がいない・リースが切れているシャードのリースを取得する"""
+
+    @abstractmethod
+    def renew(self, shard: int, instance_id: str, ttl: float, checkpoint: Optional[str]) -> bool:
+        """自分が担当しているシャードのリースを更新する（他のインスタンスに移っていればFalse）"""
+
+    @abstractmethod
+    def release(self, shard: int, instance_id: str, checkpoint: Optional[str]) -> None:
+        """シャードのリースを解放する（チェックポイントは残す）"""
+
+    @abstractmethod
+    def leave(self, instance_id: str) -> None:
+        """インスタンスの生存情報を削除する（停止時）"""
+
+
+class FileLeaseBackend(LeaseBackend):
+    """ローカルファイルでリースを管理する（同一ホストの複数プロセス・テスト用、読み書きはファイルロックで直列化）"""
+
+    def __init__(self, path: str = SHARD_LEASE_PATH):
+        self.path = path
+
+    def _update(self, change: Callable[[Dict[str, Any]], Any]) -> Any:
+        """ロックを取得して状態を読み込み、change で変更して書き戻す（change の戻り値を返す）"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    state = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                state = {}
+            state.setdefault("members", {})
+            state.setdefault("leases", {})
+            result = change(state)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.path)
+            return result
+
+    def heartbeat(self, instance_id: str, ttl: float) -> List[str]:
+        def change(state):
+            now = time.time()
+            state["members"][instance_id] = now + ttl
+            state["members"] = {member: expires for member, expires in state["members"].items() if expires > now}
+            return sorted(state["members"])
+        return self._update(change)
+
+    def leases(self) -> Dict[int, Dict[str, Any]]:
+        return self._update(lambda state: {int(shard): dict(lease) for shard, lease in state["leases"].items()})
+
+    def acquire(self, shard: int, instance_id: str, ttl: float) -> AcquireResult:
+        def change(state):
+            lease = state["leases"].setdefault(str(shard), {"owner": None, "expires_at": 0, "checkpoint": None})
+            if lease["owner"] not in (None, instance_id) and lease["expires_at"] > time.time():
+                return False, None
+            lease["owner"] = instance_id
+            lease["expires_at"] = time.time() + ttl
+            return True, lease["checkpoint"]
+        return self._update(change)
+
+    def renew(self, shard: int, instance_id: str, ttl: float, checkpoint: Optional[str]) -> bool:
+        def change(state):
+            lease = state["leases"].get(str(shard))
+            if not lease or lease["owner"] != instance_id:
+                return False
+            lease["expires_at"] = time.time() + ttl
+            if checkpoint is not None:
+                lease["checkpoint"] = checkpoint
+            return True
+        return self._update(change)
+
+    def release(self, shard: int, instance_id: str, checkpoint: Optional[str]) -> None:
+        def change(state):
+            lease = state["leases"].get(str(shard))
+            if lease and lease["owner"] == instance_id:
+                lease["owner"] = None
+                lease["expires_at"] = 0
+                if checkpoint is not None:
+                    lease["checkpoint"] = checkpoint
+        self._update(change)
+
+    def leave(self, instance_id: str) -> None:
+        self._update(lambda state: state["members"].pop(instance_id, None))
+
+
+def _iso(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _epoch(value: Any) -> float:
+    if not value:
+        return 0.0
+    return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+
+
+class SupabaseLeaseBackend(LeaseBackend):
+    """
+    Supabaseのテーブルでリースを管理する
+
+    リースの取得・更新は条件付きのUPDATE（担当者・期限をWHERE句で確認）で行うため、
+    複数のインスタンスが同時に取得しようとしても1つだけが成功する。
+    """
+
+    def __init__(self, get_supabase_client: Callable[[], Any], shard_count: int = SHARD_COUNT):
+        self._get_supabase_client = get_supabase_client
+        self.shard_count = shard_count
+        self._seeded = False
+
+    def _table(self, name: str):
+        return self._get_supabase_client().client.table(name)
+
+    def _seed(self) -> None:
+        """全シャードの行を作成する（既存の行はそのまま）"""
+        if self._seeded:
+            return
+        rows = [{"shard": shard, "owner": None, "expires_at": _iso(0)} for shard in range(self.shard_count)]
+        self._table(SHARD_LEASE_TABLE).upsert(rows, on_conflict="shard", ignore_duplicates=True).execute()
+        self._seeded = True
+
+    def heartbeat(self, instance_id: str, ttl: float) -> List[str]:
+        now = time.time()
+        self._table(SHARD_MEMBER_TABLE).upsert(
+            {"instance_id": instance_id, "expires_at": _iso(now + ttl)}, on_conflict="instance_id"
+        ).execute()
+        result = self._table(SHARD_MEMBER_TABLE).select("instance_id").gt("expires_at", _iso(now)).execute()
+        return sorted(row["instance_id"] for row in result.data or [])
+
+    def leases(self) -> Dict[int, Dict[str, Any]]:
+        self._seed()
+        result = self._table(SHARD_LEASE_TABLE).select("shard, owner, expires_at, checkpoint").execute()
+        return {
+            row["shard"]: {"owner": row.get("owner"), "expires_at": _epoch(row.get("expires_at")), "checkpoint": row.get("checkpoint")}
+            for row in result.data or []
+        }
+
+    def acquire(self, shard: int, instance_id: str, ttl: float) -> AcquireResult:
+        now = time.time()
+        result = (
+            self._table(SHARD_LEASE_TABLE)
+            .update({"owner": instance_id, "expires_at": _iso(now + ttl)})
+            .eq("shard", shard)
+            .or_(f'owner.is.null,owner.eq."{instance_id}",expires_at.lt."{_iso(now)}"')
+            .execute()
+        )
+        if not result.data:
+            return False, None
+        return True, result.data[0].get("checkpoint")
+
+    def renew(self, shard: int, instance_id: str, ttl: float, checkpoint: Optional[str]) -> bool:
+        values = {"expires_at": _iso(time.time() + ttl)}
+        if checkpoint is not None:
+            values["checkpoint"] = checkpoint
+        result = self._table(SHARD_LEASE_TABLE).update(values).eq("shard", shard).eq("owner", instance_id).execute()
+        return bool(result.data)
+
+    def release(self, shard: int, instance_id: str, checkpoint: Optional[str]) -> None:
+        values = {"owner": None, "expires_at": _iso(0)}
+        if checkpoint is not None:
+            values["checkpoint"] = checkpoint
+        self._table(SHARD_LEASE_TABLE).update(values).eq("shard", shard).eq("owner", instance_id).execute()
+
+    def leave(self, instance_id: str) -> None:
+        self._table(SHARD_MEMBER_TABLE).delete().eq("instance_id", instance_id).execute()
+
+
+class ShardCoordinator:
+    """
+    このインスタンスが担当するシャードの管理
+
+    run() の間、lease_ttl の1/3ごとに生存情報の記録・リースの更新・過不足の調整を行う。
+    owns() は、リースの期限（安全のため LEASE_SAFETY_RATIO を掛けたもの）内に更新できている
+    シャードのみ担当とみなす。
+    """
+
+    def __init__(
+        self,
+        backend: LeaseBackend,
+        instance_id: Optional[str] = None,
+        shard_count: int = SHARD_COUNT,
+        lease_ttl: float = SHARD_LEASE_TTL_SECONDS
+    ):
+        self.backend = backend
+        self.instance_id = instance_id or default_instance_id()
+        self.shard_count = shard_count
+        self.lease_ttl = lease_ttl
+        # 担当シャード → 担当とみなす期限（time.monotonic）
+        self._owned: Dict[int, float] = {}
+        self._preference = sorted(range(shard_count), key=lambda shard: _rank(self.instance_id, shard), reverse=True)
+        self._stopping = asyncio.Event()
+        # 最初の調整が終わったか（取り込みは担当シャードが決まってから始める）
+        self.ready = asyncio.Event()
+        self.members: List[str] = []
+        # 取り込み位置（リースに保存するチェックポイント）を返す関数と、シャードを引き継いだ際の通知先
+        self.checkpoint: Callable[[], Optional[str]] = lambda: None
+        self.on_acquire: Callable[[int, Optional[str]], None] = lambda shard, checkpoint: None
+        self.stats = {"acquired": 0, "released": 0, "lost": 0, "rounds": 0, "errors": 0}
+
+    def owned_shards(self) -> List[int]:
+        now = time.monotonic()
+        return sorted(shard for shard, deadline in list(self._owned.items()) if deadline > now)
+
+    def owns(self, device_id: str) -> bool:
+        """device_id がこのインスタンスの担当か"""
+        deadline = self._owned.get(shard_of(device_id, self.shard_count))
+        return deadline is not None and deadline > time.monotonic()
+
+    def _hold(self, shard: int, renewed_at: float) -> None:
+        self._owned[shard] = renewed_at + self.lease_ttl * LEASE_SAFETY_RATIO
+
+    def rebalance(self, checkpoint: Optional[str] = None) -> List[Tuple[int, Optional[str]]]:
+        """
+        1回分の調整（生存情報の記録 → リース更新 → 余剰の解放 → 不足分の取得）
+
+        スレッドで実行するため、リースの読み書き以外には触れない。
+        取得したシャードとその前回のチェックポイントを返す（on_acquire はイベントループ側で呼ぶ）
+        """
+        started = time.monotonic()
+        self.members = self.backend.heartbeat(self.instance_id, self.lease_ttl)
+        target = math.ceil(self.shard_count / max(1, len(self.members)))
+        acquired_shards: List[Tuple[int, Optional[str]]] = []
+
+        for shard in list(self._owned):
+            if self.backend.renew(shard, self.instance_id, self.lease_ttl, checkpoint):
+                self._hold(shard, started)
+            else:
+                del self._owned[shard]
+                self.stats["lost"] += 1
+                print(f"⚠️ シャード {shard} のリースが他のインスタンスに移りました")
+
+        # インスタンスが増えた場合は、優先度の低いシャードから解放して他のインスタンスに渡す
+        for shard in reversed(self._preference):
+            if len(self._owned) <= target:
+                break
+            if shard in self._owned:
+                self.backend.release(shard, self.instance_id, checkpoint)
+                del self._owned[shard]
+                self.stats["released"] += 1
+
+        if len(self._owned) < target:
+            now = time.time()
+            leases = self.backend.leases()
+            for shard in self._preference:
+                if len(self._owned) >= target:
+                    break
+                lease = leases.get(shard)
+                if shard in self._owned or (lease and lease["owner"] and lease["expires_at"] > now):
+                    continue
+                acquired, previous = self.backend.acquire(shard, self.instance_id, self.lease_ttl)
+                if acquired:
+                    self._hold(shard, started)
+                    self.stats["acquired"] += 1
+                    acquired_shards.append((shard, previous))
+        self.stats["rounds"] += 1
+        return acquired_shards
+
+    async def run(self) -> None:
+        """stop() が呼ばれるまで担当シャードを調整し続ける"""
+        print(f"🧩 シャード分担開始: {self.instance_id}（シャード数 {self.shard_count}）")
+        while not self._stopping.is_set():
+            try:
+                # チェックポイントの読み取りと引き継ぎの通知はワーカーの状態に触れるため、イベントループ上で行う
+                acquired = await asyncio.to_thread(self.rebalance, self.checkpoint())
+                for shard, previous in acquired:
+                    self.on_acquire(shard, previous)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"⚠️ シャードのリース更新失敗: {e}")
+            self.ready.set()
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.lease_ttl / 3)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self) -> None:
+        """担当シャードを解放して生存情報を削除する（他のインスタンスがすぐに引き継げるようにする）"""
+        self._stopping.set()
+        checkpoint = self.checkpoint()
+        owned, self._owned = list(self._owned), {}
+
+        def leave():
+            for shard in owned:
+                self.backend.release(shard, self.instance_id, checkpoint)
+            self.backend.leave(self.instance_id)
+
+        try:
+            await asyncio.to_thread(leave)
+        except Exception as e:
+            print(f"⚠️ シャードの解放失敗（リースの期限切れ後に引き継がれます）: {e}")
+
+    def metrics(self) -> Dict[str, Any]:
+        owned = self.owned_shards()
+        return {
+            "instance_id": self.instance_id,
+            "members": len(self.members),
+            "shard_count": self.shard_count,
+            "owned": len(owned),
+            "owned_shards": owned,
+            **self.stats
+        }
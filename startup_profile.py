@@ -0,0 +1,85 @@
+"""
+起動時間の計測
+
+モジュールのインポートやクライアントの初期化にかかった時間を記録し、
+/debug/startup で内訳を確認できるようにする。
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+
+class StartupProfile:
+    """起動フェーズごとの所要時間を記録する"""
+
+    def __init__(self):
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self.started_at = datetime.now().isoformat()
+        self.phases: List[Dict[str, Any]] = []
+        self.ready_after_ms: Optional[float] = None
+        self.warmup_done_after_ms: Optional[float] = None
+
+    def _elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self._origin) * 1000, 1)
+
+    @contextmanager
+    def phase(self, name: str, kind: str = "import"):
+        """
+        with ブロックの所要時間を1フェーズとして記録する
+
+        Args:
+            name: フェーズ名（例: "import:supabase_client"）
+            kind: 種別（"import", "init", "warmup"）
+        """
+        started_ms = self._elapsed_ms()
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            entry = {
+                "name": name,
+                "kind": kind,
+                "started_at_ms": started_ms,
+                "duration_ms": round((time.perf_counter() - start) * 1000, 1),
+            }
+            if error:
+                entry["error"] = error
+            with self._lock:
+                self.phases.append(entry)
+
+    def mark_ready(self) -> None:
+        """リクエスト受付可能になった時点を記録する"""
+        self.ready_after_ms = self._elapsed_ms()
+
+    def mark_warmup_done(self) -> None:
+        """バックグラウンドの事前初期化が終わった時点を記録する"""
+        self.warmup_done_after_ms = self._elapsed_ms()
+
+    def report(self) -> Dict[str, Any]:
+        """フェーズの内訳と種別ごとの合計を返す"""
+        with self._lock:
+            phases = list(self.phases)
+        totals: Dict[str, float] = {}
+        for entry in phases:
+            totals[entry["kind"]] = round(totals.get(entry["kind"], 0.0) + entry["duration_ms"], 1)
+        return {
+            "pid": os.getpid(),
+            "started_at": self.started_at,
+            "ready_after_ms": self.ready_after_ms,
+            "warmup_done_after_ms": self.warmup_done_after_ms,
+            "totals_ms": totals,
+            "phases": phases,
+        }
+
+
+# プロセス全体で共有する計測結果（main.py から最初にインポートされる）
+startup_profile = StartupProfile()
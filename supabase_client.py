@@ -4,12 +4,51 @@ Supabase Client for vibe_whisper_prompt and vibe_whisper_summary tables
 
 import os
 import math
-from typing import Dict, Any, Optional, List
-from supabase import create_client, Client
+import asyncio
+from typing import Dict, Any, Optional, List, Set, Tuple, TYPE_CHECKING
 from datetime import datetime
 import json
 
+if TYPE_CHECKING:
+    from supabase import Client
+
+# in_ クエリ1回あたりのデバイス数（URL長の上限対策）
+IN_QUERY_CHUNK_SIZE = 100
+
+# dashboard_summary の複数行を1回で更新するSQL関数（README参照、空にすると1行ずつのUPDATEのみ）
+DASHBOARD_BULK_UPDATE_RPC = os.getenv("DASHBOARD_BULK_UPDATE_RPC", "update_dashboard_summary_analyses")
+
+# SQL関数が使えない場合に、1行ずつのUPDATEを同時に実行する数
+DASHBOARD_UPDATE_CONCURRENCY = int(os.getenv("DASHBOARD_UPDATE_CONCURRENCY", "8"))
+
+
+# NaN/Infinity値をNoneに変換する関数（dict・listは再帰的に処理）
+def sanitize_value(value):
+    if isinstance(value, dict):
+        return sanitize_dict(value)
+    if isinstance(value, list):
+        return sanitize_list(value)
+    if isinstance(value, float):
+        if math.isnan(value) or math.isinf(value):
+            return None
+    return value
+
+
+def sanitize_list(lst):
+    if lst is None:
+        return []
+    return [sanitize_value(item) for item in lst]
+
+
+def sanitize_dict(d):
+    if d is None:
+        return {}
+    return {key: sanitize_value(value) for key, value in d.items()}
+
 class SupabaseClient:
+    # 一括更新のSQL関数が未作成と分かった後は呼ばない
+    _bulk_update_rpc_missing = False
+
     def __init__(self):
         """Initialize Supabase client"""
         url = os.getenv("SUPABASE_URL")
@@ -18,7 +57,10 @@ class SupabaseClient:
         if not url or not key:
             raise ValueError("SUPABASE_URL and SUPABASE_KEY must be set in environment variables")
         
-        self.client: Client = create_client(url, key)
+        # supabaseパッケージ（gotrue/postgrest/realtime/storage）は読み込みが重いため遅延インポート
+        from supabase import create_client
+
+        self.client: "Client" = create_client(url, key)
         print(f"✅ Supabase client initialized: {url}")
     
     async def get_vibe_whisper_prompt(self, device_id: str, target_date: str) -> Optional[Dict[str, Any]]:
@@ -78,31 +120,6 @@ class SupabaseClient:
             bool: 保存成功時True
         """
         try:
-            # NaN/Infinity値をNoneに変換する関数
-            def sanitize_value(value):
-                if isinstance(value, float):
-                    if math.isnan(value) or math.isinf(value):
-                        return None
-                return value
-            
-            def sanitize_list(lst):
-                if lst is None:
-                    return []
-                return [sanitize_value(item) if not isinstance(item, dict) else sanitize_dict(item) for item in lst]
-            
-            def sanitize_dict(d):
-                if d is None:
-                    return {}
-                result = {}
-                for key, value in d.items():
-                    if isinstance(value, list):
-                        result[key] = sanitize_list(value)
-                    elif isinstance(value, dict):
-                        result[key] = sanitize_dict(value)
-                    else:
-                        result[key] = sanitize_value(value)
-                return result
-            
             # データをサニタイズ
             data = {
                 'device_id': device_id,
@@ -181,7 +198,8 @@ class SupabaseClient:
         vibe_scores: Optional[List] = None,
         average_vibe: Optional[float] = None,
         insights: Optional[List] = None,
-        burst_events: Optional[List[Dict[str, Any]]] = None  # 追加
+        burst_events: Optional[List[Dict[str, Any]]] = None,  # 追加
+        incremental_state: Optional[Dict[str, Any]] = None
     ) -> bool:
         """
         dashboard_summaryテーブルのanalysis_resultフィールドを更新
@@ -194,31 +212,12 @@ class SupabaseClient:
             average_vibe: 平均Vibeスコア（オプション）
             insights: インサイト（オプション）
             burst_events: バーストイベント情報（オプション）
+            incremental_state: 差分更新の基準（オプション、incremental_stateカラムに保存）
         
         Returns:
             bool: 更新成功時True
         """
         try:
-            # NaN/Infinity値をNoneに変換する関数
-            def sanitize_value(value):
-                if isinstance(value, float):
-                    if math.isnan(value) or math.isinf(value):
-                        return None
-                return value
-            
-            def sanitize_dict(d):
-                if d is None:
-                    return {}
-                result = {}
-                for key, value in d.items():
-                    if isinstance(value, list):
-                        result[key] = [sanitize_value(item) if not isinstance(item, dict) else sanitize_dict(item) for item in value]
-                    elif isinstance(value, dict):
-                        result[key] = sanitize_dict(value)
-                    else:
-                        result[key] = sanitize_value(value)
-                return result
-            
             # 更新データを準備
             update_data = {
                 'analysis_result': sanitize_dict(analysis_result),
@@ -250,6 +249,10 @@ class SupabaseClient:
                     # リストでない場合は空のリストまたはNoneをセット
                     update_data['burst_events'] = [] if burst_events else None
             
+            # 差分更新の基準（アプリが参照するanalysis_resultとは別のカラム）
+            if incremental_state is not None:
+                update_data['incremental_state'] = sanitize_dict(incremental_state)
+            
             # デバッグ用：更新するデータを確認
             print(f"📝 Updating dashboard_summary:")
             print(f"   device_id: {device_id}")
@@ -268,4 +271,123 @@ class SupabaseClient:
                 
         except Exception as e:
             print(f"❌ Error updating dashboard_summary: {str(e)}")
-            raise e
\ No newline at end of file
+            raise e
+
+    async def get_dashboard_summary_prompts(
+        self,
+        target_date: str,
+        device_ids: Optional[List[str]] = None,
+        only_unanalyzed: bool = False
+    ) -> List[Dict[str, Any]]:
+        """
+        dashboard_summaryテーブルから指定日付の複数デバイスのpromptをまとめて取得
+
+        Args:
+            target_date: 対象日付 (YYYY-MM-DD)
+            device_ids: 対象デバイスID（省略時はその日付の全デバイス）
+            only_unanalyzed: Trueの場合、analysis_resultが未保存の行のみ
+
+        Returns:
+            List[Dict]: 行データ（device_id, date, prompt, analysis_result, updated_at）
+        """
+        columns = 'device_id, date, prompt, analysis_result, updated_at'
+
+        def build_query():
+            query = self.client.table('dashboard_summary').select(columns).eq('date', target_date)
+            if only_unanalyzed:
+                query = query.is_('analysis_result', 'null')
+            return query
+
+        try:
+            if device_ids is None:
+                rows = build_query().execute().data or []
+            else:
+                rows = []
+                for start in range(0, len(device_ids), IN_QUERY_CHUNK_SIZE):
+                    chunk = device_ids[start:start + IN_QUERY_CHUNK_SIZE]
+                    rows.extend(build_query().in_('device_id', chunk).execute().data or [])
+            print(f"✅ Found {len(rows)} dashboard_summary rows for date={target_date}")
+            return rows
+
+        except Exception as e:
+            print(f"❌ Error fetching dashboard_summary rows: {str(e)}")
+            raise e
+
+    async def update_dashboard_summary_analyses(self, rows: List[Dict[str, Any]]) -> Set[Tuple[str, str]]:
+        """
+        dashboard_summaryテーブルの複数デバイスの分析結果をまとめて書き込み（UPDATE）
+
+        update_dashboard_summary_analysis と同じく既存の行のみを更新し、行は作成しない
+        （UPSERTでは prompt のない行が作られてしまうため）。
+        PostgRESTのUPDATEは1回で1つの値しか書き込めないため、SQL関数（DASHBOARD_BULK_UPDATE_RPC）で
+        全行を1回で更新する。関数が使えない場合は1行ずつのUPDATEを DASHBOARD_UPDATE_CONCURRENCY 件ずつ並行して行う。
+
+        Args:
+            rows: device_id, date と更新するカラム（analysis_result, vibe_scores など）の辞書のリスト
+
+        Returns:
+            Set[Tuple[str, str]]: 書き込めた行の (device_id, date)
+        """
+        updated_at = datetime.now().isoformat()
+        updates = []
+        for row in rows:
+            data = {column: sanitize_value(value) for column, value in row.items() if value is not None}
+            data['updated_at'] = updated_at
+            updates.append(data)
+        if not updates:
+            return set()
+
+        saved = None
+        if DASHBOARD_BULK_UPDATE_RPC and not self._bulk_update_rpc_missing:
+            try:
+                saved = await asyncio.to_thread(self._update_dashboard_summary_rpc, updates)
+            except Exception as e:
+                if "PGRST202" in str(e):
+                    # 関数が作成されていない（以降は1行ずつのUPDATEのみ）
+                    SupabaseClient._bulk_update_rpc_missing = True
+                print(f"⚠️ dashboard_summaryの一括更新（{DASHBOARD_BULK_UPDATE_RPC}）失敗。1行ずつ更新します: {str(e)}")
+        if saved is None:
+            saved = await self._update_dashboard_summary_rows(updates)
+
+        print(f"✅ Successfully updated {len(saved)}/{len(rows)} dashboard_summary rows")
+        return saved
+
+    def _update_dashboard_summary_rpc(self, updates: List[Dict[str, Any]]) -> Set[Tuple[str, str]]:
+        """SQL関数で全行を1回のリクエストで更新し、更新できた行の (device_id, date) を返す"""
+        response = self.client.rpc(DASHBOARD_BULK_UPDATE_RPC, {'updates': updates}).execute()
+        updated = {(str(row['device_id']).lower(), str(row['date'])) for row in response.data or []}
+        saved = set()
+        for data in updates:
+            key = (data['device_id'], data['date'])
+            if (str(key[0]).lower(), str(key[1])) in updated:
+                saved.add(key)
+            else:
+                print(f"❌ No dashboard_summary row to update: device_id={key[0]}, date={key[1]}")
+        return saved
+
+    async def _update_dashboard_summary_rows(self, updates: List[Dict[str, Any]]) -> Set[Tuple[str, str]]:
+        """1行ずつのUPDATEを DASHBOARD_UPDATE_CONCURRENCY 件ずつ並行して行い、更新できた行の (device_id, date) を返す"""
+        semaphore = asyncio.Semaphore(max(1, DASHBOARD_UPDATE_CONCURRENCY))
+
+        def update_row(data: Dict[str, Any]) -> bool:
+            key = (data['device_id'], data['date'])
+            values = {column: value for column, value in data.items() if column not in ('device_id', 'date')}
+            try:
+                response = self.client.table('dashboard_summary').update(values).eq('device_id', key[0]).eq('date', key[1]).execute()
+            except Exception as e:
+                print(f"❌ Error updating dashboard_summary: device_id={key[0]}, date={key[1]}: {str(e)}")
+                return False
+            if not response.data:
+                print(f"❌ No dashboard_summary row to update: device_id={key[0]}, date={key[1]}")
+            return bool(response.data)
+
+        async def update(data: Dict[str, Any]) -> bool:
+            async with semaphore:
+                return await asyncio.to_thread(update_row, data)
+
+        results = await asyncio.gather(*(update(data) for data in updates))
+        return {(data['device_id'], data['date']) for data, ok in zip(updates, results) if ok}
+
+        saved = await asyncio.to_thread(update_rows)
+        print(f"✅ Successfully updated {len(saved)}/{len(rows)} dashboard_summary rows")
+        return saved
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+バッチAPIモード（llm_providers のバッチ処理）のテストスクリプト
+
+ベンダーの代わりに LocalBatchStub を使用するため、APIキーやサーバーの起動は不要。
+"""
+
+import asyncio
+import json
+import sys
+
+from llm_providers import (
+    LLMProvider, LocalBatchStub, build_batch_jsonl, parse_batch_output, run_batch_job, run_batch_job_async
+)
+
+
+class EchoProvider(LLMProvider):
+    """リクエストボディの作成だけを行うテスト用プロバイダー"""
+
+    def generate(self, prompt: str) -> str:
+        raise NotImplementedError
+
+    def build_request_body(self, prompt: str):
+        return {"model": "test-model", "messages": [{"role": "user", "content": prompt}]}
+
+    @property
+    def model_name(self) -> str:
+        return "test/test-model"
+
+
+def responder(body):
+    """プロンプトに応じた応答を返す（"fail"を含む場合はエラー行にする）"""
+    prompt = body["messages"][0]["content"]
+    if "fail" in prompt:
+        raise RuntimeError("rate limited")
+    return json.dumps({"summary": prompt, "behavior": "test", "vibe_score": len(prompt)})
+
+
+def test_batch_round_trip():
+    """JSONL作成 → 投入 → ポーリング → 結果の対応付けまでを確認"""
+    prompts = [("t0", "block-a"), ("t1", "block-bb"), ("t2", "fail-block")]
+    jsonl = build_batch_jsonl(EchoProvider(), prompts)
+
+    lines = [json.loads(line) for line in jsonl.splitlines()]
+    assert [line["custom_id"] for line in lines] == ["t0", "t1", "t2"]
+    assert lines[0]["url"] == "/v1/chat/completions"
+
+    submitted = []
+    backend = LocalBatchStub(responder, polls_until_complete=3)
+    results = run_batch_job(backend, jsonl, poll_interval=0, on_submitted=submitted.append)
+
+    assert len(submitted) == 1
+    assert json.loads(results["t0"]["content"])["vibe_score"] == len("block-a")
+    assert json.loads(results["t1"]["content"])["summary"] == "block-bb"
+    assert "error" in results["t2"]
+    print("✅ バッチ往復テスト成功")
+
+
+def test_batch_round_trip_async():
+    """asyncio版でも同じ結果になり、待機中もイベントループが止まらないことを確認"""
+    jsonl = build_batch_jsonl(EchoProvider(), [("t0", "block-a"), ("t1", "fail-block")])
+    backend = LocalBatchStub(responder, polls_until_complete=3)
+
+    async def run():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.001)
+
+        ticker_task = asyncio.create_task(ticker())
+        try:
+            results = await run_batch_job_async(backend, jsonl, poll_interval=0.01)
+        finally:
+            ticker_task.cancel()
+        return results, ticks
+
+    results, ticks = asyncio.run(run())
+    assert json.loads(results["t0"]["content"])["summary"] == "block-a"
+    assert "error" in results["t1"]
+    assert ticks > 1
+    print("✅ バッチ往復テスト（asyncio版）成功")
+
+
+def test_parse_batch_output_errors():
+    """ステータスコードが200以外の行はエラーとして扱う"""
+    output = json.dumps({
+        "custom_id": "t0",
+        "response": {"status_code": 429, "body": {"error": "rate limited"}},
+        "error": None
+    })
+    results = parse_batch_output(output)
+    assert results["t0"] == {"error": {"error": "rate limited"}}
+    print("✅ エラー行のテスト成功")
+
+
+def main():
+    """メイン処理"""
+    print("\n🧪 バッチAPIモードのテスト")
+    print("-" * 60)
+    test_batch_round_trip()
+    test_batch_round_trip_async()
+    test_parse_batch_output_errors()
+    print("\n✨ テスト完了!")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except AssertionError as e:
+        print(f"\n❌ テスト失敗: {e}")
+        sys.exit(1)
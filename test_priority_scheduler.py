@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+優先度レーン付きの同時実行数制御（analysis_scheduler.PriorityScheduler）のテストスクリプト
+
+LLMの代わりに asyncio.Event で実行枠の保持時間を制御するため、APIキーやサーバーの起動は不要。
+"""
+
+import asyncio
+import sys
+from typing import List, Optional
+
+from analysis_scheduler import PriorityScheduler
+
+
+async def hold(
+    scheduler: PriorityScheduler,
+    lane: str,
+    device_id: Optional[str],
+    started: List[str],
+    release: asyncio.Event,
+    label: str
+) -> None:
+    """実行枠を確保したら label を記録し、release が設定されるまで保持する"""
+    async with scheduler.slot(lane, device_id):
+        started.append(label)
+        await release.wait()
+
+
+async def settle() -> None:
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def finish(release: asyncio.Event, tasks: List[asyncio.Task]) -> None:
+    release.set()
+    await asyncio.gather(*tasks)
+
+
+def test_higher_lane_goes_first():
+    """枠が空いた時は、先に待っていた下位レーンより上位レーンに割り当てる"""
+    async def run():
+        scheduler = PriorityScheduler(capacity=1)
+        started: List[str] = []
+        first = asyncio.Event()
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(hold(scheduler, "backfill", "a", started, first, "running"))]
+        await settle()
+        tasks.append(asyncio.create_task(hold(scheduler, "backfill", "b", started, release, "backfill")))
+        tasks.append(asyncio.create_task(hold(scheduler, "scheduled", "c", started, release, "scheduled")))
+        tasks.append(asyncio.create_task(hold(scheduler, "interactive", "d", started, release, "interactive")))
+        await settle()
+        assert scheduler.queued == 3 and scheduler.ahead_of("interactive") == 2
+
+        first.set()
+        await settle()
+        release.set()
+        await asyncio.gather(*tasks)
+        assert started == ["running", "interactive", "scheduled", "backfill"], started
+
+    asyncio.run(run())
+    print("✅ レーンの優先順位テスト成功")
+
+
+def test_lane_limits():
+    """各レーンは capacity × 割合 までしか同時に実行しない（上位レーンの枠を残す）"""
+    async def run():
+        scheduler = PriorityScheduler(capacity=4, lane_shares={"interactive": 1.0, "scheduled": 0.75, "backfill": 0.5})
+        started: List[str] = []
+        release = asyncio.Event()
+        tasks = [
+            asyncio.create_task(hold(scheduler, "backfill", f"dev-{i}", started, release, f"backfill-{i}"))
+            for i in range(4)
+        ]
+        await settle()
+        assert scheduler.inflight == 2 and scheduler.queued == 2
+
+        tasks += [
+            asyncio.create_task(hold(scheduler, "interactive", f"user-{i}", started, release, f"interactive-{i}"))
+            for i in range(2)
+        ]
+        await settle()
+        assert scheduler.inflight == 4
+        assert sorted(label for label in started if label.startswith("interactive")) == ["interactive-0", "interactive-1"]
+        await finish(release, tasks)
+        assert scheduler.inflight == 0 and scheduler.queued == 0
+
+    asyncio.run(run())
+    print("✅ レーンの同時実行数の上限テスト成功")
+
+
+def test_devices_share_a_lane_fairly():
+    """1台のデバイスが大量に待機していても、後から来た他のデバイスが先に割り当てられる"""
+    async def run():
+        scheduler = PriorityScheduler(
+            capacity=2, lane_shares={"interactive": 1.0, "scheduled": 1.0, "backfill": 1.0}, device_burst=0
+        )
+        started: List[str] = []
+        events = {}
+        tasks = []
+
+        def submit(device_id: str, number: int) -> None:
+            label = f"{device_id}-{number}"
+            events[label] = asyncio.Event()
+            tasks.append(asyncio.create_task(hold(scheduler, "scheduled", device_id, started, events[label], label)))
+
+        for number in range(6):
+            submit("heavy", number)
+        await settle()
+        for number in range(2):
+            submit("light", number)
+        await settle()
+        # device_limit（デフォルト: capacity の半分）までしか実行せず、残りは light に割り当てる
+        assert started == ["heavy-0", "light-0"], started
+
+        # light の2件目は、先に待っていた heavy の5件より先に割り当てられる
+        events["light-0"].set()
+        await settle()
+        assert started == ["heavy-0", "light-0", "light-1"], started
+        events["heavy-0"].set()
+        await settle()
+        assert started[3] == "heavy-1", started
+
+        for event in events.values():
+            event.set()
+        await asyncio.gather(*tasks)
+        assert len(started) == 8
+
+    asyncio.run(run())
+    print("✅ デバイス間の公平な割り当てテスト成功")
+
+
+def test_device_burst_when_alone():
+    """他のデバイスが待機していなければ、device_limit を超えて device_burst まで実行できる"""
+    async def run():
+        scheduler = PriorityScheduler(capacity=4, lane_shares={"interactive": 1.0, "scheduled": 1.0, "backfill": 1.0})
+        started: List[str] = []
+        release = asyncio.Event()
+        tasks = [
+            asyncio.create_task(hold(scheduler, "scheduled", "only", started, release, f"only-{i}"))
+            for i in range(5)
+        ]
+        await settle()
+        assert scheduler.inflight == 4 and scheduler.queued == 1
+        await finish(release, tasks)
+
+    asyncio.run(run())
+    print("✅ デバイスのバースト枠テスト成功")
+
+
+def test_device_weights():
+    """重みの大きいデバイスは、重みに比例して多く割り当てられる"""
+    async def run():
+        scheduler = PriorityScheduler(
+            capacity=1,
+            lane_shares={"interactive": 1.0, "scheduled": 1.0, "backfill": 1.0},
+            device_weights={"premium": 2.0}
+        )
+        started: List[str] = []
+        gate = asyncio.Event()
+        tasks = [asyncio.create_task(hold(scheduler, "scheduled", "blocker", started, gate, "blocker"))]
+        await settle()
+
+        release = asyncio.Event()
+        release.set()
+        for number in range(6):
+            tasks.append(asyncio.create_task(hold(scheduler, "scheduled", "premium", started, release, "premium")))
+            tasks.append(asyncio.create_task(hold(scheduler, "scheduled", "basic", started, release, "basic")))
+        await settle()
+        gate.set()
+        await asyncio.gather(*tasks)
+        first_six = started[1:7]
+        assert first_six.count("premium") == 4 and first_six.count("basic") == 2, first_six
+
+    asyncio.run(run())
+    print("✅ デバイスの重み付けテスト成功")
+
+
+def test_cancelled_waiter_frees_its_place():
+    """待機中にキャンセルされた処理は待ち行列から外れ、実行中のキャンセルは枠を返す"""
+    async def run():
+        scheduler = PriorityScheduler(capacity=1)
+        started: List[str] = []
+        release = asyncio.Event()
+        running = asyncio.create_task(hold(scheduler, "interactive", "a", started, release, "running"))
+        await settle()
+        waiting = asyncio.create_task(hold(scheduler, "interactive", "b", started, release, "cancelled"))
+        await settle()
+        assert scheduler.queued == 1
+
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert scheduler.queued == 0
+        await finish(release, [running])
+        assert scheduler.inflight == 0 and started == ["running"]
+
+        # 枠を割り当てられた後にキャンセルされても枠は返却される
+        blocker_release = asyncio.Event()
+        blocker = asyncio.create_task(hold(scheduler, "interactive", "a", started, blocker_release, "blocker"))
+        await settle()
+        late = asyncio.create_task(hold(scheduler, "interactive", "b", started, asyncio.Event(), "late"))
+        await settle()
+        blocker_release.set()
+        await blocker
+        late.cancel()
+        await asyncio.gather(late, return_exceptions=True)
+        assert scheduler.inflight == 0 and scheduler.queued == 0
+
+    asyncio.run(run())
+    print("✅ 待機中のキャンセルのテスト成功")
+
+
+def main():
+    """メイン処理"""
+    print("\n🧪 優先度レーン・デバイス間の公平性のテスト")
+    print("-" * 60)
+    test_higher_lane_goes_first()
+    test_lane_limits()
+    test_devices_share_a_lane_fairly()
+    test_device_burst_when_alone()
+    test_device_weights()
+    test_cancelled_waiter_frees_its_place()
+    print("\n✨ テスト完了!")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except AssertionError as e:
+        print(f"\n❌ テスト失敗: {e}")
+        sys.exit(1)
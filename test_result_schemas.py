@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+分析結果のスキーマ（result_schemas.py）の項目単位の検証のテストスクリプト
+
+LLMやSupabaseは使用しないため、APIキーやサーバーの起動は不要。
+"""
+
+import sys
+
+from result_schemas import RESULT_SCHEMAS
+
+NAN = float("nan")
+
+
+def test_nan_slots_are_not_problems():
+    """未分析のスロット（"NaN" → float('nan')・null）は正しい回答として扱う"""
+    dashboard = RESULT_SCHEMAS["dashboard_summary"]
+    scores = [10, NAN, None] + [0] * 45
+    assert dashboard.problems({"cumulative_evaluation": "評価", "emotionScores": scores}) == {}
+    assert dashboard.problems({"insights": "評価", "vibeScores": scores, "averageVibe": NAN}) == {}
+    assert RESULT_SCHEMAS["vibegraph"].problems({"emotionScores": [NAN] * 48}) == {}
+
+    timeblock = RESULT_SCHEMAS["timeblock"]
+    assert timeblock.problems({"summary": "観測なし", "behavior": "不明", "vibe_score": NAN}) == {}
+    assert timeblock.problems({"summary": "観測なし", "behavior": "不明", "vibe_score": None}) == {}
+    print("✅ NaNスロットのテスト成功")
+
+
+def test_invalid_fields_are_detected():
+    """欠けている・不正な項目だけを検出する"""
+    timeblock = RESULT_SCHEMAS["timeblock"]
+    assert timeblock.problems({"summary": "要約", "behavior": ""}) == {"behavior": "empty", "vibe_score": "missing"}
+    assert timeblock.problems({"summary": "要約", "behavior": "会話", "vibe_score": 150}) == {"vibe_score": "out_of_range"}
+    assert RESULT_SCHEMAS["vibegraph"].problems({"emotionScores": [NAN] * 40}) == {"emotionScores": "wrong_length"}
+    assert RESULT_SCHEMAS["vibegraph"].problems({"emotionScores": ["高い"] + [0] * 47}) == {"emotionScores": "invalid_items"}
+    print("✅ 不正な項目の検出テスト成功")
+
+
+def test_merge_keeps_original_key():
+    """修復の応答は検証を通過した項目だけを、元の応答のキー（別名）にマージする"""
+    dashboard = RESULT_SCHEMAS["dashboard_summary"]
+    result = {"insights": "評価", "averageVibe": 300}
+    problems = dashboard.problems(result)
+    assert problems == {"averageVibe": "out_of_range"}
+    assert dashboard.merge(result, {"averageScore": 12}, problems) == ["averageVibe"]
+    assert result["averageVibe"] == 12 and "averageScore" not in result
+    assert dashboard.merge(result, {"averageVibe": 500}, problems) == []
+    print("✅ マージのテスト成功")
+
+
+def main():
+    """メイン処理"""
+    print("\n🧪 分析結果のスキーマのテスト")
+    print("-" * 60)
+    test_nan_slots_are_not_problems()
+    test_invalid_fields_are_detected()
+    test_merge_keeps_original_key()
+    print("\n✨ テスト完了!")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except AssertionError as e:
+        print(f"\n❌ テスト失敗: {e}")
+        sys.exit(1)
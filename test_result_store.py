@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+LLM分析結果のローカル保存（result_store.py）のテストスクリプト
+
+一時ディレクトリにストアを作成するため、APIキーやSupabase・サーバーの起動は不要。
+"""
+
+import multiprocessing
+import os
+import sys
+import tempfile
+
+from result_store import ResultStore
+
+DATE = "2025-11-10"
+
+
+def new_store_path() -> str:
+    return os.path.join(tempfile.mkdtemp(), "results.jsonl")
+
+
+def append(store: ResultStore, device_id: str, time_block: str = "14-00", prompt_hash: str = "h", score: int = 0) -> str:
+    return store.append_result(
+        "timeblock", device_id, DATE, time_block, prompt_hash, {"vibe_score": score}, "test/model"
+    )
+
+
+def test_saved_results_are_not_replayed():
+    """保存済みの結果・より新しいプロンプトの結果がある古い結果は未保存として扱わない"""
+    store = ResultStore(new_store_path(), compact_bytes=0)
+    first = append(store, "dev-a", prompt_hash="old", score=1)
+    append(store, "dev-a", prompt_hash="new", score=2)
+    saved = append(store, "dev-b", score=3)
+    append(store, "dev-c", score=4)
+    store.mark_saved([saved])
+
+    assert store.find_unsaved("timeblock", "dev-a", DATE, "14-00", "new")["analysis_result"] == {"vibe_score": 2}
+    assert store.find_unsaved("timeblock", "dev-b", DATE, "14-00", "h") is None
+    assert [record["key"][1] for record in store.unsaved()] == ["dev-a", "dev-c"]
+    assert [record["analysis_result"]["vibe_score"] for record in store.unsaved(limit=1)] == [2]
+
+    # 古いプロンプトの結果を保存済みにしても、新しい結果は未保存のまま
+    store.mark_saved([first])
+    assert store.stats()["unsaved"] == 2
+    print("✅ 保存済み・未保存の判定テスト成功")
+
+
+def test_other_worker_appends_are_indexed():
+    """他のワーカー（別インスタンス）が追記した結果・保存完了を差分で読み込む"""
+    path = new_store_path()
+    writer = ResultStore(path, compact_bytes=0)
+    reader = ResultStore(path, compact_bytes=0)
+
+    record_id = append(writer, "dev-a")
+    assert reader.find_unsaved("timeblock", "dev-a", DATE, "14-00", "h")["id"] == record_id
+    append(writer, "dev-b")
+    writer.mark_saved([record_id])
+    assert [record["key"][1] for record in reader.unsaved()] == ["dev-b"]
+    print("✅ 他のワーカーの追記の読み込みテスト成功")
+
+
+def test_compact_keeps_only_unsaved():
+    """compact() は未保存の結果だけを残し、他のワーカーは置き換え後のファイルを読み直す"""
+    path = new_store_path()
+    store = ResultStore(path, compact_bytes=0)
+    other = ResultStore(path, compact_bytes=0)
+    ids = [append(store, f"dev-{i}", score=i) for i in range(5)]
+    store.mark_saved(ids[:3])
+    assert len(other.unsaved()) == 2
+    size_before = os.path.getsize(path)
+
+    assert store.compact() == 2
+    assert os.path.getsize(path) < size_before
+    # 置き換え前に索引を作ったインスタンスも同じ結果を返す
+    assert [record["analysis_result"]["vibe_score"] for record in other.unsaved()] == [3, 4]
+    assert other.find_unsaved("timeblock", "dev-4", DATE, "14-00", "h")["id"] == ids[4]
+
+    # compact 後の追記・保存完了も反映される
+    store.mark_saved([ids[3]])
+    assert [record["id"] for record in other.unsaved()] == [ids[4]]
+    print("✅ compact のテスト成功")
+
+
+def test_automatic_compact():
+    """ファイルが compact_bytes を超えたら保存済みの結果を削除する"""
+    path = new_store_path()
+    store = ResultStore(path, compact_bytes=4096)
+    for i in range(50):
+        store.mark_saved([append(store, f"dev-{i}")])
+    kept = append(store, "dev-last")
+    assert os.path.getsize(path) < 4096 * 2
+    assert [record["id"] for record in store.unsaved()] == [kept]
+    print("✅ 自動 compact のテスト成功")
+
+
+def test_mismatched_index_entry_is_skipped():
+    """索引のオフセットが別のレコードを指している場合は、そのレコードを返さない"""
+    store = ResultStore(new_store_path(), compact_bytes=0)
+    append(store, "dev-a")
+    append(store, "dev-b")
+    assert len(store.unsaved()) == 2
+    key = ("timeblock", "dev-b", DATE, "14-00", "h")
+    store._latest[key] = (0, store._latest[key][1])
+    assert store.find_unsaved("timeblock", "dev-b", DATE, "14-00", "h") is None
+    assert [record["key"][1] for record in store.unsaved()] == ["dev-a"]
+    print("✅ 索引と一致しないレコードのテスト成功")
+
+
+def append_many(path: str, worker: int, count: int) -> None:
+    store = ResultStore(path, compact_bytes=4096)
+    for i in range(count):
+        record_id = append(store, f"w{worker}-{i}")
+        if i % 2 == 0:
+            store.mark_saved([record_id])
+
+
+def test_concurrent_workers_with_compact():
+    """複数プロセスの追記と compact が重なっても未保存の結果は失われない"""
+    path = new_store_path()
+    workers, count = 4, 60
+    processes = [multiprocessing.Process(target=append_many, args=(path, worker, count)) for worker in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    unsaved = {record["key"][1] for record in ResultStore(path, compact_bytes=0).unsaved()}
+    expected = {f"w{worker}-{i}" for worker in range(workers) for i in range(1, count, 2)}
+    assert unsaved == expected, f"失われた結果: {sorted(expected - unsaved)[:5]}"
+    print("✅ 複数プロセスの追記と compact のテスト成功")
+
+
+def main():
+    """メイン処理"""
+    print("\n🧪 結果ストアのテスト")
+    print("-" * 60)
+    test_saved_results_are_not_replayed()
+    test_other_worker_appends_are_indexed()
+    test_compact_keeps_only_unsaved()
+    test_automatic_compact()
+    test_mismatched_index_entry_is_skipped()
+    test_concurrent_workers_with_compact()
+    print("\n✨ テスト完了!")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except AssertionError as e:
+        print(f"\n❌ テスト失敗: {e}")
+        sys.exit(1)
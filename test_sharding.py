@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+複数インスタンス間の処理の分担（sharding.py）のテストスクリプト
+
+リースは一時ディレクトリの FileLeaseBackend で管理するため、Supabaseやサーバーの起動は不要。
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from sharding import FileLeaseBackend, ShardCoordinator, shard_of
+
+SHARDS = 8
+
+
+def new_backend() -> FileLeaseBackend:
+    return FileLeaseBackend(os.path.join(tempfile.mkdtemp(), "leases.json"))
+
+
+def coordinator(backend: FileLeaseBackend, instance_id: str, ttl: float = 30) -> ShardCoordinator:
+    return ShardCoordinator(backend, instance_id=instance_id, shard_count=SHARDS, lease_ttl=ttl)
+
+
+def test_single_instance_owns_everything():
+    """インスタンスが1つならすべてのシャード（すべての device_id）を担当する"""
+    single = coordinator(new_backend(), "a")
+    acquired = single.rebalance()
+    assert sorted(shard for shard, _ in acquired) == list(range(SHARDS))
+    assert single.owned_shards() == list(range(SHARDS))
+    assert all(single.owns(f"device-{i}") for i in range(20))
+    # 2回目以降はリースを更新するだけで、新たに取得しない
+    assert single.rebalance() == []
+    print("✅ 単一インスタンスのテスト成功")
+
+
+def test_new_instance_gets_half():
+    """インスタンスが増えると既存のインスタンスがシャードを解放し、重複なく分担する"""
+    backend = new_backend()
+    first, second = coordinator(backend, "a"), coordinator(backend, "b")
+    first.rebalance(checkpoint="cp-a")
+    # 全シャードのリースが有効なため、後から参加したインスタンスはまだ取得できない
+    assert second.rebalance() == []
+    first.rebalance(checkpoint="cp-a")
+    assert len(first.owned_shards()) == SHARDS // 2
+
+    acquired = second.rebalance()
+    # 解放されたシャードのチェックポイントから取り込み直す
+    assert acquired and all(previous == "cp-a" for _, previous in acquired)
+    owned_first, owned_second = set(first.owned_shards()), set(second.owned_shards())
+    assert not owned_first & owned_second
+    assert owned_first | owned_second == set(range(SHARDS))
+    for i in range(50):
+        device_id = f"device-{i}"
+        assert first.owns(device_id) != second.owns(device_id)
+        assert (shard_of(device_id, SHARDS) in owned_first) == first.owns(device_id)
+    print("✅ インスタンス追加時の分担テスト成功")
+
+
+def test_takeover_after_lease_expires():
+    """停止したインスタンスのシャードは、リースが切れた後に他のインスタンスが引き継ぐ"""
+    backend = new_backend()
+    crashed, survivor = coordinator(backend, "a", ttl=0.3), coordinator(backend, "b", ttl=0.3)
+    crashed.rebalance(checkpoint="cp-crashed")
+    survivor.rebalance()
+    crashed.rebalance(checkpoint="cp-crashed")
+    survivor.rebalance()
+    crashed_shards = set(crashed.owned_shards())
+    assert crashed_shards
+
+    # crashed はリースを更新しなくなる。期限の LEASE_SAFETY_RATIO が過ぎたら担当をやめる
+    time.sleep(0.5)
+    assert crashed.owned_shards() == []
+    acquired = dict(survivor.rebalance())
+    assert set(acquired) == crashed_shards
+    assert set(acquired.values()) == {"cp-crashed"}
+    assert survivor.owned_shards() == list(range(SHARDS))
+
+    # 復帰した crashed のリース更新は失敗し、担当に戻らない
+    crashed.rebalance()
+    assert not set(crashed.owned_shards()) & set(survivor.owned_shards())
+    print("✅ リース切れ後の引き継ぎテスト成功")
+
+
+def test_stop_releases_immediately():
+    """stop() でリースを解放すると、期限を待たずに他のインスタンスが引き継げる"""
+    async def run():
+        backend = new_backend()
+        leaving, staying = coordinator(backend, "a"), coordinator(backend, "b")
+        leaving.checkpoint = lambda: "cp-leaving"
+        leaving.rebalance()
+        staying.rebalance()
+        await leaving.stop()
+        acquired = dict(staying.rebalance())
+        assert set(acquired) == set(range(SHARDS))
+        assert set(acquired.values()) == {"cp-leaving"}
+
+    asyncio.run(run())
+    print("✅ 停止時の解放テスト成功")
+
+
+def test_run_calls_hooks_on_event_loop():
+    """run() はリースの読み書きだけをスレッドで行い、checkpoint と on_acquire はイベントループ上で呼ぶ"""
+    async def run():
+        loop_thread = threading.get_ident()
+        calls = []
+        shard_coordinator = coordinator(new_backend(), "a", ttl=0.3)
+
+        def checkpoint():
+            calls.append(("checkpoint", threading.get_ident()))
+            return "cp"
+
+        def on_acquire(shard, previous):
+            calls.append(("on_acquire", threading.get_ident()))
+
+        shard_coordinator.checkpoint = checkpoint
+        shard_coordinator.on_acquire = on_acquire
+        task = asyncio.create_task(shard_coordinator.run())
+        await shard_coordinator.ready.wait()
+        await asyncio.sleep(0.25)
+        await shard_coordinator.stop()
+        await task
+
+        assert [name for name, _ in calls].count("on_acquire") == SHARDS
+        assert {thread for _, thread in calls} == {loop_thread}
+        assert shard_coordinator.stats["rounds"] >= 2 and shard_coordinator.stats["errors"] == 0
+
+    asyncio.run(run())
+    print("✅ イベントループ上での通知テスト成功")
+
+
+def main():
+    """メイン処理"""
+    print("\n🧪 シャーディングのテスト")
+    print("-" * 60)
+    test_single_instance_owns_everything()
+    test_new_instance_gets_half()
+    test_takeover_after_lease_expires()
+    test_stop_releases_immediately()
+    test_run_calls_hooks_on_event_loop()
+    print("\n✨ テスト完了!")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except AssertionError as e:
+        print(f"\n❌ テスト失敗: {e}")
+        sys.exit(1)
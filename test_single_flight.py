@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+同一キーの同時実行の集約（analysis_scheduler.SingleFlight）のテストスクリプト
+
+LLMの代わりに asyncio.Event で処理の完了を制御するため、APIキーやサーバーの起動は不要。
+"""
+
+import asyncio
+import sys
+
+from analysis_scheduler import SingleFlight
+
+
+async def settle() -> None:
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+class Work:
+    """実行回数とキャンセルを記録する処理（release が設定されるまで完了しない）"""
+
+    def __init__(self, result="result"):
+        self.result = result
+        self.release = asyncio.Event()
+        self.calls = 0
+        self.cancelled = False
+
+    async def __call__(self):
+        self.calls += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+def test_concurrent_calls_share_one_execution():
+    """同じキーの同時呼び出しは1回だけ実行し、全員が同じ結果を受け取る"""
+    async def run():
+        flights = SingleFlight()
+        work = Work()
+        callers = [asyncio.create_task(flights.run("key", work)) for _ in range(5)]
+        await settle()
+        assert flights.inflight_count() == 1
+        work.release.set()
+        results = await asyncio.gather(*callers)
+
+        assert work.calls == 1
+        assert [coalesced for _, coalesced in results] == [False, True, True, True, True]
+        assert all(result == "result" for result, _ in results)
+        assert flights.inflight_count() == 0
+        assert flights.stats == {"executed": 1, "coalesced": 4, "abandoned": 0}
+
+        # 完了後の呼び出しは新たに実行する
+        again = Work("again")
+        again.release.set()
+        assert await flights.run("key", again) == ("again", False)
+
+    asyncio.run(run())
+    print("✅ 同時呼び出しの集約テスト成功")
+
+
+def test_different_keys_run_separately():
+    """キーが異なる呼び出しは集約しない"""
+    async def run():
+        flights = SingleFlight()
+        first, second = Work("first"), Work("second")
+        tasks = [asyncio.create_task(flights.run("a", first)), asyncio.create_task(flights.run("b", second))]
+        await settle()
+        assert flights.inflight_count() == 2
+        first.release.set()
+        second.release.set()
+        assert [result for result, _ in await asyncio.gather(*tasks)] == ["first", "second"]
+
+    asyncio.run(run())
+    print("✅ キーごとの実行テスト成功")
+
+
+def test_errors_are_shared():
+    """処理の例外は待機者全員に伝わり、キーは解放される"""
+    async def run():
+        flights = SingleFlight()
+        work = Work(RuntimeError("llm failed"))
+        callers = [asyncio.create_task(flights.run("key", work)) for _ in range(3)]
+        await settle()
+        work.release.set()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert flights.inflight_count() == 0
+
+    asyncio.run(run())
+    print("✅ 例外の共有テスト成功")
+
+
+def test_one_waiter_cancelled_others_still_get_result():
+    """待機者の1人がキャンセルされても、処理は続き他の待機者は結果を受け取る"""
+    async def run():
+        flights = SingleFlight()
+        work = Work()
+        leaving = asyncio.create_task(flights.run("key", work, persist=False))
+        staying = asyncio.create_task(flights.run("key", work, persist=False))
+        await settle()
+        leaving.cancel()
+        await asyncio.gather(leaving, return_exceptions=True)
+        await settle()
+        assert not work.cancelled
+        work.release.set()
+        assert await staying == ("result", True)
+        assert flights.stats["abandoned"] == 0
+
+    asyncio.run(run())
+    print("✅ 一部の待機者のキャンセルのテスト成功")
+
+
+def test_cancel_when_all_waiters_leave():
+    """persist=False の待機者が全員キャンセルされた場合は処理本体もキャンセルし、キーを解放する"""
+    async def run():
+        flights = SingleFlight()
+        work = Work()
+        callers = [asyncio.create_task(flights.run("key", work, persist=False)) for _ in range(3)]
+        await settle()
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await settle()
+        assert work.cancelled
+        assert flights.stats["abandoned"] == 1
+        assert flights.inflight_count() == 0
+
+        # 次の呼び出しは新たに実行する
+        retry = Work("retry")
+        retry.release.set()
+        assert await flights.run("key", retry, persist=False) == ("retry", False)
+
+    asyncio.run(run())
+    print("✅ 全待機者のキャンセル時の中止テスト成功")
+
+
+def test_persist_waiter_keeps_work_running():
+    """persist=True の待機者がいた場合は、全員がいなくなっても処理を完了させる"""
+    async def run():
+        flights = SingleFlight()
+        work = Work()
+        callers = [
+            asyncio.create_task(flights.run("key", work, persist=True)),
+            asyncio.create_task(flights.run("key", work, persist=False)),
+        ]
+        await settle()
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await settle()
+        assert not work.cancelled and flights.inflight_count() == 1
+
+        # 完了するまでの呼び出しは実行中の処理に相乗りする
+        joining = asyncio.create_task(flights.run("key", Work("unused")))
+        await settle()
+        work.release.set()
+        assert await joining == ("result", True)
+        assert flights.inflight_count() == 0 and flights.stats["abandoned"] == 0
+
+    asyncio.run(run())
+    print("✅ 完了させる待機者のテスト成功")
+
+
+def main():
+    """メイン処理"""
+    print("\n🧪 同時実行の集約（single-flight）のテスト")
+    print("-" * 60)
+    test_concurrent_calls_share_one_execution()
+    test_different_keys_run_separately()
+    test_errors_are_shared()
+    test_one_waiter_cancelled_others_still_get_result()
+    test_cancel_when_all_waiters_leave()
+    test_persist_waiter_keeps_work_running()
+    print("\n✨ テスト完了!")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except AssertionError as e:
+        print(f"\n❌ テスト失敗: {e}")
+        sys.exit(1)
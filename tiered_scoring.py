@@ -0,0 +1,85 @@
+"""
+段階的スコアリング（高速モデルでの一次判定 → 必要な場合のみ推論モデル）
+
+観測がほとんどない静かなタイムブロックは、小さなモデルでも推論モデルと同じスコアになる。
+まず高速モデルで分析し、結果が以下の判定をすべて通過した場合はそのまま採用する。
+
+- プロンプトが大きすぎない（観測が多いブロックは最初から推論モデルで分析）
+- JSONとして解析でき、タイムブロックのスキーマ（result_schemas.py）の検証を通過する
+  （観測がないブロックの vibe_score: null・NaN は正しい回答として採用する）
+- vibe_score が極端な値ではない（極端なスコアは推論モデルで確認する）
+"""
+
+import math
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+from result_schemas import RESULT_SCHEMAS
+
+# 高速モデルを試すプロンプトの最大文字数
+TIERED_MAX_PROMPT_CHARS = int(os.getenv("TIERED_MAX_PROMPT_CHARS", "6000"))
+
+# この絶対値以上のスコアは推論モデルで分析し直す
+TIERED_EXTREME_SCORE = float(os.getenv("TIERED_EXTREME_SCORE", "60"))
+
+
+def precheck_prompt(prompt: str) -> List[str]:
+    """高速モデルを試す前の判定（該当する理由があれば最初から推論モデルで分析する）"""
+    if len(prompt) > TIERED_MAX_PROMPT_CHARS:
+        return ["prompt_too_large"]
+    return []
+
+
+def check_fast_result(result: Any) -> List[str]:
+    """高速モデルの結果の判定（問題がなければ空リスト、あれば推論モデルに切り替える理由）"""
+    if not isinstance(result, dict) or "processing_error" in result:
+        return ["invalid_json"]
+
+    problems = RESULT_SCHEMAS["timeblock"].problems(result)
+    reasons = []
+    if any(reason in ("missing", "empty", "not_text") for reason in problems.values()):
+        reasons.append("schema_incomplete")
+    score_problem = problems.get("vibe_score")
+    if score_problem in ("not_numeric", "out_of_range"):
+        reasons.append(f"score_{score_problem}")
+
+    score = result.get("vibe_score")
+    if score_problem is None and isinstance(score, (int, float)) and not math.isnan(score):
+        if abs(score) >= TIERED_EXTREME_SCORE:
+            reasons.append("extreme_score")
+    return reasons
+
+
+class TieredScoringStats:
+    """高速モデルの採用数と推論モデルへの切り替え数（理由別）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.accepted = 0
+        self.escalated = 0
+        self.reasons: Dict[str, int] = {}
+
+    def record(self, accepted: bool, reasons: Optional[List[str]] = None) -> None:
+        with self._lock:
+            if accepted:
+                self.accepted += 1
+                return
+            self.escalated += 1
+            for reason in reasons or []:
+                self.reasons[reason] = self.reasons.get(reason, 0) + 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.accepted + self.escalated
+            return {
+                "total": total,
+                "accepted": self.accepted,
+                "escalated": self.escalated,
+                "escalation_rate": round(self.escalated / total, 3) if total else None,
+                "escalation_reasons": dict(self.reasons)
+            }
+
+
+# プロセス全体で共有する統計
+tiered_scoring_stats = TieredScoringStats()
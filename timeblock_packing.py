@@ -0,0 +1,100 @@
+"""
+タイムブロックのまとめ分析（パッキング）
+
+同じデバイス・日付の隣接するタイムブロックを K 件ずつ1回のLLM呼び出しにまとめ、
+タイムブロックをキーにしたJSONで結果を受け取り、ブロックごとの結果に分割する。
+各ブロックのプロンプト・出力は小さいため、往復回数と推論モデルの思考コストを K 分の1にできる。
+
+応答に含まれたブロックの結果は、項目の検証・修復（result_schemas.py）をブロック単位で行う。
+応答に含まれなかったブロックだけをブロック単位の分析にフォールバックする。
+"""
+
+import os
+from typing import Any, Dict, List, Tuple
+
+from llm_providers import common_prefix_at_line
+
+# 1回のLLM呼び出しにまとめるタイムブロック数（デフォルトと上限）
+TIMEBLOCK_PACK_SIZE = int(os.getenv("TIMEBLOCK_PACK_SIZE", "4"))
+TIMEBLOCK_PACK_MAX_SIZE = 8
+
+# 各ブロックのプロンプトに共通する指示文を1回だけ載せる際の最小文字数
+PACK_SHARED_PREFIX_MIN_CHARS = 200
+
+PACKING_INSTRUCTIONS = """
+---
+【複数タイムブロックの一括分析】
+以下に複数のタイムブロックの観測データを示します。各タイムブロックを上記の指示に従って個別に分析してください。
+出力は、タイムブロック（例: "17-00"）をキー、そのタイムブロック単体の分析結果（上記の指示で指定されたJSON）を値とする
+1つのJSONオブジェクトのみとしてください。すべてのタイムブロックを必ず含めてください。
+
+出力例:
+{
+  "17-00": { ...17-00 の分析結果... },
+  "17-30": { ...17-30 の分析結果... }
+}
+"""
+
+
+class PackedResponseError(ValueError):
+    """まとめ分析の応答がタイムブロックごとの結果に分割できない"""
+
+
+def chunk_time_blocks(time_blocks: List[str], pack_size: int) -> List[List[str]]:
+    """
+    タイムブロックを時刻順に並べ、隣接する pack_size 件ずつに分ける（重複は除く）
+
+    "HH-MM" 形式はゼロ埋めのため文字列順が時刻順になる。
+    """
+    pack_size = max(1, min(pack_size, TIMEBLOCK_PACK_MAX_SIZE))
+    ordered = sorted(set(time_blocks))
+    return [ordered[i:i + pack_size] for i in range(0, len(ordered), pack_size)]
+
+
+def build_packed_prompt(block_prompts: List[Tuple[str, str]]) -> str:
+    """
+    (time_block, prompt) のリストから1回分のプロンプトを作成する
+
+    各ブロックのプロンプトに共通する指示文は先頭に1回だけ載せ、
+    以降はタイムブロックごとの差分（観測データ）のみを並べる。
+    """
+    prompts = [prompt for _, prompt in block_prompts]
+    shared = common_prefix_at_line(prompts, PACK_SHARED_PREFIX_MIN_CHARS)
+
+    sections = []
+    for time_block, prompt in block_prompts:
+        sections.append(f"\n### time_block: {time_block}\n{prompt[len(shared):].strip()}\n")
+    return shared + PACKING_INSTRUCTIONS + "".join(sections)
+
+
+def split_packed_result(
+    packed_result: Dict[str, Any],
+    time_blocks: List[str]
+) -> Tuple[Dict[str, Dict[str, Any]], List[str]]:
+    """
+    まとめ分析の応答をタイムブロックごとの結果に分割する
+
+    項目の欠け・不正は検証しない（呼び出し元でブロックごとに RESULT_SCHEMAS["timeblock"] で検証・修復する）。
+
+    Returns:
+        (タイムブロック → 結果, 応答に含まれなかった・オブジェクトでなかったタイムブロック)
+
+    Raises:
+        PackedResponseError: JSON解析に失敗した、またはどのブロックの結果も含まれていない場合
+    """
+    if not isinstance(packed_result, dict) or "processing_error" in packed_result:
+        raise PackedResponseError("まとめ分析の応答をJSONとして解析できませんでした")
+
+    # "results" などで1段包まれている場合に対応
+    if not any(time_block in packed_result for time_block in time_blocks) and len(packed_result) == 1:
+        inner = next(iter(packed_result.values()))
+        if isinstance(inner, dict):
+            packed_result = inner
+
+    results = {
+        time_block: packed_result[time_block] for time_block in time_blocks
+        if isinstance(packed_result.get(time_block), dict) and "processing_error" not in packed_result[time_block]
+    }
+    if not results:
+        raise PackedResponseError("まとめ分析の応答にタイムブロックの結果が含まれていません")
+    return results, [time_block for time_block in time_blocks if time_block not in results]
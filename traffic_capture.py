@@ -0,0 +1,470 @@
+"""
+LLM・Supabaseの通信の記録と再生（性能の回帰確認用）
+
+本番の遅さは、入力（Supabaseのプロンプト）とベンダーの応答時間に依存するため手元では再現できない。
+TRAFFIC_CAPTURE=true の場合、以下をワーカーごとの圧縮ファイル（gzip圧縮のJSONL）に記録する。
+
+- request: 分析エンドポイントへのリクエスト（到着時刻・ボディ・ステータス・所要時間）
+- llm: LLM呼び出し（プロンプト・生の応答・トークン使用量・所要時間）
+- supabase: Supabaseへのクエリ（テーブル・メソッドチェーン・結果・所要時間）
+
+記録したファイルを使って、main.py の処理全体を元のリクエスト間隔・応答時間で再実行できる:
+    python traffic_capture.py replay /tmp/vibe-scorer-capture/*.jsonl.gz [--speed 2]
+    python traffic_capture.py summary /tmp/vibe-scorer-capture/*.jsonl.gz
+
+記録にはプロンプト（利用者のデータ）が含まれるため、取り扱いに注意すること。
+"""
+
+import asyncio
+import gzip
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from analysis_scheduler import percentile, prompt_hash
+from llm_providers import LLMProvider, PromptInput, prompt_text
+
+# 記録を有効にするか・記録先ディレクトリ
+TRAFFIC_CAPTURE = os.getenv("TRAFFIC_CAPTURE", "false").lower() == "true"
+TRAFFIC_CAPTURE_DIR = os.getenv("TRAFFIC_CAPTURE_DIR", "/tmp/vibe-scorer-capture")
+
+# リクエストを記録するパスの接頭辞と、記録しないパス（ボディが大きいストリーミング）
+CAPTURE_PATH_PREFIXES = ("/analyze",)
+CAPTURE_EXCLUDED_PATHS = ("/analyze-timeblocks/stream",)
+
+# クエリの内容（ペイロード）を渡すメソッド。再生時の照合キーには含めない（保存時刻などが毎回変わるため）
+PAYLOAD_METHODS = ("upsert", "insert", "update")
+
+
+class TrafficRecorder:
+    """記録ファイルへの追記（ワーカープロセスごとに1ファイル、最初の記録時に作成）"""
+
+    def __init__(self, directory: str = TRAFFIC_CAPTURE_DIR, enabled: bool = TRAFFIC_CAPTURE):
+        self.directory = directory
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._file = None
+        self.path: Optional[str] = None
+        self.records = 0
+
+    def record(self, kind: str, **fields: Any) -> None:
+        if not self.enabled:
+            return
+        line = json.dumps({"kind": kind, "ts": time.time(), **fields}, ensure_ascii=False, default=str)
+        with self._lock:
+            if self._file is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self.path = os.path.join(
+                    self.directory, f"capture-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}.jsonl.gz"
+                )
+                self._file = gzip.open(self.path, "at", encoding="utf-8")
+                print(f"🎙️ 通信の記録を開始: {self.path}")
+            self._file.write(line + "\n")
+            # 異常終了時も記録済みの分は読めるようにする
+            self._file.flush()
+            self.records += 1
+
+    @contextmanager
+    def llm_call(self, prompt: str, model: str, settings: Any = None):
+        """
+        with ブロックの所要時間とともにLLM呼び出しを記録する
+
+        ブロック内で返された dict に raw_response と usage を設定する。
+        """
+        call: Dict[str, Any] = {}
+        if not self.enabled:
+            yield call
+            return
+        started = time.perf_counter()
+        error = None
+        try:
+            yield call
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.record(
+                "llm",
+                model=model,
+                prompt_hash=prompt_hash(prompt),
+                prompt=prompt,
+                settings=settings.to_dict() if settings is not None else None,
+                raw_response=call.get("raw_response"),
+                usage=call.get("usage"),
+                latency=round(time.perf_counter() - started, 4),
+                error=error
+            )
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "path": self.path, "records": self.records}
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# プロセス全体で共有する記録
+traffic_recorder = TrafficRecorder()
+
+
+# ---------- Supabase ----------
+
+def query_signature(table: str, chain: List[Tuple[str, list, dict]]) -> str:
+    """クエリの照合キー（テーブルとメソッドチェーン。ペイロードは除く）"""
+    parts = [[name] if name in PAYLOAD_METHODS else [name, args, kwargs] for name, args, kwargs in chain]
+    return json.dumps([table, parts], ensure_ascii=False, sort_keys=True, default=str)
+
+
+class _CapturingQuery:
+    """クエリビルダーのメソッドチェーンを記録し、execute の結果と所要時間を記録する"""
+
+    def __init__(self, query: Any, table: str, recorder: TrafficRecorder):
+        self._query = query
+        self._table = table
+        self._recorder = recorder
+        self._chain: List[Tuple[str, list, dict]] = []
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._query, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            if name == "execute":
+                return self._execute(attr, *args, **kwargs)
+            self._chain.append((name, list(args), kwargs))
+            self._query = attr(*args, **kwargs)
+            return self
+
+        return call
+
+    def _execute(self, execute, *args, **kwargs):
+        started = time.perf_counter()
+        error = None
+        data = None
+        try:
+            response = execute(*args, **kwargs)
+            data = getattr(response, "data", None)
+            return response
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self._recorder.record(
+                "supabase",
+                table=self._table,
+                signature=query_signature(self._table, self._chain),
+                data=data,
+                latency=round(time.perf_counter() - started, 4),
+                error=error
+            )
+
+
+class CapturingClient:
+    """Supabaseクライアントのラッパー（table() 経由のクエリを記録する。その他の属性はそのまま委譲）"""
+
+    def __init__(self, client: Any, recorder: TrafficRecorder):
+        self._client = client
+        self._recorder = recorder
+
+    def table(self, name: str) -> _CapturingQuery:
+        return _CapturingQuery(self._client.table(name), name, self._recorder)
+
+    def __getattr__(self, name: str):
+        return getattr(self._client, name)
+
+
+# ---------- 記録ファイルの読み込み ----------
+
+def load_archive(paths: List[str]) -> List[Dict[str, Any]]:
+    """記録ファイル（複数ワーカー分）を読み込み、記録時刻順に並べる"""
+    events = []
+    for path in paths:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # 書き込み途中で終了した最終行
+                    break
+    events.sort(key=lambda event: event["ts"])
+    return events
+
+
+class _Replies:
+    """照合キーごとの記録（記録順に返し、使い切った後は最後の記録を返し続ける）"""
+
+    def __init__(self, events: List[Dict[str, Any]], key):
+        self._replies: Dict[Any, Deque[Dict[str, Any]]] = {}
+        for event in events:
+            self._replies.setdefault(key(event), deque()).append(event)
+        self.missing = 0
+
+    def take(self, key) -> Optional[Dict[str, Any]]:
+        replies = self._replies.get(key)
+        if not replies:
+            self.missing += 1
+            return None
+        return replies.popleft() if len(replies) > 1 else replies[0]
+
+
+def _sleep(seconds: float, speed: float) -> None:
+    if seconds and speed > 0:
+        time.sleep(seconds / speed)
+
+
+# ---------- 再生用のLLM・Supabase ----------
+
+class ReplayLLM(LLMProvider):
+    """
+    記録したLLMの応答を、記録した所要時間だけ待ってから返す
+
+    プロンプトのハッシュで照合する（段階的スコアリングのように同じプロンプトを複数回呼び出す場合は記録順に返す）。
+    """
+
+    def __init__(self, replies: _Replies, model: str, speed: float = 1.0):
+        self._replies = replies
+        self._model = model
+        self._speed = speed
+
+    def generate(self, prompt: PromptInput) -> str:
+        return self.generate_with_usage(prompt)[0]
+
+    def generate_with_usage(
+        self, prompt: PromptInput, settings: Any = None, partial: Optional[str] = None
+    ) -> Tuple[str, Dict[str, Any]]:
+        digest = prompt_hash(prompt_text(prompt))
+        event = self._replies.take(digest)
+        if event is None:
+            raise RuntimeError(f"記録にないプロンプトです: {digest}")
+        _sleep(event["latency"], self._speed)
+        if event.get("error"):
+            raise RuntimeError(event["error"])
+        return event["raw_response"], event.get("usage") or {}
+
+    @property
+    def model_name(self) -> str:
+        return self._model
+
+
+class _ReplayResponse:
+    def __init__(self, data: Any):
+        self.data = data
+
+
+class _ReplayQuery:
+    """メソッドチェーンを記録し、execute で同じクエリの記録を返す"""
+
+    def __init__(self, table: str, replies: _Replies, speed: float):
+        self._table = table
+        self._replies = replies
+        self._speed = speed
+        self._chain: List[Tuple[str, list, dict]] = []
+        self._payload = None
+
+    def __getattr__(self, name: str):
+        def call(*args, **kwargs):
+            self._chain.append((name, list(args), kwargs))
+            if name in PAYLOAD_METHODS and args:
+                self._payload = args[0]
+            return self
+        return call
+
+    def execute(self) -> _ReplayResponse:
+        event = self._replies.take(query_signature(self._table, self._chain))
+        if event is None:
+            # 記録にない書き込みは成功扱い、読み込みは0件
+            payload = self._payload
+            return _ReplayResponse(payload if isinstance(payload, list) else ([payload] if payload else []))
+        _sleep(event["latency"], self._speed)
+        if event.get("error"):
+            raise RuntimeError(event["error"])
+        return _ReplayResponse(event["data"])
+
+
+class ReplayClient:
+    """記録したSupabaseのクエリ結果を返すクライアント"""
+
+    def __init__(self, replies: _Replies, speed: float = 1.0):
+        self._replies = replies
+        self._speed = speed
+
+    def table(self, name: str) -> _ReplayQuery:
+        return _ReplayQuery(name, self._replies, self._speed)
+
+
+# ---------- リクエストの記録 ----------
+
+class TrafficCaptureMiddleware:
+    """分析エンドポイントへのリクエスト（到着時刻・ボディ・ステータス・所要時間）を記録するASGIミドルウェア"""
+
+    def __init__(self, app, recorder: TrafficRecorder = traffic_recorder):
+        self.app = app
+        self.recorder = recorder
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not scope["path"].startswith(CAPTURE_PATH_PREFIXES)
+            or scope["path"] in CAPTURE_EXCLUDED_PATHS
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        arrived_at = time.time()
+        started = time.perf_counter()
+        body = bytearray()
+        status = {"code": None}
+
+        async def capture_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                body.extend(message.get("body", b""))
+            return message
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, capture_receive, capture_send)
+        finally:
+            self.recorder.record(
+                "request",
+                arrived_at=arrived_at,
+                method=scope["method"],
+                path=scope["path"],
+                query=scope.get("query_string", b"").decode("latin-1"),
+                body=body.decode("utf-8", errors="replace"),
+                status=status["code"],
+                duration=round(time.perf_counter() - started, 4)
+            )
+
+
+# ---------- 再生 ----------
+
+def _latency_summary(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "p50_ms": round(percentile(values, 0.5) * 1000, 1) if values else None,
+        "p95_ms": round(percentile(values, 0.95) * 1000, 1) if values else None,
+    }
+
+
+def summarize_archive(events: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """記録の件数と、エンドポイント・LLM・Supabaseテーブルごとの所要時間"""
+    groups: Dict[str, List[float]] = {}
+    for event in events:
+        if event["kind"] == "request":
+            name = f"request {event['path']}"
+            value = event["duration"]
+        elif event["kind"] == "llm":
+            name = f"llm {event['model']}"
+            value = event["latency"]
+        else:
+            name = f"supabase {event['table']}"
+            value = event["latency"]
+        groups.setdefault(name, []).append(value)
+    return {name: {"count": len(values), **_latency_summary(values)} for name, values in sorted(groups.items())}
+
+
+async def replay(paths: List[str], speed: float = 1.0) -> Dict[str, Any]:
+    """
+    記録したリクエストを元の間隔（speed倍速）で main.py の処理全体に送り直す
+
+    LLM・Supabaseは記録した応答を記録した所要時間だけ待って返すため、
+    パーサー・サニタイズ・スケジューラーの変更による所要時間の変化を本番と同じ負荷の形で確認できる。
+    """
+    import tempfile
+
+    import httpx
+
+    events = load_archive(paths)
+    requests = [event for event in events if event["kind"] == "request"]
+    if not requests:
+        raise ValueError("記録にリクエストが含まれていません")
+
+    # 再生中の結果を本番の結果ストアに混ぜない
+    os.environ.setdefault("RESULT_STORE_PATH", os.path.join(tempfile.mkdtemp(), "results.jsonl"))
+    import main
+    from supabase_client import SupabaseClient
+
+    llm_replies = _Replies([e for e in events if e["kind"] == "llm"], key=lambda e: e["prompt_hash"])
+    db_replies = _Replies([e for e in events if e["kind"] == "supabase"], key=lambda e: e["signature"])
+    supabase = SupabaseClient.__new__(SupabaseClient)
+    supabase.client = ReplayClient(db_replies, speed)
+    current_llm = ReplayLLM(llm_replies, f"{main.CURRENT_PROVIDER}/{main.CURRENT_MODEL}", speed)
+    fast_llm = ReplayLLM(llm_replies, f"{main.FAST_PROVIDER}/{main.FAST_MODEL}", speed)
+    main.get_supabase_client = lambda: supabase
+    main.get_current_llm = lambda: current_llm
+    main.get_fast_llm = lambda: fast_llm
+
+    results: List[Dict[str, Any]] = []
+    first_arrival = requests[0]["arrived_at"]
+
+    async def send(client: httpx.AsyncClient, event: Dict[str, Any]) -> None:
+        await asyncio.sleep(max(0.0, (event["arrived_at"] - first_arrival) / speed) - (time.monotonic() - replay_started))
+        started = time.perf_counter()
+        response = await client.request(
+            event["method"],
+            event["path"] + (f"?{event['query']}" if event["query"] else ""),
+            content=event["body"].encode("utf-8"),
+            headers={"Content-Type": "application/json"}
+        )
+        results.append({
+            "path": event["path"],
+            "captured_status": event["status"],
+            "status": response.status_code,
+            "captured_duration": event["duration"],
+            "duration": time.perf_counter() - started
+        })
+
+    print(f"▶️ 再生開始: リクエスト {len(requests)}件（{speed}倍速）")
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(app=main.app, base_url="http://replay", timeout=None) as client:
+            replay_started = time.monotonic()
+            await asyncio.gather(*(send(client, event) for event in requests))
+
+    by_path: Dict[str, Dict[str, Any]] = {}
+    for path in sorted({result["path"] for result in results}):
+        items = [result for result in results if result["path"] == path]
+        by_path[path] = {
+            "count": len(items),
+            "status_mismatches": sum(1 for r in items if r["status"] != r["captured_status"]),
+            "captured": _latency_summary([r["captured_duration"] for r in items]),
+            "replayed": _latency_summary([r["duration"] for r in items]),
+        }
+    return {
+        "requests": len(results),
+        "speed": speed,
+        "endpoints": by_path,
+        "missing_llm_replies": llm_replies.missing,
+        "missing_supabase_replies": db_replies.missing,
+        "scheduler": main.llm_scheduler.metrics(),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="LLM・Supabaseの通信の記録の確認と再生")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    replay_parser = subparsers.add_parser("replay", help="記録したリクエストを元の間隔で再実行する")
+    replay_parser.add_argument("paths", nargs="+", help="記録ファイル（*.jsonl.gz）")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="再生速度（2で2倍速）")
+    summary_parser = subparsers.add_parser("summary", help="記録の件数と所要時間を表示する")
+    summary_parser.add_argument("paths", nargs="+", help="記録ファイル（*.jsonl.gz）")
+    args = parser.parse_args()
+
+    if args.command == "summary":
+        report = summarize_archive(load_archive(args.paths))
+    else:
+        report = asyncio.run(replay(args.paths, args.speed))
+    print(json.dumps(report, ensure_ascii=False, indent=2))